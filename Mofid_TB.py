@@ -9,6 +9,8 @@ import asyncio
 import json
 from time import sleep
 import uuid # For generating unique tokens
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, time as dt_time, timedelta
 from typing import List
 from PIL import Image # Still needed if we have other images, but not for Mofid CAPTCHA
@@ -32,7 +34,21 @@ from telegram.ext import (
 from telegram.ext import MessageHandler, CallbackQueryHandler
 from telegram.ext.filters import Text
 from telegram.error import BadRequest # For managing errors related to message deletion
-from mofid_module import MofidBroker # Import Mofid broker module
+from mofid_module import MofidBroker, get_driver_pool # Import Mofid broker module
+from shared_browser import stop_shared_browser
+from session_store import BrokerSessionStore
+from broker_clock import get_broker_clock
+from lead_time_store import LeadTimeStore, MIN_SAMPLES_FOR_AUTO
+from history_cache import HistoryCache
+from user_repository import UserRepository, TokenRedemption, USER_COLUMNS, TOKEN_COLUMNS, record_fingerprint
+from user_cache import UserCache
+from db_executor import DBExecutor
+from db_pool import DBPool, DB_CONCURRENCY
+from migrations import run_migrations
+from update_processor import PerUserUpdateProcessor
+from rate_limiter import RateLimiter, MySQLRateLimitBackend, InMemoryRateLimitBackend, RATE_LIMIT_BACKEND
+from order_history import (parse_order_history_file, first_accepted_epoch, merge_history_workbooks, dataframe_from_table,
+                           summarize_history, tehran_tz as history_tz)
 from selenium.webdriver.common.by import By # For closing forms (if applicable to Mofid)
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
@@ -48,7 +64,6 @@ from typing import List
 
 import mysql.connector
 from mysql.connector import Error
-from mysql.connector import pooling
 from datetime import datetime
 
 import os 
@@ -123,9 +138,23 @@ MIN_SECONDS_BETWEEN_ORDERS = 10 # This can be adjusted based on Mofid's behavior
 
 
 
-#Database connection details
+# تنظیمات موتور ارسال سریع: "webdriver" (پیش‌فرض) یا "js" (حلقه کلیک داخل صفحه)
+BURST_MODE = os.environ.get("MOFID_BURST_MODE", "webdriver").lower()
+BURST_RATE_PER_SECOND = float(os.environ.get("MOFID_BURST_RATE", 0)) or None  # خالی/صفر = بدون محدودیت نرخ
+BURST_DURATION_SECONDS = float(os.environ.get("MOFID_BURST_DURATION", 20))
+BURST_AFTER_SUCCESS = os.environ.get("MOFID_BURST_AFTER_SUCCESS", "stop").lower()  # stop / trickle / continue
+# پر کردن فرم سفارش: "webdriver" (مرحله به مرحله) یا "macro" (یک اسکریپت، با بازگشت خودکار به webdriver)
+ORDER_FORM_MODE = os.environ.get("MOFID_ORDER_FORM_MODE", "webdriver").lower()
+
+# نشست‌های رمزنگاری‌شده کارگزاری برای ورود بدون فرم (با نبود MOFID_SESSION_KEY غیرفعال است)
+broker_session_store = BrokerSessionStore()
 
-from mysql.connector import pooling
+# تاخیر یادگرفته‌شده بین اولین کلیک و ثبت در هسته، برای حالت زمان‌بندی خودکار
+lead_time_store = LeadTimeStore()
+# زمان هدف پیش‌فرض حالت خودکار: باز شدن بازار (ثبت سفارش در هسته دقیقاً در این لحظه)
+AUTO_SCHEDULE_TARGET = dt_time(8, 45, 0, 0)
+
+#Database connection details
 
 dbconfig = {
     "host": os.environ.get("MYSQLHOST"),
@@ -134,14 +163,20 @@ dbconfig = {
     "password": os.environ.get("MYSQLPASSWORD"),
     "database": os.environ.get("MYSQLDATABASE")
 }
-connection_pool = pooling.MySQLConnectionPool(pool_name="mypool", pool_size=5, **dbconfig)
+# pool در اولین استفاده ساخته می‌شود؛ اندازه‌اش با تعداد نخ‌های DBExecutor (MOFID_DB_CONCURRENCY) یکی است
+# و پیش از اولین استفاده، migrationهای معوق schema اعمال می‌شوند
+db_pool = DBPool(dbconfig, pool_size=DB_CONCURRENCY, on_create=run_migrations)
 
 def get_db_connection():
-    try:
-        return connection_pool.get_connection()
-    except Error as e:
-        logger.error(f"Error getting connection from pool: {e}")
-        return None
+    return db_pool.get_connection()
+
+# همه‌ی فراخوانی‌های پایگاه داده از handlerها با await db.run(...) روی این pool اجرا می‌شوند
+db = DBExecutor()
+
+# رکورد هر کاربر در حافظه؛ نوشتن‌های همین پروسه مستقیم و ویرایش‌های پنل ادمین با جدول ابطال پاک می‌شوند
+user_cache = UserCache(lambda telegram_id: select_user_by_telegram_id(telegram_id), get_db_connection)
+# عملیات تک‌ردیفی روی کاربران و توکن‌ها (ثبت‌نام، فعال‌سازی توکن، تغییر اشتراک)
+user_repository = UserRepository(get_db_connection, on_user_write=user_cache.invalidate)
 
 
 # --- User Data Management (Identical to telegramBotV7.py) ---
@@ -186,7 +221,13 @@ def load_users_data():
                 "last_order_submission_timestamp": log["last_order_submission_timestamp"].isoformat() if log["last_order_submission_timestamp"] else None
             }
 
-        return {"users": users, "tokens": tokens, "activity_log": activity_log}
+        # اثر انگشت ردیف‌های خوانده‌شده؛ save_users_data فقط ردیف‌های تغییرکرده یا جدید را می‌نویسد
+        fingerprints = {
+            "users": {str(user["telegram_id"]): record_fingerprint(user, USER_COLUMNS) for user in users},
+            "tokens": {token["token"]: record_fingerprint(token, TOKEN_COLUMNS) for token in tokens},
+            "activity_log": {telegram_id: activity_fingerprint(activity) for telegram_id, activity in activity_log.items()},
+        }
+        return {"users": users, "tokens": tokens, "activity_log": activity_log, "_fingerprints": fingerprints}
 
     except Error as e:
         logger.error(f"Error loading users data from MySQL: {e}")
@@ -197,7 +238,38 @@ def load_users_data():
             connection.close()
 
 
+def activity_fingerprint(activity):
+    login_attempts = activity.get("login_attempts", {})
+    return (str(login_attempts.get("count", 0)), str(login_attempts.get("first_attempt_timestamp")),
+            str(login_attempts.get("cooldown_until")), str(activity.get("last_order_submission_timestamp")))
+
+
 def save_users_data(data):
+    """
+    Bulk sync for data from load_users_data: only records that are new or changed since they
+    were loaded are written, one executemany per table. Single-record changes should use
+    user_repository instead.
+    """
+    fingerprints = data.get("_fingerprints", {})
+    loaded_users = fingerprints.get("users", {})
+    loaded_tokens = fingerprints.get("tokens", {})
+    loaded_activity = fingerprints.get("activity_log", {})
+
+    dirty_users = [tuple(user.get(column) for column in USER_COLUMNS) for user in data.get("users", [])
+                   if loaded_users.get(str(user.get("telegram_id"))) != record_fingerprint(user, USER_COLUMNS)]
+    dirty_tokens = [tuple(token.get(column) for column in TOKEN_COLUMNS) for token in data.get("tokens", [])
+                    if loaded_tokens.get(token.get("token")) != record_fingerprint(token, TOKEN_COLUMNS)]
+    dirty_activity = [(telegram_id,
+                       activity.get("login_attempts", {}).get("count", 0),
+                       activity.get("login_attempts", {}).get("first_attempt_timestamp"),
+                       activity.get("login_attempts", {}).get("cooldown_until"),
+                       activity.get("last_order_submission_timestamp"))
+                      for telegram_id, activity in data.get("activity_log", {}).items()
+                      if loaded_activity.get(telegram_id) != activity_fingerprint(activity)]
+    if not (dirty_users or dirty_tokens or dirty_activity):
+        logger.info("User data unchanged; nothing to save.")
+        return
+
     connection = get_db_connection()
     if not connection:
         logger.error("Cannot save users data: No database connection")
@@ -206,73 +278,27 @@ def save_users_data(data):
     try:
         cursor = connection.cursor()
 
-        # ذخیره یا به‌روزرسانی کاربران
-        for user in data.get("users", []):
-            cursor.execute("""
-                INSERT INTO users (telegram_id, telegram_name, registration_date, brokerage_type, full_name, 
-                                   brokerage_username, subscription_type, token, expiry_date, brokerage_password, 
-                                   real_name, national_id, phone_number, email)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        # ذخیره یا به‌روزرسانی کاربران تغییرکرده
+        if dirty_users:
+            cursor.executemany(f"""
+                INSERT INTO users ({", ".join(USER_COLUMNS)})
+                VALUES ({", ".join(["%s"] * len(USER_COLUMNS))})
                 ON DUPLICATE KEY UPDATE
-                    telegram_name = VALUES(telegram_name),
-                    registration_date = VALUES(registration_date),
-                    brokerage_type = VALUES(brokerage_type),
-                    full_name = VALUES(full_name),
-                    brokerage_username = VALUES(brokerage_username),
-                    subscription_type = VALUES(subscription_type),
-                    token = VALUES(token),
-                    expiry_date = VALUES(expiry_date),
-                    brokerage_password = VALUES(brokerage_password),
-                    real_name = VALUES(real_name),
-                    national_id = VALUES(national_id),
-                    phone_number = VALUES(phone_number),
-                    email = VALUES(email)
-            """, (
-                user.get("telegram_id"),
-                user.get("telegram_name"),
-                user.get("registration_date"),
-                user.get("brokerage_type"),
-                user.get("full_name"),
-                user.get("brokerage_username"),
-                user.get("subscription_type"),
-                user.get("token"),
-                user.get("expiry_date"),
-                user.get("brokerage_password"),
-                user.get("real_name"),
-                user.get("national_id"),
-                user.get("phone_number"),
-                user.get("email")
-            ))
-
-        # ذخیره یا به‌روزرسانی توکن‌ها
-        for token in data.get("tokens", []):
-            cursor.execute("""
-                INSERT INTO tokens (token, is_used, used_by_telegram_id, used_at, telegram_id, 
-                                    brokerage_username, subscription_type, expiry_date)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    {", ".join(f"{column} = VALUES({column})" for column in USER_COLUMNS if column != "telegram_id")}
+            """, dirty_users)
+
+        # ذخیره یا به‌روزرسانی توکن‌های تغییرکرده
+        if dirty_tokens:
+            cursor.executemany(f"""
+                INSERT INTO tokens ({", ".join(TOKEN_COLUMNS)})
+                VALUES ({", ".join(["%s"] * len(TOKEN_COLUMNS))})
                 ON DUPLICATE KEY UPDATE
-                    is_used = VALUES(is_used),
-                    used_by_telegram_id = VALUES(used_by_telegram_id),
-                    used_at = VALUES(used_at),
-                    telegram_id = VALUES(telegram_id),
-                    brokerage_username = VALUES(brokerage_username),
-                    subscription_type = VALUES(subscription_type),
-                    expiry_date = VALUES(expiry_date)
-            """, (
-                token.get("token"),
-                token.get("is_used"),
-                token.get("used_by_telegram_id"),
-                token.get("used_at"),
-                token.get("telegram_id"),
-                token.get("brokerage_username"),
-                token.get("subscription_type"),
-                token.get("expiry_date")
-            ))
-
-        # ذخیره یا به‌روزرسانی لاگ‌های فعالیت
-        for telegram_id, activity in data.get("activity_log", {}).items():
-            login_attempts = activity.get("login_attempts", {})
-            cursor.execute("""
+                    {", ".join(f"{column} = VALUES({column})" for column in TOKEN_COLUMNS if column != "token")}
+            """, dirty_tokens)
+
+        # ذخیره یا به‌روزرسانی لاگ‌های فعالیت تغییرکرده
+        if dirty_activity:
+            cursor.executemany("""
                 INSERT INTO activity_log (telegram_id, login_attempts_count, first_attempt_timestamp, 
                                           cooldown_until, last_order_submission_timestamp)
                 VALUES (%s, %s, %s, %s, %s)
@@ -281,16 +307,12 @@ def save_users_data(data):
                     first_attempt_timestamp = VALUES(first_attempt_timestamp),
                     cooldown_until = VALUES(cooldown_until),
                     last_order_submission_timestamp = VALUES(last_order_submission_timestamp)
-            """, (
-                telegram_id,
-                login_attempts.get("count", 0),
-                login_attempts.get("first_attempt_timestamp"),
-                login_attempts.get("cooldown_until"),
-                activity.get("last_order_submission_timestamp")
-            ))
+            """, dirty_activity)
 
         connection.commit()
-        logger.info("User data successfully saved to MySQL")
+        for user in dirty_users:
+            user_cache.invalidate(user[0])
+        logger.info(f"User data saved to MySQL ({len(dirty_users)} users, {len(dirty_tokens)} tokens, {len(dirty_activity)} activity rows)")
     except Error as e:
         logger.error(f"Error saving user data to MySQL: {e}")
         raise
@@ -299,11 +321,11 @@ def save_users_data(data):
             cursor.close()
             connection.close()
 
-def find_user_by_telegram_id(telegram_id):
+def select_user_by_telegram_id(telegram_id):
+    """Uncached users row (None if missing); raises mysql Error so failures are never cached."""
     connection = get_db_connection()
     if not connection:
-        logger.error("Cannot find user: No database connection")
-        return None
+        raise Error("No database connection")
 
     try:
         cursor = connection.cursor(dictionary=True)
@@ -312,14 +334,18 @@ def find_user_by_telegram_id(telegram_id):
         """, (telegram_id,))
         user = cursor.fetchone()
         return user
-    except Error as e:
-        logger.error(f"Error finding user by telegram_id {telegram_id}: {e}")
-        return None
     finally:
         if connection.is_connected():
             cursor.close()
             connection.close()
 
+def find_user_by_telegram_id(telegram_id):
+    try:
+        return user_cache.get(telegram_id)
+    except Error as e:
+        logger.error(f"Error finding user by telegram_id {telegram_id}: {e}")
+        return None
+
 def is_brokerage_username_in_use(brokerage_username_to_check: str, brokerage_type_to_check: str = "mofid") -> bool:
     connection = get_db_connection()
     if not connection:
@@ -330,7 +356,7 @@ def is_brokerage_username_in_use(brokerage_username_to_check: str, brokerage_typ
         cursor = connection.cursor()
         cursor.execute("""
             SELECT COUNT(*) FROM users
-            WHERE LOWER(brokerage_username) = LOWER(%s) AND brokerage_type = %s
+            WHERE brokerage_username_normalized = LOWER(%s) AND brokerage_type = %s
         """, (brokerage_username_to_check, brokerage_type_to_check))
         count = cursor.fetchone()[0]
         return count > 0
@@ -346,15 +372,15 @@ def is_brokerage_username_in_use(brokerage_username_to_check: str, brokerage_typ
 
 def is_subscription_active(user):
     if not user or "expiry_date" not in user or not user["expiry_date"]:
-        print(f"User {user.get('telegram_id')} has no expiry_date or it's empty")
+        logger.debug(f"User {user.get('telegram_id') if user else None} has no expiry_date or it's empty")
         return False
     try:
         expiry_date = user["expiry_date"]  # این یک شیء datetime است
         now = datetime.now()
-        print(f"Current time: {now}, Expiry date: {expiry_date}")
+        logger.debug(f"Current time: {now}, Expiry date: {expiry_date}")
         return now < expiry_date
     except Exception as e:
-        print(f"Error checking subscription for user {user.get('telegram_id')}: {e}")
+        logger.error(f"Error checking subscription for user {user.get('telegram_id')}: {e}")
         return False
 
 def get_time_remaining(user):
@@ -374,48 +400,6 @@ def get_time_remaining(user):
 
 
 
-def validate_premium_token(token_string, telegram_id, brokerage_username_for_validation):
-    connection = get_db_connection()
-    if not connection:
-        logger.error("Cannot validate token: No database connection")
-        return {"valid": False, "message": "خطای اتصال به پایگاه داده"}
-
-    try:
-        cursor = connection.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM tokens WHERE token = %s", (token_string,))
-        token_data = cursor.fetchone()
-
-        if not token_data:
-            return {"valid": False, "message": "توکن نامعتبر یا پیدا نشد."}
-
-        if token_data.get("is_used", False):
-            logger.warning(f"Attempt to use already used token {token_string} by Telegram ID {telegram_id}")
-            return {"valid": False, "message": "این توکن قبلا استفاده شده است."}
-
-        token_bound_telegram_id = token_data.get("telegram_id")
-        if token_bound_telegram_id and str(token_bound_telegram_id) != str(telegram_id):
-            logger.warning(f"Token {token_string} (for Telegram ID {token_bound_telegram_id}) attempted by {telegram_id}")
-            return {"valid": False, "message": "این توکن برای شناسه تلگرام شما صادر نشده است."}
-
-        token_bound_brokerage_username = token_data.get("brokerage_username")
-        if token_bound_brokerage_username and brokerage_username_for_validation.lower() != token_bound_brokerage_username.lower():
-            logger.warning(f"Token {token_string} (for brokerage {token_bound_brokerage_username}) attempted with brokerage {brokerage_username_for_validation} by {telegram_id}")
-            return {"valid": False, "message": f"این توکن برای نام کاربری کارگزاری '{brokerage_username_for_validation}' معتبر نیست."}
-
-        if "expiry_date" in token_data and token_data["expiry_date"]:
-            if datetime.now() >= token_data["expiry_date"]:
-                logger.warning(f"Attempted to use expired token: {token_string}")
-                return {"valid": False, "message": "توکن منقضی شده است."}
-
-        return {"valid": True, "token_data": token_data}
-    except Error as e:
-        logger.error(f"Error validating token {token_string}: {e}")
-        return {"valid": False, "message": "خطا در بررسی توکن"}
-    finally:
-        if connection.is_connected():
-            cursor.close()
-            connection.close()
-
 def calculate_premium_expiry(subscription_type):
     now = datetime.now()
     if subscription_type == "روزانه": return now + timedelta(days=1)
@@ -425,144 +409,94 @@ def calculate_premium_expiry(subscription_type):
         logger.warning(f"Unknown sub type for expiry: {subscription_type}. Defaulting to 1 day.")
         return now + timedelta(days=1)
 
-# --- Rate Limiting (Identical to telegramBotV7.py) ---
+# --- Rate Limiting ---
+# هر بررسی فقط ردیف همان کاربر را (با کش درون‌پروسه‌ای) می‌خواند؛ بررسی و ثبت سفارش در یک دستور اتمیک انجام می‌شود
+rate_limiter = RateLimiter(
+    InMemoryRateLimitBackend() if RATE_LIMIT_BACKEND == "memory" else MySQLRateLimitBackend(get_db_connection),
+    max_login_attempts=MAX_LOGIN_ATTEMPTS,
+    login_window_minutes=LOGIN_ATTEMPT_WINDOW_MINUTES,
+    login_cooldown_minutes=LOGIN_COOLDOWN_MINUTES,
+    min_seconds_between_orders=MIN_SECONDS_BETWEEN_ORDERS,
+)
+
 def check_login_rate_limit(user_id: int) -> tuple[bool, str]:
-    user_id_str = str(user_id)
-    now = datetime.now()
-    activity_data = load_users_data().get("activity_log", {})
-    user_login_activity = activity_data.get(user_id_str, {}).get("login_attempts", {})
-    cooldown_until_str = user_login_activity.get("cooldown_until")
-    if cooldown_until_str:
-        cooldown_until = datetime.fromisoformat(cooldown_until_str)
-        if now < cooldown_until:
-            rem_cooldown = cooldown_until - now
-            return True, f"{EMOJI['ratelimit']} محدودیت ورود. لطفاً پس از {int(rem_cooldown.total_seconds() // 60)} دقیقه تلاش کنید."
+    remaining_seconds = rate_limiter.login_cooldown_remaining(user_id)
+    if remaining_seconds > 0:
+        return True, f"{EMOJI['ratelimit']} محدودیت ورود. لطفاً پس از {int(remaining_seconds // 60)} دقیقه تلاش کنید."
     return False, ""
 
 def record_failed_login_attempt(user_id: int):
-    user_id_str = str(user_id)
-    now = datetime.now()
-    connection = get_db_connection()
-    if not connection:
-        logger.error("Cannot record failed login attempt: No database connection")
-        return
-
-    try:
-        cursor = connection.cursor()
-        cursor.execute("""
-            SELECT login_attempts_count, first_attempt_timestamp
-            FROM activity_log
-            WHERE telegram_id = %s
-        """, (user_id_str,))
-        result = cursor.fetchone()
-
-        if result:
-            count, first_attempt_ts = result
-            if first_attempt_ts and now - first_attempt_ts < timedelta(minutes=LOGIN_ATTEMPT_WINDOW_MINUTES):
-                count += 1
-            else:
-                count = 1
-                first_attempt_ts = now
-        else:
-            count = 1
-            first_attempt_ts = now
-
-        cooldown_until = None
-        if count >= MAX_LOGIN_ATTEMPTS:
-            cooldown_until = now + timedelta(minutes=LOGIN_COOLDOWN_MINUTES)
-            count = 0
-            first_attempt_ts = None
-            logger.warning(f"User {user_id_str} rate-limited for login. Cooldown until: {cooldown_until}")
-
-        cursor.execute("""
-            INSERT INTO activity_log (telegram_id, login_attempts_count, first_attempt_timestamp, cooldown_until)
-            VALUES (%s, %s, %s, %s)
-            ON DUPLICATE KEY UPDATE
-                login_attempts_count = %s,
-                first_attempt_timestamp = %s,
-                cooldown_until = %s
-        """, (user_id_str, count, first_attempt_ts, cooldown_until, count, first_attempt_ts, cooldown_until))
-
-        connection.commit()
-    except Error as e:
-        logger.error(f"Error recording failed login attempt for user {user_id}: {e}")
-    finally:
-        if connection.is_connected():
-            cursor.close()
-            connection.close()
+    rate_limiter.record_failed_login(user_id)
 
 def reset_login_attempts(user_id: int):
-    user_id_str = str(user_id)
-    connection = get_db_connection()
-    if not connection:
-        logger.error("Cannot reset login attempts: No database connection")
-        return
-
-    try:
-        cursor = connection.cursor()
-        cursor.execute("""
-            UPDATE activity_log
-            SET login_attempts_count = 0, first_attempt_timestamp = NULL, cooldown_until = NULL
-            WHERE telegram_id = %s
-        """, (user_id_str,))
-        connection.commit()
-        logger.info(f"Login attempts reset for user {user_id_str}")
-    except Error as e:
-        logger.error(f"Error resetting login attempts for user {user_id}: {e}")
-    finally:
-        if connection.is_connected():
-            cursor.close()
-            connection.close()
+    rate_limiter.reset_login(user_id)
 
 def check_order_submission_rate_limit(user_id: int) -> tuple[bool, str]:
-    user_id_str = str(user_id)
-    now = datetime.now()
-    activity_data = load_users_data().get("activity_log", {})
-    last_sub_ts_str = activity_data.get(user_id_str, {}).get("last_order_submission_timestamp")
-    if last_sub_ts_str:
-        last_sub_ts = datetime.fromisoformat(last_sub_ts_str)
-        if now - last_sub_ts < timedelta(seconds=MIN_SECONDS_BETWEEN_ORDERS):
-            wait_time = MIN_SECONDS_BETWEEN_ORDERS - (now - last_sub_ts).total_seconds()
-            return True, f"{EMOJI['ratelimit']} ثبت سفارش سریع. لطفاً {int(wait_time) + 1} ثانیه دیگر تلاش کنید."
+    """Check and (when allowed) record the submission in one atomic step."""
+    wait_time = rate_limiter.acquire_order_slot(user_id)
+    if wait_time > 0:
+        return True, f"{EMOJI['ratelimit']} ثبت سفارش سریع. لطفاً {int(wait_time) + 1} ثانیه دیگر تلاش کنید."
     return False, ""
 
 def record_order_submission(user_id: int):
-    user_id_str = str(user_id)
-    now = datetime.now()
-    connection = get_db_connection()
-    if not connection:
-        logger.error("Cannot record order submission: No database connection")
-        return
-
-    try:
-        cursor = connection.cursor()
-        cursor.execute("""
-            INSERT INTO activity_log (telegram_id, last_order_submission_timestamp)
-            VALUES (%s, %s)
-            ON DUPLICATE KEY UPDATE last_order_submission_timestamp = %s
-        """, (user_id_str, now, now))
-        connection.commit()
-    except Error as e:
-        logger.error(f"Error recording order submission for user {user_id}: {e}")
-    finally:
-        if connection.is_connected():
-            cursor.close()
-            connection.close()
+    rate_limiter.record_order(user_id)
 
 
 class MofidBrokerSession:
     def __init__(self, user_id):
         self.user_id = user_id
-        self.bot = MofidBroker()
+        self.bot = MofidBroker(session_id=f"{user_id}-{uuid.uuid4().hex[:8]}")
         self.is_logged_in = False
         self.order_details = {}
         self.logs = []
         self.order_detail_message_ids = []  
         self.active_orders = set()
         self.credentials = {}
+        self.brokerage_username = None
         self.user_data = None
+        self.last_burst = None  # {"stock", "started_at"} آخرین ارسال پیاپی، برای یادگیری تاخیر پذیرش
+        self.history_cache = HistoryCache()  # نتایج تاریخچه سفارشات به تفکیک (نماد، سمت، فیلتر وضعیت)
         self.last_activity_time = datetime.now()  # Initialize last activity time
         self.inactivity_timeout_task = None
+        # All Selenium work for this session runs on one dedicated thread so the event loop never blocks
+        self.driver_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"mofid-driver-{user_id}")
+
+    async def run_driver_task(self, func, *args, **kwargs):
+        """Run a blocking WebDriver call on this session's driver thread and await its result."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.driver_executor, functools.partial(func, *args, **kwargs))
+
+    async def close(self):
+        """Release the driver on the driver thread (after any running order work), then stop that thread. Call before discarding the session."""
+        await self.run_driver_task(self.safe_quit)
+        self.driver_executor.shutdown(wait=False)
+
+    def learn_lead_time(self, history_path):
+        """
+        Record the delay between the last burst's first click and the first accepted order
+        found in a downloaded history file. Returns the lead time in ms, or None.
+        """
+        burst = self.last_burst
+        if not burst or burst.get("learned") or not history_path:
+            return None
+        burst_date = datetime.fromtimestamp(burst["started_at"], history_tz).date()
+        return self.learn_lead_time_from_rows(parse_order_history_file(history_path, burst_date))
+
+    def learn_lead_time_from_rows(self, history_rows):
+        """Same as learn_lead_time, for rows already parsed (order_history.rows_from_dataframe)."""
+        burst = self.last_burst
+        if not burst or burst.get("learned"):
+            return None
+        accepted_epoch = first_accepted_epoch(history_rows, burst["started_at"])
+        if accepted_epoch is None:
+            logger.info(f"No accepted order after the last burst found in history for user {self.user_id}.")
+            return None
+        lead_ms = max(0.0, (accepted_epoch - burst["started_at"]) * 1000)
+        if lead_time_store.record(self.user_id, burst["stock"], lead_ms):
+            burst["learned"] = True
+            self.add_log(f"تاخیر پذیرش سفارش در هسته ثبت شد: {lead_ms:.0f} میلی‌ثانیه", "info")
+            return lead_ms
+        return None
 
     def update_activity(self):
         """Update the last activity timestamp."""
@@ -583,7 +517,7 @@ class MofidBrokerSession:
                 try:
                     scheduled_time_str = self.order_details["scheduled_time_str_for_module"]
                     scheduled_time = datetime.strptime(scheduled_time_str, "%H:%M:%S.%f").time()
-                    current_time = now.time()
+                    current_time = get_broker_clock().now_tehran().time()
                     # Convert times to seconds for comparison
                     scheduled_seconds = scheduled_time.hour * 3600 + scheduled_time.minute * 60 + scheduled_time.second + (scheduled_time.microsecond / 1_000_000)
                     current_seconds = current_time.hour * 3600 + current_time.minute * 60 + current_time.second + (current_time.microsecond / 1_000_000)
@@ -614,7 +548,8 @@ class MofidBrokerSession:
             # Only close browser if inactive for 5 minutes AND no pending orders
             if inactivity_duration >= 300 and not has_pending_orders:  # 5 minutes = 300 seconds
                 logger.info(f"User {self.user_id} inactive for 5 minutes with no pending orders. Closing browser.")
-                self.safe_quit()
+                await self.run_driver_task(self.save_broker_session_blocking)
+                await self.run_driver_task(self.safe_quit)
                 try:
                     await context.bot.send_message(
                         chat_id=self.user_id,
@@ -634,25 +569,231 @@ class MofidBrokerSession:
         # logger.info(f"User {self.user_id} Log: {message}") # Optional: also log to main logger
         return log_entry
 
+    def save_broker_session_blocking(self):
+        """Persist the current broker web session (encrypted) so the next login can skip the form. Runs on the driver thread."""
+        if not broker_session_store.enabled or not self.is_logged_in or not self.brokerage_username:
+            return False
+        return broker_session_store.save(self.user_id, self.brokerage_username, self.bot.export_session_state())
+
     def safe_quit(self):
         """Safely quit the WebDriver for Mofid."""
         if self.bot and self.bot.driver:
             try:
-                self.bot.driver.quit()
-                logger.info(f"Mofid WebDriver quit for user {self.user_id}")
+                # درایور به استخر برمی‌گردد و در صورت امن بودن پس از پاک‌سازی دوباره استفاده می‌شود
+                self.bot.release_driver()
+                logger.info(f"Mofid WebDriver released for user {self.user_id}")
             except Exception as e:
                 logger.error(f"Error quitting Mofid WebDriver for user {self.user_id}: {e}")
             self.bot.driver = None
+        if self.bot:
+            self.bot.cleanup_download_dir()
         self.is_logged_in = False
         # self.stocks_in_watchlist.clear() # Mofid module doesn't use a watchlist in the same way
 
+    def reset_settings_blocking(self):
+        """Reset the Mofid platform settings to default. Runs on the driver thread."""
+        settings_reset_successful = False
+        try:
+            self.add_log("شروع فرآیند بازنشانی تنظیمات به حالت پیش‌فرض...", "info")
+            try:
+                self.add_log("در حال کلیک روی آیکون تنظیمات...", "info")
+                settings_icon_clickable_part = self.bot.wait_for_element(By.CSS_SELECTOR, "li#settings-li span#settings-span", timeout=15) 
+                settings_icon_clickable_part.click()
+                self.add_log("روی آیکون تنظیمات کلیک شد.", "success")
+                sleep(1) 
+            except Exception as e:
+                self.add_log(f"خطا در کلیک روی آیکون تنظیمات: {str(e)}", "error")
+                logger.error(f"Error clicking settings icon for user {self.user_id}: {e}")
+
+            try:
+                self.add_log("در حال کلیک روی دکمه 'بازگشت به تنظیمات پیش‌فرض'...", "info")
+                reset_button = self.bot.wait_for_element(By.CSS_SELECTOR, "div[data-cy='reset-to-default-setting-btn']", timeout=10) 
+                reset_button.click()
+                self.add_log("روی دکمه 'بازگشت به تنظیمات پیش‌فرض' کلیک شد.", "success")
+                sleep(1) 
+            except Exception as e:
+                self.add_log(f"خطا در کلیک روی دکمه 'بازگشت به تنظیمات پیش‌فرض': {str(e)}", "error")
+                logger.error(f"Error clicking reset-to-default button for user {self.user_id}: {e}")
+
+            try:
+                self.add_log("در حال کلیک روی دکمه 'تایید' در مودال...", "info")
+                confirm_button = self.bot.wait_for_element(By.CSS_SELECTOR, "button[data-cy='setting-reset-to-default-modal-confirm']", timeout=10) 
+                confirm_button.click()
+                self.add_log("روی دکمه 'تایید' در مودال کلیک شد. تنظیمات باید بازنشانی شده باشند.", "success")
+                settings_reset_successful = True
+                sleep(1.5) 
+            except Exception as e:
+                self.add_log(f"خطا در کلیک روی دکمه 'تایید' در مودال: {str(e)}", "error")
+                logger.error(f"Error clicking confirm button in modal for user {self.user_id}: {e}")
+
+            self.add_log("فرآیند بازنشانی تنظیمات به پایان رسید.", "info")
+        except Exception as e:
+            self.add_log(f"خطای کلی در فرآیند بازنشانی تنظیمات: {str(e)}", "error")
+            logger.error(f"Overall error in settings reset process for user {self.user_id}: {e}")
+        return settings_reset_successful
+
+    def extract_identity_blocking(self):
+        """Open the profile page and scrape identity fields. Runs on the driver thread."""
+        identity_data_extracted = {}
+        original_window = None
+        new_tab_opened = False
+        try:
+            if not self.bot.driver:
+                self.add_log("خطا: درایور Selenium برای استخراج اطلاعات هویتی موجود نیست.", "error")
+                raise Exception("Selenium driver not available for identity extraction.")
+
+            original_window = self.bot.driver.current_window_handle
+            windows_before_click = set(self.bot.own_window_handles())
+
+            self.add_log("در حال کلیک روی منوی پروفایل (market-data-pop-over)...", "info")
+            profile_popover_css_selector = "div[data-cy='market-data-pop-over']"
+            profile_popover = WebDriverWait(self.bot.driver, 15).until( 
+                EC.element_to_be_clickable((By.CSS_SELECTOR, profile_popover_css_selector))
+            )
+            self.bot.driver.execute_script("arguments[0].scrollIntoView({block: 'center', inline: 'center'});", profile_popover)
+            sleep(0.3)
+            try:
+                profile_popover.click()
+            except ElementClickInterceptedException:
+                self.add_log("کلیک مستقیم روی منوی پروفایل رهگیری شد. تلاش با کلیک جاوا اسکریپت...", "warning")
+                self.bot.driver.execute_script("arguments[0].click();", profile_popover)
+            self.add_log("روی منوی پروفایل کلیک شد.", "success")
+            sleep(1)
+
+            self.add_log("در حال کلیک روی 'ویرایش حساب کاربری'...", "info")
+            edit_account_button_xpath = "//div[contains(@class, 'dropdown-item') and contains(., 'ویرایش حساب کاربری')]"
+            edit_account_button = WebDriverWait(self.bot.driver, 10).until( 
+                EC.element_to_be_clickable((By.XPATH, edit_account_button_xpath))
+            )
+            self.bot.driver.execute_script("arguments[0].scrollIntoView({block: 'center', inline: 'center'});", edit_account_button)
+            sleep(0.3)
+            try:
+                edit_account_button.click()
+            except ElementClickInterceptedException:
+                self.add_log("کلیک مستقیم روی 'ویرایش حساب کاربری' رهگیری شد. تلاش با جاوااسکریپت...", "warning")
+                self.bot.driver.execute_script("arguments[0].click();", edit_account_button)
+            self.add_log("روی 'ویرایش حساب کاربری' کلیک شد.", "success")
+
+            WebDriverWait(self.bot.driver, 10).until( 
+                lambda driver: len(self.bot.own_window_handles()) > len(windows_before_click) or \
+                               "profile" in driver.current_url.lower() or \
+                               "customer" in driver.current_url.lower() 
+            )
+            sleep(1)
+
+            current_windows = set(self.bot.own_window_handles())
+            if len(current_windows) > len(windows_before_click):
+                new_window_handle = (current_windows - windows_before_click).pop()
+                self.bot.driver.switch_to.window(new_window_handle)
+                new_tab_opened = True
+                self.add_log(f"به تب جدید پروفایل ({new_window_handle}) سوئیچ شد. URL: {self.bot.driver.current_url}", "info")
+                sleep(0.5)
+
+            profile_list_xpath = "//div[contains(@class, 'profile-list')]"
+            self.add_log(f"در حال تلاش برای یافتن کانتینر اطلاعات پروفایل در آدرس: {self.bot.driver.current_url}", "debug")
+            WebDriverWait(self.bot.driver, 20).until( # افزایش زمان انتظار
+                EC.visibility_of_element_located((By.XPATH, profile_list_xpath))
+            )
+            self.add_log("کانتینر اطلاعات پروفایل (profile-list) پیدا شد.", "info")
+
+            profile_items_xpath = f"{profile_list_xpath}//div[contains(@class, 'profile-item')]"
+            profile_items = self.bot.driver.find_elements(By.XPATH, profile_items_xpath)
+
+            if not profile_items:
+                self.add_log("هیچ آیتم پروفایلی (profile-item) برای استخراج اطلاعات هویتی یافت نشد.", "warning")
+            else:
+                self.add_log(f"تعداد {len(profile_items)} آیتم پروفایل پیدا شد.", "info")
+
+            for item_idx, item in enumerate(profile_items):
+                try:
+                    self.bot.driver.execute_script("arguments[0].scrollIntoView({block: 'center', inline: 'center'});", item)
+                    sleep(0.1) 
+                    label_element = item.find_element(By.CSS_SELECTOR, "div.font-bold.text-sm")
+                    label_text = label_element.text.strip()
+                    value_text = ""
+                    value_container = item.find_element(By.XPATH, ".//div[contains(@class, 'flex-1') and contains(@class, 'flex') and contains(@class, 'w-full')]")
+                    child_divs = value_container.find_elements(By.XPATH, "./div")
+
+                    if len(child_divs) > 1: 
+                        for child_div in child_divs:
+                            if "font-bold" not in child_div.get_attribute("class"):
+                                value_text = child_div.text.strip()
+                                break
+                    if not value_text: 
+                        all_text_in_item = item.text.splitlines()
+                        if label_text and all_text_in_item:
+                            for line_idx, line in enumerate(all_text_in_item):
+                                if label_text in line and line_idx + 1 < len(all_text_in_item):
+                                    potential_value = all_text_in_item[line_idx+1].strip()
+                                    if potential_value: 
+                                        value_text = potential_value
+                                        break
+                                elif label_text in line and ":" in line:
+                                    value_text = line.split(":",1)[-1].strip()
+                                    break
+                    value_text = value_text.replace(":", "").strip()
+
+                    if "نام و نام خانوادگی" in label_text and not identity_data_extracted.get("real_name"):
+                        identity_data_extracted["real_name"] = value_text
+                        self.add_log(f"نام و نام خانوادگی استخراج شد: '{value_text}'", "info")
+                    elif "کدملی" in label_text and not identity_data_extracted.get("national_id"):
+                        identity_data_extracted["national_id"] = value_text
+                        self.add_log(f"کدملی استخراج شد: '{value_text}'", "info")
+                    elif "شماره همراه" in label_text and not identity_data_extracted.get("phone_number"):
+                        identity_data_extracted["phone_number"] = value_text
+                        self.add_log(f"شماره همراه استخراج شد: '{value_text}'", "info")
+                    elif "ایمیل" in label_text and not identity_data_extracted.get("email"):
+                        identity_data_extracted["email"] = value_text
+                        self.add_log(f"ایمیل استخراج شد: '{value_text}'", "info")
+                except Exception as e_item_proc:
+                    self.add_log(f"خطا در پردازش آیتم پروفایل ({item_idx}) '{label_text if 'label_text' in locals() else 'N/A'}': {e_item_proc}", "warning")
+                    logger.debug(f"Error processing profile item ({item_idx}): {e_item_proc}, item HTML: {item.get_attribute('outerHTML')}")
+
+            if not any(identity_data_extracted.values()):
+                 self.add_log("هشدار: هیچ اطلاعات هویتی از آیتم‌های پروفایل استخراج نشد.", "warning")
+
+        except TimeoutException as e_profile_content:
+            self.add_log(f"خطای Timeout: محتوای صفحه پروفایل (profile-list) در زمان مقرر بارگذاری نشد. URL: {self.bot.driver.current_url}", "error")
+            logger.error(f"Timeout waiting for profile content for user {self.user_id}: {e_profile_content}")
+        except Exception as e_extract_generic:
+            self.add_log(f"خطای کلی در استخراج اطلاعات هویتی: {str(e_extract_generic)}", "error")
+            logger.error(f"Generic error extracting identity info for user {self.user_id} at URL {self.bot.driver.current_url}: {e_extract_generic}")
+        finally:
+            if new_tab_opened and original_window:
+                try:
+                    self.add_log(f"بستن تب پروفایل: '{self.bot.driver.title}'", "info")
+                    self.bot.driver.close()
+                    self.bot.driver.switch_to.window(original_window)
+                    self.add_log(f"بازگشت به تب اصلی: '{self.bot.driver.title}'", "info")
+                except Exception as e_tab_close:
+                    self.add_log(f"خطا در بستن تب پروفایل یا سوئیچ به تب اصلی: {e_tab_close}", "error")
+                    logger.error(f"Error closing/switching tab for user {self.user_id}: {e_tab_close}")
+                    try: # تلاش برای بازگشت به صفحه اصلی در صورت خطا
+                        if original_window in self.bot.driver.window_handles:
+                            self.bot.driver.switch_to.window(original_window)
+                        self.bot.driver.get("https://online.mofidbrokerage.ir/")
+                    except: pass
+            elif ("profile" in self.bot.driver.current_url.lower() or \
+                  "customer" in self.bot.driver.current_url.lower()) and \
+                  self.bot.driver.current_window_handle == original_window:
+                try:
+                    self.bot.driver.get("https://online.mofidbrokerage.ir/") 
+                    self.add_log("بازگشت به صفحه اصلی معاملات (از همان تب).", "info")
+                    sleep(0.5) 
+                except Exception as e_nav_same_tab:
+                     self.add_log(f"خطا در بازگشت به صفحه اصلی (از همان تب): {e_nav_same_tab}", "warning")
+        return identity_data_extracted
+
     # --- Wrappers for MofidBroker methods to standardize return types or add logging ---
     async def mofid_login(self, username, password):
         """Wrapper for MofidBroker's login_to_website."""
         try:
-            success = self.bot.login_to_website(username, password)
+            self.brokerage_username = username
+            saved_session_state = broker_session_store.load(self.user_id, username)
+            success = await self.run_driver_task(self.bot.login_to_website, username, password, session_state=saved_session_state)
             if success:
                 self.is_logged_in = True
+                await self.run_driver_task(self.save_broker_session_blocking)
                 return {"success": True, "message": "ورود به کارگزاری مفید موفقیت آمیز بود."}
             else:
                 return {"success": False, "message": "خطا در ورود به کارگزاری مفید. اطلاعات صحیح نیست یا مشکلی رخ داده."}
@@ -668,7 +809,7 @@ class MofidBrokerSession:
         if not self.is_logged_in:
             return {"success": False, "message": "ابتدا باید وارد حساب کارگزاری شوید."}
         try:
-            success = self.bot.search_stock(stock_name)
+            success = await self.run_driver_task(self.bot.search_stock, stock_name)
             if success:
                 return {"success": True, "message": f"نماد '{stock_name}' با موفقیت پیدا و انتخاب شد."}
             else:
@@ -697,31 +838,42 @@ class MofidBrokerSession:
         order_submission_logs = []
         try:
             # result_from_broker شامل click_count خواهد بود
-            result_from_broker = self.bot.place_order(
+            result_from_broker = await self.run_driver_task(
+                self.bot.place_order,
                 action=mofid_action,
                 quantity=quantity,
                 price_option=mofid_price_option,
                 custom_price=custom_price,
                 send_option=mofid_send_option,
-                scheduled_time_str=scheduled_time_str
+                scheduled_time_str=scheduled_time_str,
+                burst_mode=BURST_MODE,
+                burst_rate_per_second=BURST_RATE_PER_SECOND,
+                burst_duration_seconds=BURST_DURATION_SECONDS,
+                after_success=BURST_AFTER_SUCCESS,
+                form_mode=ORDER_FORM_MODE
             )
 
             # استخراج click_count و سایر موارد لازم
             click_count_val = result_from_broker.get("click_count", 0)
             submission_logs_val = result_from_broker.get("submission_logs", [])
+            if result_from_broker.get("burst_started_at") and click_count_val:
+                self.last_burst = {"stock": stock_name, "started_at": result_from_broker["burst_started_at"]}
+            timing_info = {key: result_from_broker.get(key) for key in ("burst_duration", "fire_jitter_ms", "release_jitter_ms", "burst_mode", "accepted_at", "restage_count", "clock_offset_ms", "clock_uncertainty_ms",
+                                                                     "requests_sent", "requests_accepted", "requests_rejected", "requests_pending",
+                                                                     "latency_histogram", "latency_p50_ms", "latency_p95_ms")}
 
             if result_from_broker["success"]:
                 final_message = "سفارش با موفقیت در هسته معاملات ثبت گردید."
                 current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
                 order_submission_logs.append(f"{current_time}: نتیجه: {final_message}")
                 order_submission_logs.extend(submission_logs_val)
-                return {"success": True, "message": final_message, "submission_logs": order_submission_logs, "click_count": click_count_val}
+                return {"success": True, "message": final_message, "submission_logs": order_submission_logs, "click_count": click_count_val, **timing_info}
             else:
                 final_message = "ارسال سفارش ناموفق بود."
                 current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
                 order_submission_logs.append(f"{current_time}: نتیجه: {final_message}")
                 order_submission_logs.extend(submission_logs_val)
-                return {"success": False, "message": final_message, "submission_logs": order_submission_logs, "click_count": click_count_val}
+                return {"success": False, "message": final_message, "submission_logs": order_submission_logs, "click_count": click_count_val, **timing_info}
 
         except Exception as e:
             logger.error(f"Mofid place_order error for user {self.user_id}: {e}")
@@ -778,9 +930,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     session.active_orders = set()
     session.credentials = {}
     if session.is_logged_in:  # If there was an active selenium session, try to close it.
-        session.safe_quit()
+        await session.run_driver_task(session.safe_quit)
 
-    user_data_from_db = find_user_by_telegram_id(user_id)
+    user_data_from_db = await db.run_or(None, find_user_by_telegram_id, user_id)
     
     if user_data_from_db and user_data_from_db.get("brokerage_type") != "mofid":
         welcome_text = (
@@ -985,15 +1137,16 @@ async def get_brokerage_username(update: Update, context: ContextTypes.DEFAULT_T
     session.user_data["brokerage_username"] = brokerage_username_input 
     
     # Check for free trial uniqueness for this Mofid username
-    if is_brokerage_username_in_use(brokerage_username_input, "mofid"):
-        data = load_users_data()
-        associated_user_is_current_user = False
-        for usr in data.get("users", []):
-            if usr.get("brokerage_username", "").lower() == brokerage_username_input.lower() and \
-               usr.get("brokerage_type") == "mofid" and \
-               str(usr.get("telegram_id")) == str(session.user_id):
-                associated_user_is_current_user = True
-                break
+    try:
+        username_owners = await db.run(user_repository.brokerage_username_owners, brokerage_username_input, "mofid")
+    except Error as e:
+        logger.error(f"Error checking Mofid brokerage username for user {session.user_id}: {e}")
+        await update.message.reply_text(
+            f"{EMOJI['error']} خطا در بررسی نام کاربری کارگزاری. لطفا چند لحظه بعد مجددا نام کاربری را وارد کنید:"
+        )
+        return REGISTER_BROKERAGE_USERNAME
+    if username_owners:
+        associated_user_is_current_user = str(session.user_id) in username_owners
         
         if not associated_user_is_current_user:
             logger.warning(f"Registration attempt by {session.user_id} with already used Mofid brokerage username '{brokerage_username_input}'.")
@@ -1021,6 +1174,19 @@ async def get_brokerage_username(update: Update, context: ContextTypes.DEFAULT_T
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
     return REGISTER_HAS_TOKEN
+async def reply_registration_db_error(query) -> int:
+    """Database failed during the free/premium choice: keep the registration open so the user can retry."""
+    keyboard = [
+        [InlineKeyboardButton(f"{EMOJI['free']} تلاش مجدد حساب رایگان (مفید)", callback_data="has_token_no")],
+        [InlineKeyboardButton(f"{EMOJI['token']} توکن فعال‌سازی پریمیوم دارم", callback_data="has_token_yes")],
+        [InlineKeyboardButton("❌ انصراف از ثبت‌نام", callback_data="cancel_registration_mofid")],
+    ]
+    await query.edit_message_text(
+        f"{EMOJI['error']} خطا در ارتباط با پایگاه داده. لطفا چند لحظه بعد مجددا تلاش کنید:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    return REGISTER_HAS_TOKEN
+
 async def has_token(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
@@ -1031,15 +1197,13 @@ async def has_token(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         await query.edit_message_text(f"{EMOJI['token']} لطفا توکن فعال‌سازی خود را وارد کنید:")
         return REGISTER_TOKEN_INPUT
     else: # User chooses free account for Mofid
-        if is_brokerage_username_in_use(session.user_data["brokerage_username"], "mofid"):
-            data = load_users_data()
-            associated_user_is_current_user = False
-            for usr in data.get("users", []):
-                if usr.get("brokerage_username", "").lower() == session.user_data["brokerage_username"].lower() and \
-                   usr.get("brokerage_type") == "mofid" and \
-                   str(usr.get("telegram_id")) == str(session.user_id):
-                    associated_user_is_current_user = True
-                    break
+        try:
+            username_owners = await db.run(user_repository.brokerage_username_owners, session.user_data["brokerage_username"], "mofid")
+        except Error as e:
+            logger.error(f"Error checking Mofid brokerage username for free trial of user {session.user_id}: {e}")
+            return await reply_registration_db_error(query)
+        if username_owners:
+            associated_user_is_current_user = str(session.user_id) in username_owners
             if not associated_user_is_current_user:
                 logger.warning(f"Free trial for Mofid denied for {session.user_id} (brokerage '{session.user_data['brokerage_username']}' already in use by another TG ID for Mofid).")
                 await query.edit_message_text(
@@ -1055,10 +1219,12 @@ async def has_token(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         session.user_data["expiry_date"] = (datetime.now() + timedelta(days=3)).strftime("%Y-%m-%d %H:%M:%S")
         session.add_log("کاربر حساب رایگان (مفید) را انتخاب کرد", "info")
 
-        all_data = load_users_data()
-        all_data["users"] = [u for u in all_data["users"] if str(u.get("telegram_id")) != str(session.user_id)]
-        all_data["users"].append(session.user_data) 
-        save_users_data(all_data)
+        try:
+            await db.run(user_repository.upsert_user, session.user_data)
+        except Error as e:
+            session.add_log(f"خطا در ذخیره اطلاعات کاربر جدید (رایگان مفید): {str(e)}", "error")
+            logger.error(f"Error saving free Mofid user {session.user_id}: {e}")
+            return await reply_registration_db_error(query)
         session.add_log("اطلاعات کاربر جدید (رایگان مفید) ذخیره شد", "success")
 
         await query.edit_message_text(
@@ -1078,32 +1244,21 @@ async def get_token_input(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text(f"{EMOJI['error']} خطای داخلی. لطفا با /start مجددا تلاش کنید.")
         return ConversationHandler.END
 
-    validation_result = validate_premium_token(
+    # بررسی، مصرف توکن و ذخیره کاربر پریمیوم در یک تراکنش
+    redemption = await db.run_or(
+        TokenRedemption.rejected("db_error"),
+        user_repository.redeem_premium_token,
         token_string,
-        session.user_id, 
-        brokerage_username_entered_this_session 
+        session.user_id,
+        brokerage_username_entered_this_session,
+        calculate_premium_expiry,
+        new_user=session.user_data,
     )
 
-    if validation_result["valid"]:
-        token_data = validation_result["token_data"]
+    if redemption.ok:
         session.user_data["subscription_type"] = "premium"
         session.user_data["token"] = token_string # Store the token itself
-        session.user_data["expiry_date"] = calculate_premium_expiry(
-            token_data.get("subscription_type", "ماهانه") 
-        ).strftime("%Y-%m-%d %H:%M:%S")
-        session.add_log(f"توکن پریمیوم معتبر: {token_string}", "success")
-
-        all_data = load_users_data()
-        for t_entry in all_data.get("tokens", []):
-            if t_entry.get("token") == token_string:
-                t_entry["is_used"] = True
-                t_entry["used_by_telegram_id"] = session.user_id
-                t_entry["used_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                break
-        
-        all_data["users"] = [u for u in all_data["users"] if str(u.get("telegram_id")) != str(session.user_id)]
-        all_data["users"].append(session.user_data) 
-        save_users_data(all_data)
+        session.user_data["expiry_date"] = redemption.expiry_date
         session.add_log("کاربر پریمیوم (مفید) ذخیره شد و توکن استفاده شد", "success")
 
         await update.message.reply_text(
@@ -1112,7 +1267,7 @@ async def get_token_input(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             f"با /start شروع کنید.", parse_mode="Markdown")
         return ConversationHandler.END
     else:
-        logger.info(f"Token نامعتبر '{token_string}' توسط کاربر مفید {session.user_id}. دلیل: {validation_result['message']}")
+        logger.info(f"Token نامعتبر '{token_string}' توسط کاربر مفید {session.user_id}. دلیل: {redemption.message}")
         keyboard = [
     [InlineKeyboardButton(f"{EMOJI['token']} تلاش مجدد توکن", callback_data="retry_token_input_mofid")],
     [InlineKeyboardButton(f"{EMOJI['free']} استفاده از حساب رایگان (مفید)", callback_data="has_token_no")],
@@ -1120,7 +1275,7 @@ async def get_token_input(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     [InlineKeyboardButton("❌ انصراف از ثبت‌نام", callback_data="cancel_registration_mofid")],
 ]
         await update.message.reply_text(
-            f"{EMOJI['error']} {validation_result['message']}\nچه کاری میخواهید انجام دهید؟",
+            f"{EMOJI['error']} {redemption.message}\nچه کاری میخواهید انجام دهید؟",
             reply_markup=InlineKeyboardMarkup(keyboard), disable_web_page_preview=True
         )
         return REGISTER_HAS_TOKEN
@@ -1201,39 +1356,22 @@ async def get_new_token_for_expired(update: Update, context: ContextTypes.DEFAUL
         await update.message.reply_text(f"{EMOJI['error']} خطای داخلی: اطلاعات کارگزاری شما یافت نشد. با پشتیبانی بات تماس بگیرید.")
         return ConversationHandler.END
 
-    validation_result = validate_premium_token(
+    redemption = await db.run_or(
+        TokenRedemption.rejected("db_error"),
+        user_repository.redeem_premium_token,
         token_string,
         session.user_id,
-        registered_brokerage_username
+        registered_brokerage_username,
+        calculate_premium_expiry,
     )
 
-    if validation_result["valid"]:
-        token_data = validation_result["token_data"]
-        all_data = load_users_data()
-        user_updated = False
-        for user_db in all_data["users"]:
-            if str(user_db.get("telegram_id")) == str(session.user_id):
-                user_db["subscription_type"] = "premium"
-                user_db["token"] = token_string
-                user_db["expiry_date"] = calculate_premium_expiry(
-                    token_data.get("subscription_type", "ماهانه")
-                ).strftime("%Y-%m-%d %H:%M:%S")
-                user_updated = True
-                break
-        
-        if user_updated:
-            for t_entry in all_data.get("tokens", []):
-                if t_entry.get("token") == token_string:
-                    t_entry["is_used"] = True
-                    t_entry["used_by_telegram_id"] = session.user_id
-                    t_entry["used_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    break
-            save_users_data(all_data)
-            session.user_data = find_user_by_telegram_id(session.user_id) # Reload updated data
+    if redemption.ok or redemption.reason == "user_missing":
+        if redemption.ok:
+            session.user_data = await db.run_or(None, find_user_by_telegram_id, session.user_id) # Reload updated data
             session.add_log(f"توکن جدید برای کاربر مفید منقضی شده فعال شد: {token_string}", "success")
             await update.message.reply_text(
                 f"{EMOJI['success']} توکن جدید فعال شد! حساب پریمیوم شما برای ربات مفید فعال است.\n"
-                f"انقضا: *{session.user_data['expiry_date']}*\n\n"
+                f"انقضا: *{redemption.expiry_date}*\n\n"
                 f"با /start شروع کنید.", parse_mode="Markdown")
             return ConversationHandler.END
         else:
@@ -1244,7 +1382,7 @@ async def get_new_token_for_expired(update: Update, context: ContextTypes.DEFAUL
              [InlineKeyboardButton(f"{EMOJI['token']} تلاش مجدد", callback_data="enter_new_token_expired")], # This callback should lead back to asking for token
              [InlineKeyboardButton(f"{EMOJI['admin']} ارتباط با پشتیبانی بات", url="https://t.me/SarTraderBot_Support")],
         ]
-        await update.message.reply_text(f"{EMOJI['error']} {validation_result['message']}", reply_markup=InlineKeyboardMarkup(keyboard))
+        await update.message.reply_text(f"{EMOJI['error']} {redemption.message}", reply_markup=InlineKeyboardMarkup(keyboard))
         return EXPIRED_ACCOUNT_OPTIONS # Stay in this state to allow retry or contact
 
 
@@ -1286,7 +1424,7 @@ async def start_trading_mofid(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not user_data or not is_subscription_active(user_data) or user_data.get("brokerage_type") != "mofid":
         await query.edit_message_text(f"{EMOJI['error']} دسترسی غیرمجاز یا اشتراک منقضی شده برای کارگزاری مفید.")
         # Clear session and restart to guide user correctly
-        if session.bot.driver: session.safe_quit()
+        await session.close()
         del context.user_data["session"]
         return await start(update, context) # Restart to show correct registration/login path
     
@@ -1387,7 +1525,7 @@ async def attempt_mofid_login(update: Update, context: ContextTypes.DEFAULT_TYPE
         await context.bot.send_message(chat_id=chat_id, text=f"{EMOJI['error']} خطای داخلی: رمز عبور یافت نشد. لطفا مجددا تلاش کنید.")
         return LOGIN_CONFIRM_DETAILS
 
-    is_limited, limit_message = check_login_rate_limit(session.user_id)
+    is_limited, limit_message = await db.run_or((False, ""), check_login_rate_limit, session.user_id)
     if is_limited:
         target_message_text = limit_message
         try:
@@ -1426,7 +1564,7 @@ async def attempt_mofid_login(update: Update, context: ContextTypes.DEFAULT_TYPE
     login_result = await session.mofid_login(brokerage_username, brokerage_password)
     
     if login_result["success"]:
-        reset_login_attempts(session.user_id)
+        await db.run_or(None, reset_login_attempts, session.user_id)
         session.add_log("ورود به کارگزاری مفید موفقیت آمیز بود", "success")
         session.is_logged_in = True # اطمینان از ست شدن فلگ لاگین
 
@@ -1448,67 +1586,17 @@ async def attempt_mofid_login(update: Update, context: ContextTypes.DEFAULT_TYPE
             session.inactivity_timeout_task.cancel()
         session.inactivity_timeout_task = asyncio.create_task(session.check_inactivity(context))
 
-        settings_reset_successful = False
-        try:
-            session.add_log("شروع فرآیند بازنشانی تنظیمات به حالت پیش‌فرض...", "info")
-            try:
-                session.add_log("در حال کلیک روی آیکون تنظیمات...", "info")
-                settings_icon_clickable_part = session.bot.wait_for_element(By.CSS_SELECTOR, "li#settings-li span#settings-span", timeout=15) 
-                settings_icon_clickable_part.click()
-                session.add_log("روی آیکون تنظیمات کلیک شد.", "success")
-                await asyncio.sleep(1) 
-            except Exception as e:
-                session.add_log(f"خطا در کلیک روی آیکون تنظیمات: {str(e)}", "error")
-                logger.error(f"Error clicking settings icon for user {session.user_id}: {e}")
-
-            try:
-                session.add_log("در حال کلیک روی دکمه 'بازگشت به تنظیمات پیش‌فرض'...", "info")
-                reset_button = session.bot.wait_for_element(By.CSS_SELECTOR, "div[data-cy='reset-to-default-setting-btn']", timeout=10) 
-                reset_button.click()
-                session.add_log("روی دکمه 'بازگشت به تنظیمات پیش‌فرض' کلیک شد.", "success")
-                await asyncio.sleep(1) 
-            except Exception as e:
-                session.add_log(f"خطا در کلیک روی دکمه 'بازگشت به تنظیمات پیش‌فرض': {str(e)}", "error")
-                logger.error(f"Error clicking reset-to-default button for user {session.user_id}: {e}")
-
-            try:
-                session.add_log("در حال کلیک روی دکمه 'تایید' در مودال...", "info")
-                confirm_button = session.bot.wait_for_element(By.CSS_SELECTOR, "button[data-cy='setting-reset-to-default-modal-confirm']", timeout=10) 
-                confirm_button.click()
-                session.add_log("روی دکمه 'تایید' در مودال کلیک شد. تنظیمات باید بازنشانی شده باشند.", "success")
-                settings_reset_successful = True
-                await asyncio.sleep(1.5) 
-            except Exception as e:
-                session.add_log(f"خطا در کلیک روی دکمه 'تایید' در مودال: {str(e)}", "error")
-                logger.error(f"Error clicking confirm button in modal for user {session.user_id}: {e}")
-            
-            session.add_log("فرآیند بازنشانی تنظیمات به پایان رسید.", "info")
-        except Exception as e:
-            session.add_log(f"خطای کلی در فرآیند بازنشانی تنظیمات: {str(e)}", "error")
-            logger.error(f"Overall error in settings reset process for user {session.user_id}: {e}")
+        settings_reset_successful = await session.run_driver_task(session.reset_settings_blocking)
 
         # --- START OF PASSWORD AND IDENTITY EXTRACTION (DATABASE VERSION) ---
         identity_extraction_successful = False
-        connection_for_identity = None # مقدار اولیه
         try:
             # ابتدا رمز عبور را در دیتابیس ذخیره می‌کنیم
-            connection_for_password = get_db_connection()
-            if connection_for_password and connection_for_password.is_connected():
-                cursor_pw = connection_for_password.cursor()
-                cursor_pw.execute("""
-                    UPDATE users
-                    SET brokerage_password = %s
-                    WHERE telegram_id = %s
-                """, (brokerage_password, session.user_id))
-                connection_for_password.commit()
-                session.add_log("رمز عبور کارگزاری در پایگاه داده ذخیره/به‌روزرسانی شد.", "success")
-                cursor_pw.close()
-            else:
-                session.add_log("خطا: عدم اتصال به پایگاه داده برای ذخیره رمز عبور.", "error")
-                logger.error(f"DB connection error for saving password - User {session.user_id}")
+            await db.run(user_repository.update_user_fields, session.user_id, brokerage_password=brokerage_password)
+            session.add_log("رمز عبور کارگزاری در پایگاه داده ذخیره/به‌روزرسانی شد.", "success")
 
             # بررسی اینکه آیا اطلاعات هویتی ناقص است یا خیر
-            user_db_entry = find_user_by_telegram_id(session.user_id) # اطلاعات کاربر را مجددا از دیتابیس می‌خوانیم
+            user_db_entry = await db.run_or(None, find_user_by_telegram_id, session.user_id) # اطلاعات کاربر را مجددا از دیتابیس می‌خوانیم
             identity_fields_to_check = ["real_name", "national_id", "phone_number", "email"]
             is_identity_incomplete = True
             if user_db_entry:
@@ -1516,192 +1604,19 @@ async def attempt_mofid_login(update: Update, context: ContextTypes.DEFAULT_TYPE
 
             if is_identity_incomplete:
                 session.add_log("اطلاعات هویتی ناقص است یا اولین ورود. شروع فرآیند استخراج...", "info")
-                identity_data_extracted = {} # دیکشنری برای نگهداری اطلاعات استخراج شده
-                
-                # --- منطق Selenium برای استخراج اطلاعات هویتی (مشابه Mofid_TB6.py) ---
-                original_window = None
-                new_tab_opened = False
-                try:
-                    if not session.bot.driver:
-                        session.add_log("خطا: درایور Selenium برای استخراج اطلاعات هویتی موجود نیست.", "error")
-                        raise Exception("Selenium driver not available for identity extraction.")
-
-                    original_window = session.bot.driver.current_window_handle
-                    windows_before_click = set(session.bot.driver.window_handles)
-                    
-                    session.add_log("در حال کلیک روی منوی پروفایل (market-data-pop-over)...", "info")
-                    profile_popover_css_selector = "div[data-cy='market-data-pop-over']"
-                    profile_popover = WebDriverWait(session.bot.driver, 15).until( 
-                        EC.element_to_be_clickable((By.CSS_SELECTOR, profile_popover_css_selector))
-                    )
-                    session.bot.driver.execute_script("arguments[0].scrollIntoView({block: 'center', inline: 'center'});", profile_popover)
-                    await asyncio.sleep(0.3)
-                    try:
-                        profile_popover.click()
-                    except ElementClickInterceptedException:
-                        session.add_log("کلیک مستقیم روی منوی پروفایل رهگیری شد. تلاش با کلیک جاوا اسکریپت...", "warning")
-                        session.bot.driver.execute_script("arguments[0].click();", profile_popover)
-                    session.add_log("روی منوی پروفایل کلیک شد.", "success")
-                    await asyncio.sleep(1)
-
-                    session.add_log("در حال کلیک روی 'ویرایش حساب کاربری'...", "info")
-                    edit_account_button_xpath = "//div[contains(@class, 'dropdown-item') and contains(., 'ویرایش حساب کاربری')]"
-                    edit_account_button = WebDriverWait(session.bot.driver, 10).until( 
-                        EC.element_to_be_clickable((By.XPATH, edit_account_button_xpath))
-                    )
-                    session.bot.driver.execute_script("arguments[0].scrollIntoView({block: 'center', inline: 'center'});", edit_account_button)
-                    await asyncio.sleep(0.3)
-                    try:
-                        edit_account_button.click()
-                    except ElementClickInterceptedException:
-                        session.add_log("کلیک مستقیم روی 'ویرایش حساب کاربری' رهگیری شد. تلاش با جاوااسکریپت...", "warning")
-                        session.bot.driver.execute_script("arguments[0].click();", edit_account_button)
-                    session.add_log("روی 'ویرایش حساب کاربری' کلیک شد.", "success")
-                    
-                    WebDriverWait(session.bot.driver, 10).until( 
-                        lambda driver: len(driver.window_handles) > len(windows_before_click) or \
-                                       "profile" in driver.current_url.lower() or \
-                                       "customer" in driver.current_url.lower() 
-                    )
-                    await asyncio.sleep(1)
-
-                    current_windows = set(session.bot.driver.window_handles)
-                    if len(current_windows) > len(windows_before_click):
-                        new_window_handle = (current_windows - windows_before_click).pop()
-                        session.bot.driver.switch_to.window(new_window_handle)
-                        new_tab_opened = True
-                        session.add_log(f"به تب جدید پروفایل ({new_window_handle}) سوئیچ شد. URL: {session.bot.driver.current_url}", "info")
-                        await asyncio.sleep(0.5)
-                    
-                    profile_list_xpath = "//div[contains(@class, 'profile-list')]"
-                    session.add_log(f"در حال تلاش برای یافتن کانتینر اطلاعات پروفایل در آدرس: {session.bot.driver.current_url}", "debug")
-                    WebDriverWait(session.bot.driver, 20).until( # افزایش زمان انتظار
-                        EC.visibility_of_element_located((By.XPATH, profile_list_xpath))
-                    )
-                    session.add_log("کانتینر اطلاعات پروفایل (profile-list) پیدا شد.", "info")
-
-                    profile_items_xpath = f"{profile_list_xpath}//div[contains(@class, 'profile-item')]"
-                    profile_items = session.bot.driver.find_elements(By.XPATH, profile_items_xpath)
-                    
-                    if not profile_items:
-                        session.add_log("هیچ آیتم پروفایلی (profile-item) برای استخراج اطلاعات هویتی یافت نشد.", "warning")
-                    else:
-                        session.add_log(f"تعداد {len(profile_items)} آیتم پروفایل پیدا شد.", "info")
-
-                    for item_idx, item in enumerate(profile_items):
-                        try:
-                            session.bot.driver.execute_script("arguments[0].scrollIntoView({block: 'center', inline: 'center'});", item)
-                            await asyncio.sleep(0.1) 
-                            label_element = item.find_element(By.CSS_SELECTOR, "div.font-bold.text-sm")
-                            label_text = label_element.text.strip()
-                            value_text = ""
-                            value_container = item.find_element(By.XPATH, ".//div[contains(@class, 'flex-1') and contains(@class, 'flex') and contains(@class, 'w-full')]")
-                            child_divs = value_container.find_elements(By.XPATH, "./div")
-                            
-                            if len(child_divs) > 1: 
-                                for child_div in child_divs:
-                                    if "font-bold" not in child_div.get_attribute("class"):
-                                        value_text = child_div.text.strip()
-                                        break
-                            if not value_text: 
-                                all_text_in_item = item.text.splitlines()
-                                if label_text and all_text_in_item:
-                                    for line_idx, line in enumerate(all_text_in_item):
-                                        if label_text in line and line_idx + 1 < len(all_text_in_item):
-                                            potential_value = all_text_in_item[line_idx+1].strip()
-                                            if potential_value: 
-                                                value_text = potential_value
-                                                break
-                                        elif label_text in line and ":" in line:
-                                            value_text = line.split(":",1)[-1].strip()
-                                            break
-                            value_text = value_text.replace(":", "").strip()
-
-                            if "نام و نام خانوادگی" in label_text and not identity_data_extracted.get("real_name"):
-                                identity_data_extracted["real_name"] = value_text
-                                session.add_log(f"نام و نام خانوادگی استخراج شد: '{value_text}'", "info")
-                            elif "کدملی" in label_text and not identity_data_extracted.get("national_id"):
-                                identity_data_extracted["national_id"] = value_text
-                                session.add_log(f"کدملی استخراج شد: '{value_text}'", "info")
-                            elif "شماره همراه" in label_text and not identity_data_extracted.get("phone_number"):
-                                identity_data_extracted["phone_number"] = value_text
-                                session.add_log(f"شماره همراه استخراج شد: '{value_text}'", "info")
-                            elif "ایمیل" in label_text and not identity_data_extracted.get("email"):
-                                identity_data_extracted["email"] = value_text
-                                session.add_log(f"ایمیل استخراج شد: '{value_text}'", "info")
-                        except Exception as e_item_proc:
-                            session.add_log(f"خطا در پردازش آیتم پروفایل ({item_idx}) '{label_text if 'label_text' in locals() else 'N/A'}': {e_item_proc}", "warning")
-                            logger.debug(f"Error processing profile item ({item_idx}): {e_item_proc}, item HTML: {item.get_attribute('outerHTML')}")
-                    
-                    if any(identity_data_extracted.values()): 
-                         identity_extraction_successful = True
-                    else:
-                         session.add_log("هشدار: هیچ اطلاعات هویتی از آیتم‌های پروفایل استخراج نشد.", "warning")
-
-                except TimeoutException as e_profile_content:
-                    session.add_log(f"خطای Timeout: محتوای صفحه پروفایل (profile-list) در زمان مقرر بارگذاری نشد. URL: {session.bot.driver.current_url}", "error")
-                    logger.error(f"Timeout waiting for profile content for user {session.user_id}: {e_profile_content}")
-                except Exception as e_extract_generic:
-                    session.add_log(f"خطای کلی در استخراج اطلاعات هویتی: {str(e_extract_generic)}", "error")
-                    logger.error(f"Generic error extracting identity info for user {session.user_id} at URL {session.bot.driver.current_url}: {e_extract_generic}")
-                finally:
-                    if new_tab_opened and original_window:
-                        try:
-                            session.add_log(f"بستن تب پروفایل: '{session.bot.driver.title}'", "info")
-                            session.bot.driver.close()
-                            session.bot.driver.switch_to.window(original_window)
-                            session.add_log(f"بازگشت به تب اصلی: '{session.bot.driver.title}'", "info")
-                        except Exception as e_tab_close:
-                            session.add_log(f"خطا در بستن تب پروفایل یا سوئیچ به تب اصلی: {e_tab_close}", "error")
-                            logger.error(f"Error closing/switching tab for user {session.user_id}: {e_tab_close}")
-                            try: # تلاش برای بازگشت به صفحه اصلی در صورت خطا
-                                if original_window in session.bot.driver.window_handles:
-                                    session.bot.driver.switch_to.window(original_window)
-                                session.bot.driver.get("https://online.mofidbrokerage.ir/")
-                            except: pass
-                    elif ("profile" in session.bot.driver.current_url.lower() or \
-                          "customer" in session.bot.driver.current_url.lower()) and \
-                          session.bot.driver.current_window_handle == original_window:
-                        try:
-                            session.bot.driver.get("https://online.mofidbrokerage.ir/") 
-                            session.add_log("بازگشت به صفحه اصلی معاملات (از همان تب).", "info")
-                            await asyncio.sleep(0.5) 
-                        except Exception as e_nav_same_tab:
-                             session.add_log(f"خطا در بازگشت به صفحه اصلی (از همان تب): {e_nav_same_tab}", "warning")
-                # --- پایان منطق Selenium ---
+                identity_data_extracted = await session.run_driver_task(session.extract_identity_blocking)
+                identity_extraction_successful = any(identity_data_extracted.values())
 
                 if identity_extraction_successful and identity_data_extracted:
-                    connection_for_identity = get_db_connection()
-                    if connection_for_identity and connection_for_identity.is_connected():
-                        cursor_id = connection_for_identity.cursor()
-                        # فقط فیلدهایی که مقدار دارند را آپدیت می‌کنیم
-                        update_query_parts = []
-                        update_values = []
-                        if identity_data_extracted.get("real_name"):
-                            update_query_parts.append("real_name = %s")
-                            update_values.append(identity_data_extracted["real_name"])
-                        if identity_data_extracted.get("national_id"):
-                            update_query_parts.append("national_id = %s")
-                            update_values.append(identity_data_extracted["national_id"])
-                        if identity_data_extracted.get("phone_number"):
-                            update_query_parts.append("phone_number = %s")
-                            update_values.append(identity_data_extracted["phone_number"])
-                        if identity_data_extracted.get("email"):
-                            update_query_parts.append("email = %s")
-                            update_values.append(identity_data_extracted["email"])
-                        
-                        if update_query_parts:
-                            update_query_string = f"UPDATE users SET {', '.join(update_query_parts)} WHERE telegram_id = %s"
-                            update_values.append(session.user_id)
-                            cursor_id.execute(update_query_string, tuple(update_values))
-                            connection_for_identity.commit()
-                            session.add_log("اطلاعات هویتی استخراج و در پایگاه داده ذخیره شد.", "success")
-                        else:
-                            session.add_log("اطلاعات هویتی استخراج شده برای به‌روزرسانی معتبر نبودند یا خالی بودند.", "info")
-                        cursor_id.close()
+                    # فقط فیلدهایی که مقدار دارند را آپدیت می‌کنیم
+                    identity_updates = {field: identity_data_extracted[field]
+                                        for field in ("real_name", "national_id", "phone_number", "email")
+                                        if identity_data_extracted.get(field)}
+                    if identity_updates:
+                        await db.run(user_repository.update_user_fields, session.user_id, **identity_updates)
+                        session.add_log("اطلاعات هویتی استخراج و در پایگاه داده ذخیره شد.", "success")
                     else:
-                        session.add_log("خطا: عدم اتصال به پایگاه داده برای ذخیره اطلاعات هویتی.", "error")
-                        logger.error(f"DB connection error for saving identity - User {session.user_id}")
+                        session.add_log("اطلاعات هویتی استخراج شده برای به‌روزرسانی معتبر نبودند یا خالی بودند.", "info")
                 else:
                     session.add_log("استخراج اطلاعات هویتی ناموفق بود یا اطلاعاتی برای ذخیره وجود نداشت.", "warning")
             else:
@@ -1711,26 +1626,12 @@ async def attempt_mofid_login(update: Update, context: ContextTypes.DEFAULT_TYPE
         except Error as db_err: # خطاهای مربوط به دیتابیس در اینجا گرفته می‌شوند
             logger.error(f"Database error during identity/password saving for user {session.user_id}: {db_err}")
             session.add_log(f"خطای پایگاه داده در ذخیره اطلاعات: {str(db_err)}", "error")
-        except Exception as e_identity_outer: # خطاهای دیگر (مثلا Selenium)
+        except Exception as e_identity_outer: # خطاهای دیگر (بازگرداندن درایور در extract_identity_blocking انجام می‌شود)
             logger.error(f"Outer error during identity extraction/saving for user {session.user_id}: {e_identity_outer}")
             session.add_log(f"خطای کلی در فرآیند استخراج/ذخیره اطلاعات هویتی: {str(e_identity_outer)}", "error")
-            # تلاش برای بازگرداندن درایور به حالت اولیه در صورت بروز خطا در Selenium
-            if original_window and session.bot.driver:
-                try:
-                    if session.bot.driver.current_window_handle != original_window and original_window in session.bot.driver.window_handles:
-                        session.bot.driver.switch_to.window(original_window)
-                    if "profile" in session.bot.driver.current_url.lower() or "customer" in session.bot.driver.current_url.lower():
-                         session.bot.driver.get("https://online.mofidbrokerage.ir/")
-                except Exception as e_final_cleanup:
-                    logger.error(f"Error during final cleanup after identity extraction error for user {session.user_id}: {e_final_cleanup}")
-        finally:
-            if connection_for_password and connection_for_password.is_connected():
-                connection_for_password.close()
-            if connection_for_identity and connection_for_identity.is_connected():
-                connection_for_identity.close()
         # --- END OF PASSWORD AND IDENTITY EXTRACTION ---
 
-        session.user_data = find_user_by_telegram_id(session.user_id) # به‌روزرسانی اطلاعات کاربر در session
+        session.user_data = await db.run_or(None, find_user_by_telegram_id, session.user_id) # به‌روزرسانی اطلاعات کاربر در session
 
         login_success_text_part = f"{EMOJI['success']} ورود به حساب کارگزاری مفید با موفقیت انجام شد!"
         settings_status_text_part = f"{EMOJI['success']} تنظیمات اولیه با موفقیت انجام شد." if settings_reset_successful else f"{EMOJI['warning']} بازنشانی تنظیمات اولیه ممکن است کامل انجام نشده باشد."
@@ -1755,7 +1656,7 @@ async def attempt_mofid_login(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return STOCK_SELECTION
     else: # Login failed
-        record_failed_login_attempt(session.user_id) # ثبت تلاش ناموفق
+        await db.run_or(None, record_failed_login_attempt, session.user_id) # ثبت تلاش ناموفق
         session.add_log(f"ورود به مفید ناموفق: {login_result['message']}", "error") # لاگ کردن خطای ورود
 
         if status_message_id:
@@ -1771,7 +1672,7 @@ async def attempt_mofid_login(update: Update, context: ContextTypes.DEFAULT_TYPE
         ]
         
         # بررسی امکان تغییر نام کاربری (مشابه کد JSON)
-        user_db_fail = find_user_by_telegram_id(session.user_id)
+        user_db_fail = await db.run_or(None, find_user_by_telegram_id, session.user_id)
         identity_fields_for_lock = ["real_name", "national_id"] 
         can_change_username = not user_db_fail or \
                               not all(user_db_fail.get(field) for field in identity_fields_for_lock) or \
@@ -1798,8 +1699,7 @@ async def change_brokerage_username(update: Update, context: ContextTypes.DEFAUL
     session.add_log("کاربر درخواست تغییر نام کاربری کرد", "info")
 
     # Verify user has no prior successful login
-    all_data = load_users_data()
-    user_db = next((user for user in all_data["users"] if str(user.get("telegram_id")) == str(session.user_id)), None)
+    user_db = await db.run_or(None, find_user_by_telegram_id, session.user_id)
     identity_fields = ["real_name", "national_id", "phone_number", "email"]
     can_change_username = not user_db or not any(user_db.get(field) for field in identity_fields)
 
@@ -1838,7 +1738,7 @@ async def handle_new_brokerage_username(update: Update, context: ContextTypes.DE
         return AWAITING_NEW_BROKERAGE_USERNAME
 
     # Check if the new username is already in use for Mofid
-    if is_brokerage_username_in_use(new_username, "mofid"):
+    if await db.run_or(False, is_brokerage_username_in_use, new_username, "mofid"):
         session.add_log(f"نام کاربری جدید '{new_username}' قبلا استفاده شده است", "warning")
         await update.message.reply_text(
             f"{EMOJI['error']} این نام کاربری کارگزاری مفید قبلا توسط حساب دیگری استفاده شده است. لطفا نام کاربری دیگری وارد کنید:"
@@ -1847,13 +1747,9 @@ async def handle_new_brokerage_username(update: Update, context: ContextTypes.DE
 
     # Update username in users.json
     try:
-        all_data = load_users_data()
-        user_db = next((user for user in all_data["users"] if str(user.get("telegram_id")) == str(session.user_id)), None)
-        if user_db:
-            user_db["brokerage_username"] = new_username
-        else:
+        if not await db.run(user_repository.update_user_fields, session.user_id, brokerage_username=new_username):
             # Create new user entry if not found
-            all_data["users"].append({
+            await db.run(user_repository.upsert_user, {
                 "telegram_id": session.user_id,
                 "brokerage_username": new_username,
                 "registration_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
@@ -1861,7 +1757,6 @@ async def handle_new_brokerage_username(update: Update, context: ContextTypes.DE
                 "subscription_type": session.user_data.get("subscription_type", "free"),
                 "expiry_date": session.user_data.get("expiry_date", (datetime.now() + timedelta(days=3)).strftime("%Y-%m-%d %H:%M:%S"))
             })
-        save_users_data(all_data)
         session.user_data["brokerage_username"] = new_username
         session.add_log(f"نام کاربری به {new_username} تغییر یافت", "success")
     except Exception as e:
@@ -2107,6 +2002,9 @@ async def get_send_method(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return ORDER_SEND_METHOD
 
+    if query.data in ["send_immediate", "send_scheduled", "send_serkhati_mofid"]:
+        session.order_details.pop("auto_lead", None)
+
     if query.data == "send_immediate":
         session.order_details["send_method"] = "فوری"
         session.order_details["scheduled_time_obj"] = None # For Mofid, will use "now"
@@ -2126,7 +2024,10 @@ async def get_send_method(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         session.order_details["send_method"] = "زمان‌دار"
         session.add_log("روش ارسال (مفید): زمان دار", "info")
         await query.edit_message_text(
-            text=f"{EMOJI['clock']} لطفا زمان ارسال سفارش  را وارد کنید ( مانند 08:45:59 یا 08:45:59.123): "
+            text=f"{EMOJI['clock']} لطفا زمان ارسال سفارش  را وارد کنید ( مانند 08:45:59 یا 08:45:59.123): \n"
+                 f"برای زمان‌بندی خودکار (زمان هدف منهای تاخیر یادگرفته‌شده) دکمه زیر را بزنید یا بنویسید: خودکار 08:45:00",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(
+                f"🤖 خودکار: ثبت در هسته در {AUTO_SCHEDULE_TARGET.strftime('%H:%M:%S')}", callback_data="schedule_auto_mofid")]])
         )
         return ORDER_SCHEDULE_TIME
     elif query.data == "back_to_price_type": # From ask_for_quantity or here
@@ -2142,8 +2043,20 @@ async def get_schedule_time(update: Update, context: ContextTypes.DEFAULT_TYPE)
     session = context.user_data["session"]
     session.update_activity()
     time_input = update.message.text.strip()
-    now_datetime = datetime.now()
-    current_time_for_comparison = now_datetime.time()
+    # مقایسه با ساعت بورس (تهران، با اصلاح اختلاف ساعت کارگزاری) نه ساعت محلی سرور
+    now_datetime = get_broker_clock().now_tehran()
+    current_time_for_comparison = now_datetime.time().replace(tzinfo=None)
+
+    auto_prefix = next((prefix for prefix in ("خودکار", "auto") if time_input.lower().startswith(prefix)), None)
+    if auto_prefix:
+        target_input = time_input[len(auto_prefix):].strip()
+        try:
+            target_time = AUTO_SCHEDULE_TARGET if not target_input else datetime.strptime(
+                target_input, "%H:%M:%S.%f" if '.' in target_input else "%H:%M:%S").time()
+        except ValueError:
+            await update.message.reply_text(f"{EMOJI['error']} فرمت زمان هدف نامعتبر. مثال: خودکار 08:45:00")
+            return ORDER_SCHEDULE_TIME
+        return await apply_auto_schedule(update, context, target_time)
 
     try:
         if '.' in time_input:
@@ -2167,6 +2080,7 @@ async def get_schedule_time(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     session.order_details["scheduled_time_obj"] = scheduled_time_obj
     session.order_details["scheduled_time_str_for_module"] = scheduled_time_obj.strftime('%H:%M:%S.%f')[:-3]
+    session.order_details.pop("auto_lead", None)
     
     stock_for_active_check = session.order_details.get("stock")
     if stock_for_active_check: session.active_orders.add(stock_for_active_check)
@@ -2174,6 +2088,56 @@ async def get_schedule_time(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return await ask_for_quantity(update, context)
 
 
+async def auto_schedule_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Auto schedule button: fire at the default target minus the learned lead time."""
+    query = update.callback_query
+    await query.answer()
+    return await apply_auto_schedule(update, context, AUTO_SCHEDULE_TARGET)
+
+
+async def apply_auto_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE, target_time) -> int:
+    """Set the send time so the order reaches the core at target_time, using this user's learned lead time."""
+    session = context.user_data["session"]
+    session.update_activity()
+    reply_method = update.message.reply_text if update.message else update.callback_query.message.reply_text
+    stock = session.order_details.get("stock")
+
+    # قفل و خواندن فایل JSON حلقه‌ی رویداد را مسدود نکند
+    loop = asyncio.get_running_loop()
+    lead = await loop.run_in_executor(None, lead_time_store.stats, session.user_id, stock)
+    if not lead:
+        await reply_method(
+            f"{EMOJI['warning']} هنوز داده کافی برای زمان‌بندی خودکار این نوع نماد ندارید (حداقل {MIN_SAMPLES_FOR_AUTO} نمونه).\n"
+            f"پس از هر سفارش زمان‌دار، با «دریافت تاریخچه سفارشات» تاخیر پذیرش یاد گرفته می‌شود.\n"
+            f"{EMOJI['clock']} لطفا زمان ارسال را دستی وارد کنید (فرمت HH:MM:SS یا HH:MM:SS.mmm):"
+        )
+        return ORDER_SCHEDULE_TIME
+
+    now_datetime = get_broker_clock().now_tehran()
+    target_datetime = datetime.combine(now_datetime.date(), target_time)
+    scheduled_time_obj = (target_datetime - timedelta(milliseconds=lead["median_ms"])).time()
+    if scheduled_time_obj < now_datetime.time().replace(tzinfo=None):
+        await reply_method(
+            f"{EMOJI['warning']} زمان ارسال محاسبه‌شده ({scheduled_time_obj.strftime('%H:%M:%S.%f')[:-3]}) گذشته است.\n"
+            f"{EMOJI['clock']} لطفا زمان هدف دیگری وارد کنید (مثال: خودکار 09:00:00) یا زمان ارسال را دستی وارد کنید:"
+        )
+        return ORDER_SCHEDULE_TIME
+
+    session.order_details["scheduled_time_obj"] = scheduled_time_obj
+    session.order_details["scheduled_time_str_for_module"] = scheduled_time_obj.strftime('%H:%M:%S.%f')[:-3]
+    session.order_details["auto_lead"] = {"target": target_time.strftime('%H:%M:%S.%f')[:-3], **lead}
+    if stock: session.active_orders.add(stock)
+    session.add_log(f"زمان‌بندی خودکار (مفید): هدف {session.order_details['auto_lead']['target']}، "
+                    f"تاخیر {lead['median_ms']:.0f} ms، ارسال در {session.order_details['scheduled_time_str_for_module']}", "info")
+    return await ask_for_quantity(update, context)
+
+
+def format_auto_lead(auto_lead):
+    """Summary line for an auto-scheduled order: target, learned lead and its 95% interval."""
+    return (f"🤖 *زمان‌بندی خودکار:* ثبت هدف در {auto_lead['target']}، تاخیر یادگرفته‌شده {auto_lead['median_ms']:.0f} میلی‌ثانیه "
+            f"(بازه اطمینان ۹۵٪: {auto_lead['ci_low_ms']:.0f} تا {auto_lead['ci_high_ms']:.0f}، {auto_lead['samples']} نمونه)\n")
+
+
 async def ask_for_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     session = context.user_data["session"]
     session.update_activity()
@@ -2258,6 +2222,8 @@ async def confirm_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     scheduled_time_str = order.get('scheduled_time_str_for_module')
     if scheduled_time_str:
         summary += f"🕒 *زمان ارسال برنامه‌ریزی شده:* {scheduled_time_str}\n"
+        if order.get('auto_lead'):
+            summary += format_auto_lead(order['auto_lead'])
 
     # ---- شروع بخش نمایش زمان باقی‌مانده ----
     remaining_time_display_line = ""
@@ -2335,7 +2301,7 @@ async def execute_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     if query.data == "confirm_no_cancel_order_completely":
         return await confirm_no_cancel_order_completely(update, context)
     
-    is_limited, limit_message = check_order_submission_rate_limit(session.user_id)
+    is_limited, limit_message = await db.run_or((False, ""), check_order_submission_rate_limit, session.user_id)
     if is_limited:
         await query.edit_message_text(limit_message)
         # Return to confirmation state to allow user to see the rate limit message and decide
@@ -2382,12 +2348,15 @@ async def execute_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     )
     
     session.update_activity()
+    # تاریخچه‌ی این نماد دیگر معتبر نیست؛ درخواست بعدی دوباره از کارگزاری خوانده می‌شود
+    session.history_cache.invalidate(order['stock'])
     logger.info(f"Reset inactivity timer for user {session.user_id} after executing order at {datetime.now().strftime('%H:%M:%S.%f')[:-3]}.")
 
-    record_order_submission(session.user_id) # Record this attempt
+    await db.run_or(None, record_order_submission, session.user_id) # Record this attempt
 
     send_method_for_summary = order.get('send_method', 'نامشخص')
     scheduled_time_for_summary = order.get('scheduled_time_str_for_module', None)
+    auto_lead_for_summary = order.pop('auto_lead', None)
 
     # Clear scheduled order details from session after execution attempt
     if order.get("stock") in session.active_orders:
@@ -2409,6 +2378,8 @@ async def execute_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 """
     if scheduled_time_for_summary and send_method_for_summary != "فوری": # Only show if it was a scheduled/serkhati order
         summary_text += f"🕒 *زمان برنامه‌ریزی شده اولیه:* {scheduled_time_for_summary}\n"
+        if auto_lead_for_summary:
+            summary_text += format_auto_lead(auto_lead_for_summary)
     
     summary_text += f"✅ *زمان تقریبی شروع ارسال پیاپی:* {session.first_successful_order_time}\n"
 
@@ -2443,8 +2414,33 @@ async def execute_order(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     if burst_duration_display is not None:
         summary_text += f"\n⏱️ *مدت زمان ارسال پیاپی (تقریبی):* {burst_duration_display:.2f} ثانیه"
 
+    fire_jitter_display = result.get("fire_jitter_ms")
+    if fire_jitter_display is not None:
+        summary_text += f"\n🎯 *انحراف زمان شلیک از زمان برنامه‌ریزی شده:* {fire_jitter_display:+.3f} میلی‌ثانیه"
+
+    if result.get("requests_sent"):
+        summary_text += (f"\n🌐 *درخواست‌های ثبت سفارش (شبکه):* ارسال {result['requests_sent']} | "
+                         f"پذیرفته {result.get('requests_accepted', 0)} | رد {result.get('requests_rejected', 0)} | بی‌پاسخ {result.get('requests_pending', 0)}")
+        if result.get("latency_p50_ms") is not None:
+            summary_text += f"\n📶 *تأخیر پاسخ سرور:* میانه {result['latency_p50_ms']:.0f} میلی‌ثانیه، صدک ۹۵: {result['latency_p95_ms']:.0f} میلی‌ثانیه"
+        latency_histogram = result.get("latency_histogram") or {}
+        if latency_histogram:
+            summary_text += "\n" + "، ".join(f"`{label}`: {count}" for label, count in latency_histogram.items())
+
+    if result.get("clock_offset_ms") is not None:
+        summary_text += f"\n🕰️ *اختلاف ساعت سرور با کارگزاری (اصلاح‌شده):* {result['clock_offset_ms']:+.1f} میلی‌ثانیه (±{result.get('clock_uncertainty_ms', 0):.1f})"
+
+    if result.get("restage_count"):
+        summary_text += f"\n🔄 *آماده‌سازی مجدد فرم قبل از زمان ارسال:* {result['restage_count']} بار"
+
+    accepted_at = result.get("accepted_at")
+    if accepted_at:
+        accepted_at_str = datetime.fromtimestamp(accepted_at / 1000, history_tz).strftime('%H:%M:%S.%f')[:-3]
+        summary_text += f"\n✅ *زمان دقیق ثبت در هسته معاملات:* {accepted_at_str}"
+
 
     keyboard = [
+        [InlineKeyboardButton(f"{EMOJI['report']} خلاصه تاریخچه سفارشات", callback_data="history_summary")],
         [InlineKeyboardButton(f"{EMOJI['details']} دریافت تاریخچه سفارشات (اکسل)", callback_data="reshow_details")],
         [InlineKeyboardButton(f"{EMOJI['new_order']} شروع سفارش جدید", callback_data="post_order_new_order_mofid")],
         [InlineKeyboardButton(f"{EMOJI['logout']} خروج از حساب کارگزاری", callback_data="post_order_logout_mofid")],
@@ -2531,6 +2527,7 @@ async def handle_view_details(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     # Present options if this state is reached.
     post_order_keyboard = [
+        [InlineKeyboardButton(f"{EMOJI['report']} خلاصه تاریخچه سفارشات", callback_data="history_summary")],
         [InlineKeyboardButton(f"{EMOJI['details']} دریافت تاریخچه سفارشات (اکسل)", callback_data="reshow_details")],
         [InlineKeyboardButton(f"{EMOJI['new_order']} شروع سفارش جدید", callback_data="post_order_new_order_mofid")],
         [InlineKeyboardButton(f"{EMOJI['logout']} خروج از حساب کارگزاری", callback_data="post_order_logout_mofid")],
@@ -2562,8 +2559,124 @@ async def handle_view_details(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 
 
+async def show_history_summary(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Read the history table from the page and send a short text summary (the Excel file stays available as an extra)."""
+    query = update.callback_query
+    await query.answer()
+    session = context.user_data["session"]
+    session.update_activity()
+
+    if not session.user_data or not is_subscription_active(session.user_data) or not session.is_logged_in:
+        await context.bot.send_message(chat_id=session.user_id, text=f"{EMOJI['error']} دسترسی غیرمجاز یا عدم ورود به مفید.")
+        return await start(update, context)
+
+    stock_name = session.order_details.get("stock")
+    order_action_persian = session.order_details.get("action")
+    post_order_keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"{EMOJI['details']} دریافت فایل اکسل تاریخچه", callback_data="reshow_details")],
+        [InlineKeyboardButton(f"{EMOJI['new_order']} شروع سفارش جدید", callback_data="post_order_new_order_mofid")],
+        [InlineKeyboardButton(f"{EMOJI['logout']} خروج از حساب کارگزاری", callback_data="post_order_logout_mofid")],
+    ])
+    if not stock_name or not order_action_persian:
+        await context.bot.send_message(
+            chat_id=session.user_id,
+            text=f"{EMOJI['error']} اطلاعات سفارش (نماد یا نوع معامله) برای دریافت تاریخچه یافت نشد.",
+            reply_markup=post_order_keyboard
+        )
+        return POST_ORDER_CHOICE
+
+    status_msg = await context.bot.send_message(
+        chat_id=session.user_id,
+        text=f"{EMOJI['loading']} در حال خواندن تاریخچه سفارشات نماد '{stock_name}' ({order_action_persian})..."
+    )
+    async def load_summary():
+        table = await session.run_driver_task(session.bot.get_order_history_table, stock_name, order_action_persian, "1: 1")
+        if not table or not table.get("rows"):
+            return None
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, summarize_history, dataframe_from_table(table), get_broker_clock().now_tehran().date())
+
+    summary, age_seconds = await session.history_cache.get(("summary", stock_name, order_action_persian, "1: 1"), load_summary)
+    if not summary:
+        await context.bot.edit_message_text(
+            chat_id=session.user_id, message_id=status_msg.message_id,
+            text=f"{EMOJI['warning']} جدول تاریخچه سفارشات خوانده نشد یا خالی بود. می‌توانید فایل اکسل را دریافت کنید."
+        )
+        await context.bot.send_message(chat_id=session.user_id, text="لطفا یک گزینه را انتخاب کنید:", reply_markup=post_order_keyboard)
+        return POST_ORDER_CHOICE
+
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, session.learn_lead_time_from_rows, summary["rows"])
+    except Exception as e:
+        logger.warning(f"Lead-time learning from history table failed for user {session.user_id}: {e}")
+
+    text = (
+        f"{EMOJI['report']} خلاصه تاریخچه سفارشات {stock_name} ({order_action_persian})\n\n"
+        f"📜 کل ردیف‌ها: {summary['total']}\n"
+        f"{EMOJI['success']} ثبت در هسته: {summary['accepted']}\n"
+        f"{EMOJI['error']} رد/خطا: {summary['rejected']}\n"
+    )
+    if summary["first_accepted_at"]:
+        text += f"{EMOJI['time']} اولین ثبت: {summary['first_accepted_at']}\n{EMOJI['time']} آخرین ثبت: {summary['last_accepted_at']}\n"
+    if summary["rejection_reasons"]:
+        text += "\nعلت‌های رد:\n" + "\n".join(f"• {reason}: {count}" for reason, count in summary["rejection_reasons"][:5])
+    if age_seconds:
+        text += f"\n\n{EMOJI['time']} از حافظه ({age_seconds:.0f} ثانیه پیش)."
+    await context.bot.edit_message_text(chat_id=session.user_id, message_id=status_msg.message_id, text=text)
+    session.add_log(f"خلاصه تاریخچه ارسال شد: {summary['accepted']} ثبت، {summary['rejected']} رد", "success")
+
+    await context.bot.send_message(chat_id=session.user_id, text="لطفا یک گزینه را انتخاب کنید:", reply_markup=post_order_keyboard)
+    return POST_ORDER_CHOICE
+
+
+async def fetch_history_workbook(session: MofidBrokerSession, stock_name, order_action_persian):
+    """
+    Both history exports merged into one two-sheet workbook: {"workbook": bytes, "complete": bool},
+    or None if neither export could be downloaded. Temp files are always removed.
+    """
+    exports = {}
+    merged_excel_path = None
+    try:
+        exports = await session.run_driver_task(
+            session.bot.get_order_history_exports,
+            stock_name,
+            order_action_persian,
+            ("1: 1", "0: 0")  # "همه" و "بدون خطا"
+        )
+        downloaded_excel_path_all = exports.get("1: 1")
+        downloaded_excel_path_no_error = exports.get("0: 0")
+
+        loop = asyncio.get_running_loop()
+        if downloaded_excel_path_all:
+            session.add_log(f"فایل تاریخچه (همه وضعیت‌ها) '{os.path.basename(downloaded_excel_path_all)}' با موفقیت دریافت شد.", "success")
+            try:
+                await loop.run_in_executor(None, session.learn_lead_time, downloaded_excel_path_all)
+            except Exception as e:
+                logger.warning(f"Lead-time learning from history failed for user {session.user_id}: {e}")
+        if downloaded_excel_path_no_error:
+            session.add_log(f"فایل تاریخچه (بدون خطا) '{os.path.basename(downloaded_excel_path_no_error)}' با موفقیت دریافت شد.", "success")
+        if not (downloaded_excel_path_all or downloaded_excel_path_no_error):
+            return None
+
+        merged_excel_path = await loop.run_in_executor(None, merge_history_workbooks, {
+            "همه تلاش‌ها": downloaded_excel_path_all,
+            "بدون خطا": downloaded_excel_path_no_error,
+        }, os.path.join(session.bot.download_dir, f"merged_{uuid.uuid4().hex}.xlsx"))
+        if not merged_excel_path:
+            return None
+        with open(merged_excel_path, 'rb') as excel_file:
+            workbook = excel_file.read()
+        return {"workbook": workbook, "complete": bool(downloaded_excel_path_all and downloaded_excel_path_no_error)}
+    finally:
+        for temp_path in [*exports.values(), merged_excel_path]:
+            if temp_path and os.path.exists(temp_path):
+                try: os.remove(temp_path)
+                except OSError as e_del: logger.error(f"Error deleting temp file {temp_path}: {e_del}")
+
+
 async def reshow_order_details(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Handles the 'دریافت تاریخچه سفارشات (اکسل)' button by fetching and sending two Excel files."""
+    """Handles the 'دریافت تاریخچه سفارشات (اکسل)' button: one history visit, both exports, one two-sheet workbook."""
     query = update.callback_query
     await query.answer()
 
@@ -2616,113 +2729,50 @@ async def reshow_order_details(update: Update, context: ContextTypes.DEFAULT_TYP
         )
         return POST_ORDER_CHOICE
 
-    loop = asyncio.get_event_loop()
-    files_sent_successfully = 0
-
-    # --- File 1: All statuses (last 10 attempts) ---
-    status_msg_all = await context.bot.send_message(
+    # هر دو خروجی («همه» و «بدون خطا») با یک بار باز کردن تاریخچه گرفته و در یک فایل با دو برگه ارسال می‌شوند
+    status_msg = await context.bot.send_message(
         chat_id=session.user_id,
-        text=f"{EMOJI['loading']} در حال آماده‌سازی تاریخچه ۱۰ تلاش آخر برای نماد **'{stock_name}'** ({order_action_persian})...",
+        text=f"{EMOJI['loading']} در حال آماده‌سازی تاریخچه سفارشات برای نماد **'{stock_name}'** ({order_action_persian})...",
         parse_mode="Markdown"
     )
-    downloaded_excel_path_all = None
     try:
-        downloaded_excel_path_all = await loop.run_in_executor(
-            None,
-            session.bot.get_order_history_excel,
-            stock_name,
-            order_action_persian,
-            "1: 1"  # Filter for "همه"
+        history, age_seconds = await session.history_cache.get(
+            ("excel", stock_name, order_action_persian, "1: 1|0: 0"),
+            functools.partial(fetch_history_workbook, session, stock_name, order_action_persian)
         )
-
-        if downloaded_excel_path_all and os.path.exists(downloaded_excel_path_all):
-            session.add_log(f"فایل تاریخچه (همه وضعیت‌ها) '{os.path.basename(downloaded_excel_path_all)}' با موفقیت دریافت شد.", "success")
-            file_name_all = f"Mofid_OrderHistory_All_{stock_name.replace(' ', '_')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-            caption_all = (
-                f"{EMOJI['details']} فایل تاریخچه ۱۰ تلاش آخر برای نماد **{stock_name}** (عملیات: {order_action_persian}).\n"
-                f"این فایل جزئیات ۱۰ تلاش آخر (زمان ارسال و نتایج) را نمایش می‌دهد."
-            )
-            with open(downloaded_excel_path_all, 'rb') as excel_file:
-                await context.bot.send_document(
-                    chat_id=session.user_id,
-                    document=InputFile(excel_file, filename=file_name_all),
-                    caption=caption_all,
-                    parse_mode="Markdown"
-                )
-            session.add_log(f"فایل اکسل (همه وضعیت‌ها - {file_name_all}) با موفقیت ارسال شد.", "success")
-            await context.bot.edit_message_text(
-                chat_id=session.user_id, message_id=status_msg_all.message_id,
-                text=f"{EMOJI['success']} فایل تاریخچه ۱۰ تلاش آخر ارسال شد."
+        if history:
+            file_name = f"Mofid_OrderHistory_{stock_name.replace(' ', '_')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+            caption = (
+                f"{EMOJI['details']} فایل تاریخچه سفارشات نماد **{stock_name}** (عملیات: {order_action_persian}).\n"
+                f"برگه «همه تلاش‌ها»: جزئیات ۱۰ تلاش آخر (زمان ارسال و نتایج).\n"
+                f"برگه «بدون خطا»: سفارشات ثبت شده بدون خطا در هسته معاملات."
             )
-            files_sent_successfully +=1
-        else:
-            msg_fail_all = f"{EMOJI['error']} دریافت گزارش ۱۰ تلاش آخر برای نماد '{stock_name}' ناموفق بود."
-            await context.bot.edit_message_text(chat_id=session.user_id, message_id=status_msg_all.message_id, text=msg_fail_all)
-            session.add_log(msg_fail_all, "error")
-    except Exception as e_all:
-        logger.error(f"Error fetching/sending 'all statuses' Excel for user {session.user_id}: {e_all}", exc_info=True)
-        await context.bot.edit_message_text(
-            chat_id=session.user_id, message_id=status_msg_all.message_id,
-            text=f"{EMOJI['error']} خطای پیش‌بینی نشده در دریافت تاریخچه ۱۰ تلاش آخر."
-        )
-        session.add_log(f"خطای بحرانی در دریافت تاریخچه (همه وضعیت‌ها): {str(e_all)}", "critical")
-    finally:
-        if downloaded_excel_path_all and os.path.exists(downloaded_excel_path_all):
-            try: os.remove(downloaded_excel_path_all)
-            except OSError as e_del_all: logger.error(f"Error deleting temp file (all): {e_del_all}")
-
-    await asyncio.sleep(1) # Short delay before sending the next file
-
-    # --- File 2: No error status ---
-    status_msg_no_error = await context.bot.send_message(
-        chat_id=session.user_id,
-        text=f"{EMOJI['loading']} در حال آماده‌سازی تاریخچه سفارشات بدون خطا برای نماد **'{stock_name}'** ({order_action_persian})...",
-        parse_mode="Markdown"
-    )
-    downloaded_excel_path_no_error = None
-    try:
-        downloaded_excel_path_no_error = await loop.run_in_executor(
-            None,
-            session.bot.get_order_history_excel,
-            stock_name,
-            order_action_persian,
-            "0: 0"  # Filter for "بدون خطا"
-        )
-
-        if downloaded_excel_path_no_error and os.path.exists(downloaded_excel_path_no_error):
-            session.add_log(f"فایل تاریخچه (بدون خطا) '{os.path.basename(downloaded_excel_path_no_error)}' با موفقیت دریافت شد.", "success")
-            file_name_no_error = f"Mofid_OrderHistory_NoError_{stock_name.replace(' ', '_')}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-            caption_no_error = (
-                f"{EMOJI['details']} فایل تاریخچه سفارشات ثبت شده بدون خطا در هسته معاملات برای نماد **{stock_name}** (عملیات: {order_action_persian})."
+            if not history["complete"]:
+                caption += f"\n{EMOJI['warning']} یکی از دو گزارش دریافت نشد و فقط برگه موجود ارسال شده است."
+            if age_seconds:
+                caption += f"\n{EMOJI['time']} از حافظه ({age_seconds:.0f} ثانیه پیش)."
+            await context.bot.send_document(
+                chat_id=session.user_id,
+                document=InputFile(io.BytesIO(history["workbook"]), filename=file_name),
+                caption=caption,
+                parse_mode="Markdown"
             )
-            with open(downloaded_excel_path_no_error, 'rb') as excel_file:
-                await context.bot.send_document(
-                    chat_id=session.user_id,
-                    document=InputFile(excel_file, filename=file_name_no_error),
-                    caption=caption_no_error,
-                    parse_mode="Markdown"
-                )
-            session.add_log(f"فایل اکسل (بدون خطا - {file_name_no_error}) با موفقیت ارسال شد.", "success")
+            session.add_log(f"فایل اکسل تاریخچه ({file_name}) با موفقیت ارسال شد.", "success")
             await context.bot.edit_message_text(
-                chat_id=session.user_id, message_id=status_msg_no_error.message_id,
-                text=f"{EMOJI['success']} فایل تاریخچه سفارشات بدون خطا ارسال شد."
+                chat_id=session.user_id, message_id=status_msg.message_id,
+                text=f"{EMOJI['success']} فایل تاریخچه سفارشات ارسال شد."
             )
-            files_sent_successfully +=1
         else:
-            msg_fail_no_error = f"{EMOJI['error']} دریافت گزارش سفارشات بدون خطا برای نماد '{stock_name}' ناموفق بود."
-            await context.bot.edit_message_text(chat_id=session.user_id, message_id=status_msg_no_error.message_id, text=msg_fail_no_error)
-            session.add_log(msg_fail_no_error, "error")
-    except Exception as e_no_error:
-        logger.error(f"Error fetching/sending 'no error' Excel for user {session.user_id}: {e_no_error}", exc_info=True)
+            msg_fail = f"{EMOJI['error']} دریافت گزارش تاریخچه سفارشات برای نماد '{stock_name}' ناموفق بود."
+            await context.bot.edit_message_text(chat_id=session.user_id, message_id=status_msg.message_id, text=msg_fail)
+            session.add_log(msg_fail, "error")
+    except Exception as e_history:
+        logger.error(f"Error fetching/sending history Excel for user {session.user_id}: {e_history}", exc_info=True)
         await context.bot.edit_message_text(
-            chat_id=session.user_id, message_id=status_msg_no_error.message_id,
-            text=f"{EMOJI['error']} خطای پیش‌بینی نشده در دریافت تاریخچه سفارشات بدون خطا."
+            chat_id=session.user_id, message_id=status_msg.message_id,
+            text=f"{EMOJI['error']} خطای پیش‌بینی نشده در دریافت تاریخچه سفارشات."
         )
-        session.add_log(f"خطای بحرانی در دریافت تاریخچه (بدون خطا): {str(e_no_error)}", "critical")
-    finally:
-        if downloaded_excel_path_no_error and os.path.exists(downloaded_excel_path_no_error):
-            try: os.remove(downloaded_excel_path_no_error)
-            except OSError as e_del_no_error: logger.error(f"Error deleting temp file (no error): {e_del_no_error}")
+        session.add_log(f"خطای بحرانی در دریافت تاریخچه سفارشات: {str(e_history)}", "critical")
     
     # Final warning message
     final_warning = f"""
@@ -2736,6 +2786,7 @@ async def reshow_order_details(update: Update, context: ContextTypes.DEFAULT_TYP
     )
 
     post_order_keyboard = [
+        [InlineKeyboardButton(f"{EMOJI['report']} خلاصه تاریخچه سفارشات", callback_data="history_summary")],
         [InlineKeyboardButton(f"{EMOJI['details']} دریافت مجدد تاریخچه (اکسل)", callback_data="reshow_details")],
         [InlineKeyboardButton(f"{EMOJI['new_order']} شروع سفارش جدید", callback_data="post_order_new_order_mofid")],
         [InlineKeyboardButton(f"{EMOJI['logout']} خروج از حساب کارگزاری", callback_data="post_order_logout_mofid")],
@@ -2775,7 +2826,7 @@ async def handle_post_order_choice(update: Update, context: ContextTypes.DEFAULT
             await query.message.reply_text(f"{EMOJI['error']} شما وارد حساب کارگزاری مفید نشده‌اید یا ارتباط با مرورگر قطع شده است. لطفاً ابتدا با /start وارد شوید.")
             # Attempt to safely quit if driver exists but not logged in (edge case)
             if session.bot.driver:
-                session.safe_quit()
+                await session.run_driver_task(session.safe_quit)
             return await start(update, context) # Restart the process
 
         # --- New: Click watchlist tab to reset UI ---
@@ -2784,12 +2835,8 @@ async def handle_post_order_choice(update: Update, context: ContextTypes.DEFAULT
         
         watchlist_clicked_successfully = False
         try:
-            # Run the Selenium operation in an executor to avoid blocking asyncio event loop
-            loop = asyncio.get_event_loop()
-            watchlist_clicked_successfully = await loop.run_in_executor(
-                None,  # Uses default ThreadPoolExecutor
-                session.bot.click_watchlist_tab 
-            )
+            # Run the Selenium operation on the session's driver thread to avoid blocking asyncio event loop
+            watchlist_clicked_successfully = await session.run_driver_task(session.bot.click_watchlist_tab)
         except Exception as e_click_watchlist:
             logger.error(f"Exception when trying to run click_watchlist_tab in executor: {e_click_watchlist}", exc_info=True)
             session.add_log(f"خطا در اجرای کلیک روی دیده‌بان: {e_click_watchlist}", "error")
@@ -2817,9 +2864,11 @@ async def handle_post_order_choice(update: Update, context: ContextTypes.DEFAULT
         # Safely quit Selenium session
         if session.bot and session.bot.driver:
              logger.info(f"User {session.user_id} initiated logout. Closing Mofid Selenium session.")
-             session.safe_quit() # Calls MofidBrokerSession's safe_quit
+             await session.run_driver_task(session.safe_quit) # Calls MofidBrokerSession's safe_quit
         else:
             logger.info(f"User {session.user_id} initiated logout, but no active Selenium session found to close.")
+        # خروج صریح کاربر: نشست ذخیره‌شده هم حذف می‌شود
+        broker_session_store.delete(session.user_id, session.brokerage_username)
 
         session.is_logged_in = False
         session.credentials = {}
@@ -2833,6 +2882,7 @@ async def handle_post_order_choice(update: Update, context: ContextTypes.DEFAULT
     # Fallback for other unhandled post_order_ choices, or if state is just POST_ORDER_CHOICE
     # This ensures the user always has options if they land here unexpectedly.
     keyboard = [
+        [InlineKeyboardButton(f"{EMOJI['report']} خلاصه تاریخچه سفارشات", callback_data="history_summary")],
         [InlineKeyboardButton(f"{EMOJI['details']} دریافت تاریخچه سفارشات (اکسل)", callback_data="reshow_details")],
         [InlineKeyboardButton(f"{EMOJI['new_order']} شروع سفارش جدید", callback_data="post_order_new_order_mofid")],
         [InlineKeyboardButton(f"{EMOJI['logout']} خروج از حساب کارگزاری", callback_data="post_order_logout_mofid")],
@@ -2861,7 +2911,7 @@ async def restart_full_process(update: Update, context: ContextTypes.DEFAULT_TYP
     await query.answer()
     session = context.user_data.get("session")
     if session:
-        session.safe_quit()
+        await session.close()
         del context.user_data["session"] 
     await query.edit_message_text("در حال شروع مجدد ربات مفید...")
     return await start(update, context)
@@ -3050,13 +3100,28 @@ async def show_subscription_guide(update: Update, context: ContextTypes.DEFAULT_
 
 
 
+async def stop_browsers(application: Application) -> None:
+    """post_shutdown: quit pre-warmed drivers and the shared Chrome so no Chrome/chromedriver process or temp profile outlives the bot."""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, get_driver_pool().stop)
+    await loop.run_in_executor(None, stop_shared_browser)
+    logger.info("Driver pool and shared Chrome stopped.")
+
+
 def main() -> None:
     bot_token = os.environ.get("MOFID_BOT_TOKEN")
     if not bot_token:
         logger.critical("MOFID_BOT_TOKEN not found in .env file. Exiting.")
         return
 
-    application = Application.builder().token(bot_token).build()
+    # ساخت pool و اعمال migrationهای schema هنگام شروع؛ اگر MySQL در دسترس نباشد در اولین استفاده دوباره تلاش می‌شود
+    if not db_pool.ensure_ready():
+        logger.warning("MySQL is unreachable at startup; the pool and schema migrations will be retried on first use.")
+
+    # کاربران مختلف هم‌زمان پردازش می‌شوند (سفارش طولانی یک کاربر بقیه را معطل نمی‌کند)،
+    # ولی آپدیت‌های هر کاربر به ترتیب و یکی‌یکی، چون ConversationHandler به این ترتیب وابسته است
+    application = (Application.builder().token(bot_token).concurrent_updates(PerUserUpdateProcessor())
+                   .post_shutdown(stop_browsers).build())
     
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -3119,7 +3184,10 @@ def main() -> None:
                 CallbackQueryHandler(get_send_method, pattern="^back_to_send_method$"),
                 CallbackQueryHandler(back_to_send_method_from_quantity, pattern="^back_to_send_method_from_quantity$"),
             ],
-            ORDER_SCHEDULE_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_schedule_time)],
+            ORDER_SCHEDULE_TIME: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, get_schedule_time),
+                CallbackQueryHandler(auto_schedule_time, pattern="^schedule_auto_mofid$"),
+            ],
             ORDER_QUANTITY: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, get_order_quantity),
                 CallbackQueryHandler(back_to_send_method_from_quantity, pattern="^back_to_send_method_from_quantity$"),
@@ -3133,7 +3201,8 @@ def main() -> None:
             VIEW_DETAILS: [],
             POST_ORDER_CHOICE: [
                 CallbackQueryHandler(handle_post_order_choice, pattern="^post_order_"),
-                CallbackQueryHandler(reshow_order_details, pattern="^reshow_details$") 
+                CallbackQueryHandler(reshow_order_details, pattern="^reshow_details$"),
+                CallbackQueryHandler(show_history_summary, pattern="^history_summary$"),
             ],
         },
         fallbacks=[
@@ -3143,6 +3212,10 @@ def main() -> None:
     )
     application.add_handler(conv_handler)
     application.add_error_handler(error_handler)
+    # کروم‌های آماده برای ورود سریع (به‌ویژه هم‌زمان با بازگشایی بازار)
+    get_driver_pool().start()
+    # کالیبراسیون ساعت کارگزاری در پس‌زمینه (برای شلیک دقیق سفارش‌های زمان‌دار)
+    get_broker_clock().refresh_async()
     logger.info("Mofid Telegram Bot started successfully.")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
@@ -12,6 +12,8 @@ load_dotenv()
 import mysql.connector
 from mysql.connector import Error
 
+from user_cache import ensure_invalidation_table, publish_user_invalidation
+
 # --- Configuration ---
 ADMIN_PASSWORD = "0000"  # Change this in a production environment!
 
@@ -184,6 +186,76 @@ def save_users_data(data):
             connection.close()
 
 
+# ستون‌هایی از users که فرم ویرایش کاربر تغییر می‌دهد
+EDITABLE_USER_COLUMNS = ("telegram_name", "full_name", "real_name", "brokerage_username", "brokerage_password",
+                         "brokerage_type", "subscription_type", "national_id", "phone_number", "email",
+                         "expiry_date", "token")
+
+
+def update_user(telegram_id, changes):
+    """
+    Updates one users row and, in the same transaction, tells the bot to drop its cached copy
+    of that user; other rows and tables are left untouched.
+    """
+    connection = get_db_connection()
+    if not connection:
+        return False
+    
+    columns = [column for column in EDITABLE_USER_COLUMNS if column in changes]
+    try:
+        cursor = connection.cursor()
+        # DDL باعث commit ضمنی می‌شود؛ باید پیش از UPDATE اجرا شود
+        ensure_invalidation_table(cursor)
+        cursor.execute(
+            f"UPDATE users SET {', '.join(f'{column} = %s' for column in columns)} WHERE telegram_id = %s",
+            [changes[column] for column in columns] + [telegram_id]
+        )
+        publish_user_invalidation(cursor, [telegram_id])
+        connection.commit()
+        return True
+    except Error as e:
+        st.error(f"Error saving user to database: {e}")
+        connection.rollback()
+        return False
+    finally:
+        if connection and connection.is_connected():
+            cursor.close()
+            connection.close()
+
+
+def insert_token(token_item):
+    """Inserts a single new token row; users and activity_log are left untouched."""
+    connection = get_db_connection()
+    if not connection:
+        return False
+    
+    try:
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO tokens (token, telegram_id, brokerage_username, subscription_type,
+                               expiry_date, is_used, used_by_telegram_id, used_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, (
+            token_item.get("token"),
+            token_item.get("telegram_id"),
+            token_item.get("brokerage_username"),
+            token_item.get("subscription_type"),
+            token_item.get("expiry_date"),
+            token_item.get("is_used"),
+            token_item.get("used_by_telegram_id"),
+            token_item.get("used_at")
+        ))
+        connection.commit()
+        return True
+    except Error as e:
+        st.error(f"Error saving token to database: {e}")
+        return False
+    finally:
+        if connection and connection.is_connected():
+            cursor.close()
+            connection.close()
+
+
 def generate_token_entry(telegram_id, subscription_type, expiry_date_str, brokerage_username):
     """
     Generates a token entry dictionary.
@@ -431,20 +503,22 @@ else:
                             if st.form_submit_button("ذخیره تغییرات کاربر"):
                                 updated_expiry_str = datetime.combine(new_expiry_date, new_expiry_time).strftime("%Y-%m-%d %H:%M:%S")
                                 
-                                all_data["users"][user_to_edit_index]["telegram_name"] = new_telegram_name
-                                all_data["users"][user_to_edit_index]["full_name"] = new_full_name
-                                all_data["users"][user_to_edit_index]["real_name"] = new_real_name
-                                all_data["users"][user_to_edit_index]["brokerage_username"] = new_broker_user
-                                all_data["users"][user_to_edit_index]["brokerage_password"] = new_broker_password
-                                all_data["users"][user_to_edit_index]["brokerage_type"] = new_broker_type
-                                all_data["users"][user_to_edit_index]["subscription_type"] = new_sub_type
-                                all_data["users"][user_to_edit_index]["national_id"] = new_national_id
-                                all_data["users"][user_to_edit_index]["phone_number"] = new_phone_number
-                                all_data["users"][user_to_edit_index]["email"] = new_email
-                                all_data["users"][user_to_edit_index]["expiry_date"] = updated_expiry_str
-                                all_data["users"][user_to_edit_index]["token"] = new_token_val
-                                
-                                save_users_data(all_data)
+                                # فقط همین ردیف به‌روز می‌شود؛ بازنویسی کل جداول از snapshot قدیمی تغییرات ربات را برمی‌گرداند
+                                if not update_user(selected_user_id_str, {
+                                    "telegram_name": new_telegram_name,
+                                    "full_name": new_full_name,
+                                    "real_name": new_real_name,
+                                    "brokerage_username": new_broker_user,
+                                    "brokerage_password": new_broker_password,
+                                    "brokerage_type": new_broker_type,
+                                    "subscription_type": new_sub_type,
+                                    "national_id": new_national_id,
+                                    "phone_number": new_phone_number,
+                                    "email": new_email,
+                                    "expiry_date": updated_expiry_str,
+                                    "token": new_token_val,
+                                }):
+                                    st.stop()
                                 # به‌روزرسانی داده‌ها در session_state
                                 st.session_state['all_data'] = load_users_data()
                                 placeholder = st.empty()
@@ -553,8 +627,9 @@ else:
                     brokerage_username=token_brokerage_username_input
                 )
                 
-                all_data["tokens"].append(new_token_data)
-                save_users_data(all_data)
+                # فقط ردیف توکن جدید درج می‌شود؛ بازنویسی کل جداول از snapshot قدیمی تغییرات ربات را برمی‌گرداند
+                if not insert_token(new_token_data):
+                    st.stop()
                 
                 # به‌روزرسانی داده‌ها در session_state
                 st.session_state['all_data'] = load_users_data()
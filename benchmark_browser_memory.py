@@ -0,0 +1,92 @@
+"""
+Compare resident memory per logged-in user between the two browser backends:
+one Chrome per user ("process") and one shared Chrome with a browser context per user ("shared").
+
+Usage:
+    python benchmark_browser_memory.py --users 5
+    MOFID_BENCH_USERNAME=... MOFID_BENCH_PASSWORD=... python benchmark_browser_memory.py --users 3 --login
+
+Without --login every user just loads the login page; with --login each context logs in with the same account.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+from mofid_module import (CHROME_ARGUMENTS, MOFID_LOGIN_URL, MofidBroker, STEALTH_SCRIPT,
+                          attached_driver_options, create_chrome_driver)
+from shared_browser import SharedChromeBrowser, descendant_pids, rss_kb
+
+logger = logging.getLogger(__name__)
+
+
+def open_user(driver, login, broker=None):
+    if login:
+        broker.driver = driver
+        broker.setup_driver = lambda headless=True: True  # درایور از قبل توسط بنچمارک ساخته شده است
+        broker.login_to_website(os.environ["MOFID_BENCH_USERNAME"], os.environ["MOFID_BENCH_PASSWORD"])
+    else:
+        driver.get(MOFID_LOGIN_URL)
+
+
+def driver_tree_pids(driver):
+    chromedriver_pid = driver.service.process.pid
+    return [chromedriver_pid] + descendant_pids(chromedriver_pid)
+
+
+def bench_process_backend(users, login, settle_seconds):
+    download_dir = tempfile.mkdtemp(prefix="mofid-bench-")
+    drivers = []
+    try:
+        for _ in range(users):
+            driver = create_chrome_driver(download_dir)
+            drivers.append(driver)
+            open_user(driver, login, MofidBroker())
+        time.sleep(settle_seconds)
+        pids = [pid for driver in drivers for pid in driver_tree_pids(driver)]
+        return rss_kb(pids)
+    finally:
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+
+
+def bench_shared_backend(users, login, settle_seconds):
+    download_dir = tempfile.mkdtemp(prefix="mofid-bench-")
+    browser = SharedChromeBrowser(CHROME_ARGUMENTS)
+    opened = []
+    try:
+        for _ in range(users):
+            driver, context_id = browser.open_context(download_dir, attached_driver_options)
+            driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": STEALTH_SCRIPT})
+            opened.append((driver, context_id))
+            open_user(driver, login, MofidBroker())
+        time.sleep(settle_seconds)
+        pids = browser.process_pids() + [driver.service.process.pid for driver, _ in opened]
+        return rss_kb(pids)
+    finally:
+        for driver, context_id in opened:
+            browser.close_context(driver, context_id)
+        browser.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RSS per user: one Chrome per user vs shared Chrome with browser contexts")
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--login", action="store_true", help="log every user in (needs MOFID_BENCH_USERNAME/PASSWORD)")
+    parser.add_argument("--settle", type=float, default=5.0, help="seconds to wait before sampling RSS")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    print(f"users={args.users} login={args.login}")
+    print(f"{'backend':<10}{'total RSS (MB)':>16}{'per user (MB)':>16}")
+    for name, bench in (("process", bench_process_backend), ("shared", bench_shared_backend)):
+        total_kb = bench(args.users, args.login, args.settle)
+        print(f"{name:<10}{total_kb / 1024:>16.1f}{total_kb / 1024 / args.users:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
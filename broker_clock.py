@@ -0,0 +1,213 @@
+import http.client
+import logging
+import os
+import statistics
+import threading
+import time
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import pytz
+
+logger = logging.getLogger(__name__)
+
+# آدرسی که هدر Date آن ساعت کارگزاری/بورس را نشان می‌دهد
+BROKER_CLOCK_URL = os.environ.get("MOFID_CLOCK_URL", "https://d.easytrader.ir/")
+CLOCK_SAMPLES = int(os.environ.get("MOFID_CLOCK_SAMPLES", 12))
+# بعد از این مدت، تخمین قدیمی است و دوباره کالیبره می‌شود
+CLOCK_MAX_AGE_SECONDS = int(os.environ.get("MOFID_CLOCK_MAX_AGE", 600))
+# نمونه‌هایی با RTT بیشتر از این ضریب میانه حذف می‌شوند
+RTT_OUTLIER_FACTOR = 1.5
+
+tehran_tz = pytz.timezone('Asia/Tehran')
+
+
+class ClockEstimate:
+    """Broker clock minus local clock, in seconds, with the half-width of its confidence interval."""
+
+    def __init__(self, offset, uncertainty, rtt, samples_used, samples_total, measured_at):
+        self.offset = offset
+        self.uncertainty = uncertainty
+        self.rtt = rtt
+        self.samples_used = samples_used
+        self.samples_total = samples_total
+        self.measured_at = measured_at
+
+    def as_dict(self):
+        return {
+            "clock_offset_ms": self.offset * 1000,
+            "clock_uncertainty_ms": self.uncertainty * 1000,
+            "clock_rtt_ms": self.rtt * 1000,
+        }
+
+
+class BrokerClock:
+    """
+    Estimates the broker's clock from HTTP Date headers (1 s resolution).
+    Each sample bounds the offset to [date - t_recv, date + 1 - t_send]; requests are spread
+    over the phase of the second and then aimed at the estimated second boundary so that
+    their intervals intersect to a window of about one round-trip time.
+    Samples with outlying round-trip times are dropped before intersecting.
+    """
+
+    def __init__(self, url=BROKER_CLOCK_URL, samples=CLOCK_SAMPLES, max_age_seconds=CLOCK_MAX_AGE_SECONDS, timeout=5):
+        parts = urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or "/"
+        self.samples = samples
+        self.max_age_seconds = max_age_seconds
+        self.timeout = timeout
+        self.estimate = None
+        self._lock = threading.Lock()
+        self._connection = None
+        self._refresh_thread = None
+
+    def _connect(self):
+        connection_class = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+        self._connection = connection_class(self.host, self.port, timeout=self.timeout)
+
+    def _sample(self):
+        """One HEAD request: (t_send, t_recv, server_epoch_seconds) or None."""
+        for attempt in range(2):
+            if self._connection is None:
+                self._connect()
+            try:
+                t_send = time.time()
+                self._connection.request("HEAD", self.path, headers={"Cache-Control": "no-cache"})
+                response = self._connection.getresponse()
+                t_recv = time.time()
+                response.read()
+                date_header = response.getheader("Date")
+                if not date_header:
+                    return None
+                return t_send, t_recv, parsedate_to_datetime(date_header).timestamp()
+            except (OSError, http.client.HTTPException) as e:
+                # اتصال keep-alive بسته شده؛ یک بار با اتصال جدید تلاش می‌کنیم
+                logger.debug(f"Clock sample failed (attempt {attempt + 1}): {e}")
+                self._connection.close()
+                self._connection = None
+        return None
+
+    def _intersect(self, samples):
+        """(lower, upper) offset bounds from samples after RTT outlier rejection, plus the kept samples."""
+        rtts = [t_recv - t_send for t_send, t_recv, _ in samples]
+        rtt_limit = statistics.median(rtts) * RTT_OUTLIER_FACTOR
+        kept = [sample for sample, rtt in zip(samples, rtts) if rtt <= rtt_limit]
+        lower = max(server - t_recv for t_send, t_recv, server in kept)
+        upper = min(server + 1.0 - t_send for t_send, t_recv, server in kept)
+        if lower > upper:
+            # بازه‌ها هم‌پوشانی ندارند (مثلاً پرش ساعت سرور)؛ به کم‌تأخیرترین نمونه تکیه می‌کنیم
+            t_send, t_recv, server = min(kept, key=lambda sample: sample[1] - sample[0])
+            lower, upper = server - t_recv, server + 1.0 - t_send
+            kept = [(t_send, t_recv, server)]
+            logger.warning("Clock sample intervals did not intersect; using the lowest-RTT sample only.")
+        return lower, upper, kept
+
+    def _sample_at(self, local_send_time):
+        delay = local_send_time - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        return self._sample()
+
+    def calibrate(self):
+        """
+        Phase-spread samples first, then samples aimed at the estimated second boundary
+        (each one roughly halves the interval), RTT outliers dropped, intervals intersected.
+        """
+        raw = []
+        spread_count = max(4, self.samples // 2)
+        try:
+            # مرحله ۱: نمونه‌ها در فازهای مختلف ثانیه پخش می‌شوند
+            start = time.time()
+            for i in range(spread_count):
+                sample = self._sample_at(start + i * (1.0 + 1.0 / spread_count))
+                if sample:
+                    raw.append(sample)
+            if not raw:
+                raise RuntimeError("No clock samples could be taken from the broker.")
+
+            # مرحله ۲: هر درخواست طوری ارسال می‌شود که وسط آن روی مرز ثانیه‌ی تخمینی سرور بیفتد
+            for _ in range(self.samples - spread_count):
+                lower, upper, kept = self._intersect(raw)
+                offset_mid = (lower + upper) / 2
+                half_rtt = statistics.median(t_recv - t_send for t_send, t_recv, _ in kept) / 2
+                next_boundary = int(time.time() + offset_mid + half_rtt) + 1  # ثانیه‌ی سرور بعدی
+                sample = self._sample_at(next_boundary - offset_mid - half_rtt)
+                if sample:
+                    raw.append(sample)
+        finally:
+            if self._connection:
+                self._connection.close()
+                self._connection = None
+
+        lower, upper, kept = self._intersect(raw)
+        estimate = ClockEstimate(
+            offset=(lower + upper) / 2,
+            uncertainty=(upper - lower) / 2,
+            rtt=statistics.median(t_recv - t_send for t_send, t_recv, _ in kept),
+            samples_used=len(kept),
+            samples_total=len(raw),
+            measured_at=time.time(),
+        )
+        with self._lock:
+            self.estimate = estimate
+        logger.info(f"Broker clock calibrated: offset {estimate.offset * 1000:+.1f} ms "
+                    f"(±{estimate.uncertainty * 1000:.1f} ms, rtt {estimate.rtt * 1000:.1f} ms, "
+                    f"{estimate.samples_used}/{estimate.samples_total} samples)")
+        return estimate
+
+    def refresh_async(self):
+        """Recalibrate on a background thread (no-op if a calibration is already running)."""
+        with self._lock:
+            if self._refresh_thread and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(target=self._refresh, name="broker-clock", daemon=True)
+            self._refresh_thread.start()
+
+    def _refresh(self):
+        try:
+            self.calibrate()
+        except Exception as e:
+            logger.error(f"Broker clock calibration failed, keeping previous estimate: {e}")
+
+    def current_estimate(self):
+        """
+        Latest estimate without blocking (calibration takes ~10 s); a stale or missing
+        estimate triggers a background recalibration. None until the first calibration finishes.
+        """
+        with self._lock:
+            estimate = self.estimate
+        if not estimate or time.time() - estimate.measured_at >= self.max_age_seconds:
+            self.refresh_async()
+        return estimate
+
+    def offset(self):
+        estimate = self.current_estimate()
+        return estimate.offset if estimate else 0.0
+
+    def now(self):
+        """Current broker (exchange) time as epoch seconds."""
+        return time.time() + self.offset()
+
+    def now_tehran(self):
+        return datetime.fromtimestamp(self.now(), tehran_tz)
+
+    def to_local_epoch(self, broker_epoch):
+        """Local-clock instant at which the broker clock will read broker_epoch."""
+        return broker_epoch - self.offset()
+
+
+_broker_clock = None
+_broker_clock_lock = threading.Lock()
+
+
+def get_broker_clock():
+    """Process-wide broker clock shared by every session."""
+    global _broker_clock
+    with _broker_clock_lock:
+        if _broker_clock is None:
+            _broker_clock = BrokerClock()
+        return _broker_clock
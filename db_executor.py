@@ -0,0 +1,52 @@
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from mysql.connector import Error
+
+from db_pool import DB_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+# تعداد نخ‌های اختصاصی پایگاه داده برابر اندازه‌ی pool اتصال (MOFID_DB_CONCURRENCY)؛ هر نخ حداکثر یک اتصال را هم‌زمان نگه می‌دارد
+DB_THREAD_POOL_SIZE = DB_CONCURRENCY
+# سقف زمان انتظار handler برای هر فراخوانی پایگاه داده (ثانیه)
+DB_QUERY_TIMEOUT_SECONDS = float(os.environ.get("MOFID_DB_QUERY_TIMEOUT", 10))
+
+
+class DatabaseTimeout(Error):
+    """A database call did not finish within its timeout (the worker thread may still be running it)."""
+
+
+class DBExecutor:
+    """
+    Runs blocking mysql.connector calls on a bounded thread pool so handlers await them
+    instead of blocking the event loop. Each call gets a timeout; a slow MySQL then delays
+    only the users waiting on it, and at most max_workers queries run at once.
+    """
+
+    def __init__(self, max_workers=DB_THREAD_POOL_SIZE, timeout_seconds=DB_QUERY_TIMEOUT_SECONDS):
+        self.timeout_seconds = timeout_seconds
+        self.timeouts = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mofid-db")
+
+    async def run(self, func, *args, timeout=None, **kwargs):
+        """Await func(*args, **kwargs) on the DB pool. Raises DatabaseTimeout after timeout seconds."""
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+        timeout = self.timeout_seconds if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise DatabaseTimeout(msg=f"{getattr(func, '__name__', func)} timed out after {timeout:.1f}s")
+
+    async def run_or(self, fallback, func, *args, timeout=None, **kwargs):
+        """Like run, but log a timeout and return fallback — for calls whose sync version already degrades on errors."""
+        try:
+            return await self.run(func, *args, timeout=timeout, **kwargs)
+        except DatabaseTimeout as e:
+            logger.error(f"Database call timed out, continuing without it: {e}")
+            return fallback
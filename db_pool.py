@@ -0,0 +1,187 @@
+import logging
+import os
+import threading
+import time
+
+from mysql.connector import Error, pooling
+from mysql.connector.errors import PoolError
+
+logger = logging.getLogger(__name__)
+
+# تعداد کارهای هم‌زمان پایگاه داده (نخ‌های DBExecutor)؛ اندازه‌ی pool اتصال از همین پیروی می‌کند
+DB_CONCURRENCY = int(os.environ.get("MOFID_DB_CONCURRENCY", 5))
+# حداکثر انتظار برای گرفتن اتصال وقتی همه‌ی اتصال‌ها در حال استفاده‌اند (ثانیه)
+DB_POOL_WAIT_TIMEOUT_SECONDS = float(os.environ.get("MOFID_DB_POOL_WAIT_TIMEOUT", 5))
+# فاصله‌ی تلاش دوباره برای ساخت pool پس از شکست: از RECONNECT_BACKOFF_INITIAL دو برابر می‌شود تا سقف
+RECONNECT_BACKOFF_INITIAL_SECONDS = 1.0
+RECONNECT_BACKOFF_MAX_SECONDS = 30.0
+STATS_LOG_EVERY_CHECKOUTS = 1000
+
+
+class PooledConnectionLease:
+    """
+    A checked-out pooled connection. close() returns it to the pool and frees its wait-queue
+    slot; if a caller skips close() (e.g. after `if connection.is_connected()` fails), the slot is
+    freed when the lease is garbage-collected.
+    """
+
+    def __init__(self, pool, connection):
+        self._pool = pool
+        self._connection = connection
+        self._checked_out_at = time.monotonic()
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def close(self):
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        try:
+            connection.close()
+        except Error as e:
+            logger.warning(f"Error returning connection to pool: {e}")
+        finally:
+            self._pool._released(time.monotonic() - self._checked_out_at)
+
+    def __del__(self):
+        if getattr(self, "_connection", None) is not None:
+            self.close()
+
+
+class DBPool:
+    """
+    MySQL connection pool created on first use (so a briefly unreachable database does not
+    crash startup), retried with exponential backoff, and handed out through a bounded wait
+    queue: when every connection is in use, callers wait up to wait_timeout instead of failing.
+    get_connection() returns None on failure, like the previous get_db_connection.
+    on_create(get_raw_connection) runs once when the pool first comes up (e.g. schema migrations),
+    before any other caller is handed a connection.
+    """
+
+    def __init__(self, dbconfig, pool_size=DB_CONCURRENCY, wait_timeout=DB_POOL_WAIT_TIMEOUT_SECONDS, pool_name="mypool",
+                 on_create=None):
+        self.dbconfig = dbconfig
+        self.on_create = on_create
+        self.pool_size = max(1, min(pool_size, pooling.CNX_POOL_MAXSIZE))
+        self.wait_timeout = wait_timeout
+        self.pool_name = pool_name
+        self._pool = None
+        self._init_lock = threading.Lock()
+        self._next_init_attempt = 0.0
+        self._backoff = RECONNECT_BACKOFF_INITIAL_SECONDS
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+        self._stats_lock = threading.Lock()
+        self._in_use = 0
+        self._waiting = 0
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._checkout_total = 0.0
+        self._checkout_max = 0.0
+        self._returns = 0
+        self._errors = 0
+        self._timeouts = 0
+
+    def _ensure_pool(self):
+        if self._pool is not None:
+            return self._pool
+        with self._init_lock:
+            if self._pool is not None:
+                return self._pool
+            now = time.monotonic()
+            if now < self._next_init_attempt:
+                return None
+            try:
+                pool = pooling.MySQLConnectionPool(pool_name=self.pool_name, pool_size=self.pool_size, **self.dbconfig)
+                self._backoff = RECONNECT_BACKOFF_INITIAL_SECONDS
+                logger.info(f"MySQL connection pool '{self.pool_name}' created with {self.pool_size} connections")
+            except Error as e:
+                with self._stats_lock:
+                    self._errors += 1
+                self._next_init_attempt = now + self._backoff
+                logger.error(f"Could not create MySQL connection pool (retrying in {self._backoff:.0f}s): {e}")
+                self._backoff = min(self._backoff * 2, RECONNECT_BACKOFF_MAX_SECONDS)
+                return None
+            if self.on_create is not None:
+                try:
+                    self.on_create(pool.get_connection)
+                except Error as e:
+                    # بدون pool ربات کار نمی‌کند؛ خطا ثبت می‌شود و pool با همین وضعیت استفاده می‌شود
+                    logger.error(f"Pool on_create hook failed: {e}")
+            self._pool = pool
+            return self._pool
+
+    def ensure_ready(self):
+        """Create the pool now if possible (startup warm-up); False if MySQL is unreachable."""
+        return self._ensure_pool() is not None
+
+    def get_connection(self, timeout=None):
+        """A PooledConnectionLease, or None if the pool is unavailable or no connection freed up in time."""
+        if self._ensure_pool() is None:
+            return None
+        timeout = self.wait_timeout if timeout is None else timeout
+        started = time.monotonic()
+        with self._stats_lock:
+            self._waiting += 1
+        acquired = self._slots.acquire(timeout=timeout)
+        waited = time.monotonic() - started
+        with self._stats_lock:
+            self._waiting -= 1
+            if not acquired:
+                self._timeouts += 1
+        if not acquired:
+            logger.error(f"No database connection became free within {timeout:.1f}s ({self.pool_size} in use)")
+            return None
+
+        try:
+            connection = self._checkout(started + timeout)
+        except Error as e:
+            self._slots.release()
+            with self._stats_lock:
+                self._errors += 1
+            logger.error(f"Error getting connection from pool: {e}")
+            return None
+
+        with self._stats_lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+            log_stats = self._checkouts % STATS_LOG_EVERY_CHECKOUTS == 0
+        if log_stats:
+            logger.info(f"DB pool stats: {self.stats()}")
+        return PooledConnectionLease(self, connection)
+
+    def _checkout(self, deadline):
+        # هر اسلات صف متناظر یک اتصال pool است؛ PoolError فقط وقتی رخ می‌دهد که اتصالی بیرون از صف گرفته شده باشد
+        while True:
+            try:
+                return self._pool.get_connection()
+            except PoolError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.05)
+
+    def _released(self, checkout_seconds):
+        with self._stats_lock:
+            self._in_use -= 1
+            self._returns += 1
+            self._checkout_total += checkout_seconds
+            self._checkout_max = max(self._checkout_max, checkout_seconds)
+        self._slots.release()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "pool_size": self.pool_size,
+                "in_use": self._in_use,
+                "waiting": self._waiting,
+                "checkouts": self._checkouts,
+                "wait_avg_ms": round(1000 * self._wait_total / self._checkouts, 1) if self._checkouts else 0.0,
+                "wait_max_ms": round(1000 * self._wait_max, 1),
+                "checkout_avg_ms": round(1000 * self._checkout_total / self._returns, 1) if self._returns else 0.0,
+                "checkout_max_ms": round(1000 * self._checkout_max, 1),
+                "errors": self._errors,
+                "timeouts": self._timeouts,
+            }
@@ -0,0 +1,125 @@
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+logger = logging.getLogger(__name__)
+
+# ثابت‌های inotify از <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+# فاصله بررسی پوشه وقتی inotify در دسترس نیست (مثلاً غیر لینوکس)
+POLL_INTERVAL_SECONDS = 0.1
+PARTIAL_DOWNLOAD_SUFFIXES = (".crdownload", ".tmp", ".part")
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            libc.inotify_init1  # AttributeError روی سیستم‌های بدون inotify
+            _libc = libc
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc or None
+
+
+class DownloadWatcher:
+    """
+    Detects a finished browser download in one directory.
+    Chrome writes to "<name>.crdownload" and renames it to the final name when the download
+    completes, so the final name appearing (inotify IN_MOVED_TO / IN_CLOSE_WRITE, or a
+    directory listing as fallback) means the file is complete — no size-stability wait.
+    Arm it before clicking the export button:
+
+        with DownloadWatcher(directory) as watcher:
+            click_export()
+            path = watcher.wait(timeout)
+    """
+
+    def __init__(self, directory, extensions=(".xlsx", ".xls")):
+        self.directory = directory
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self._fd = None
+        self._files_before = set()
+
+    def __enter__(self):
+        self._files_before = set(os.listdir(self.directory))
+        libc = _load_libc()
+        if libc:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0 and libc.inotify_add_watch(fd, os.fsencode(self.directory), IN_MOVED_TO | IN_CLOSE_WRITE) >= 0:
+                self._fd = fd
+            else:
+                logger.warning(f"inotify unavailable for {self.directory} (errno {ctypes.get_errno()}), polling instead.")
+                if fd >= 0:
+                    os.close(fd)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _is_final(self, name):
+        lowered = name.lower()
+        return lowered.endswith(self.extensions) and not lowered.endswith(PARTIAL_DOWNLOAD_SUFFIXES)
+
+    def _completed_from_listing(self):
+        for name in set(os.listdir(self.directory)) - self._files_before:
+            path = os.path.join(self.directory, name)
+            if self._is_final(name) and os.path.exists(path) and os.path.getsize(path) > 0:
+                return path
+        return None
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        names, offset = [], 0
+        while offset + INOTIFY_EVENT_HEADER.size <= len(data):
+            _, _, _, name_len = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            names.append(os.fsdecode(data[offset:offset + name_len].rstrip(b"\0")))
+            offset += name_len
+        return names
+
+    def wait(self, timeout):
+        """Path of the first completed download, or None after timeout seconds."""
+        deadline = time.monotonic() + timeout
+        # دانلودی که قبل از ثبت watch تمام شده باشد فقط در فهرست پوشه دیده می‌شود
+        completed = self._completed_from_listing()
+        while completed is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            if self._fd is None:
+                time.sleep(min(POLL_INTERVAL_SECONDS, remaining))
+                completed = self._completed_from_listing()
+                continue
+            readable, _, _ = select.select([self._fd], [], [], remaining)
+            if not readable:
+                continue
+            for name in self._read_events():
+                if self._is_final(name) and name not in self._files_before:
+                    completed = os.path.join(self.directory, name)
+                    break
+        return completed
@@ -0,0 +1,164 @@
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# تعداد دفعات استفاده مجدد از یک کروم قبل از بستن کامل آن (جلوگیری از نشت حافظه)
+MAX_DRIVER_REUSES = 20
+
+
+class DriverPool:
+    """
+    Keeps `size` headless drivers launched, configured and parked on `warm_url`,
+    so a login can start typing immediately instead of cold-starting Chrome.
+    A background thread refills the pool and recycles drivers handed back via release().
+    """
+
+    def __init__(self, factory, size, warm_url, wipe_origins=()):
+        self.factory = factory              # callable() -> new WebDriver (already configured)
+        self.size = size
+        self.warm_url = warm_url
+        self.wipe_origins = tuple(wipe_origins)
+        self._idle = deque()                # (driver, reuse_count)
+        self._recycle = deque()             # درایورهای برگشتی که باید پاک‌سازی شوند
+        self._reuse_counts = {}             # id(driver) -> reuse_count for drivers lent out
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        if self.size <= 0:
+            logger.info("Driver pool disabled (size=0).")
+            return
+        with self._cond:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name="driver-pool", daemon=True)
+            self._thread.start()
+        logger.info(f"Driver pool started with size {self.size}, warm url {self.warm_url}")
+
+    def stop(self, join_timeout=30):
+        with self._cond:
+            self._stopped = True
+            drivers = [driver for driver, _ in self._idle] + [driver for driver, _ in self._recycle]
+            self._idle.clear()
+            self._recycle.clear()
+            self._cond.notify_all()
+            thread = self._thread
+        for driver in drivers:
+            self._quit(driver)
+        # درایوری که نخ استخر در حال ساخت یا پاک‌سازی آن است در _park بسته می‌شود
+        if thread and thread.is_alive() and thread is not threading.current_thread():
+            thread.join(join_timeout)
+
+    def idle_count(self):
+        with self._cond:
+            return len(self._idle)
+
+    def acquire(self):
+        """Take a warm driver, or None if the pool is empty (caller then cold-starts one)."""
+        while True:
+            with self._cond:
+                if not self._idle:
+                    self._cond.notify()  # درخواست پر کردن مجدد
+                    return None
+                driver, reuse_count = self._idle.popleft()
+                self._cond.notify()
+            if self._is_alive(driver):
+                with self._cond:
+                    self._reuse_counts[id(driver)] = reuse_count
+                logger.info(f"Warm driver handed out from pool ({self.idle_count()} left idle).")
+                return driver
+            self._quit(driver)
+
+    def release(self, driver):
+        """
+        Hand a driver back. Drivers that came from the pool and are under MAX_DRIVER_REUSES
+        are queued for wiping and re-warming on the pool thread; everything else is quit.
+        """
+        with self._cond:
+            reuse_count = self._reuse_counts.pop(id(driver), None)
+            recyclable = (not self._stopped and reuse_count is not None
+                          and reuse_count + 1 < MAX_DRIVER_REUSES
+                          and len(self._idle) + len(self._recycle) < self.size)
+            if recyclable:
+                self._recycle.append((driver, reuse_count + 1))
+                self._cond.notify()
+                return
+        self._quit(driver)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and not self._recycle and len(self._idle) >= self.size:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                job = self._recycle.popleft() if self._recycle else None
+
+            if job:
+                driver, reuse_count = job
+                if self._wipe_and_warm(driver):
+                    self._park(driver, reuse_count)
+                else:
+                    self._quit(driver)
+                continue
+
+            try:
+                started = time.perf_counter()
+                driver = self.factory()
+                if driver is None:
+                    raise RuntimeError("driver factory returned None")
+                driver.get(self.warm_url)
+                logger.info(f"Pre-warmed driver ready in {time.perf_counter() - started:.2f}s")
+                self._park(driver, 0)
+            except Exception as e:
+                logger.error(f"Driver pool failed to launch a driver: {e}")
+                time.sleep(5)  # جلوگیری از حلقه‌ی داغ در صورت خرابی کروم
+
+    def _park(self, driver, reuse_count):
+        with self._cond:
+            if self._stopped or len(self._idle) >= self.size:
+                surplus = True
+            else:
+                self._idle.append((driver, reuse_count))
+                surplus = False
+        if surplus:
+            self._quit(driver)
+
+    def _wipe_and_warm(self, driver):
+        """Clear cookies/storage/cache and park the driver back on warm_url. Returns False if not safe to reuse."""
+        try:
+            handles = driver.window_handles
+            if len(handles) != 1:
+                # پنجره‌های اضافه (مثلاً صفحه پروفایل) یعنی وضعیت نامشخص؛ استفاده مجدد امن نیست
+                return False
+            driver.switch_to.window(handles[0])
+            driver.get("about:blank")
+            driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+            driver.execute_cdp_cmd("Network.clearBrowserCache", {})
+            for origin in self.wipe_origins:
+                driver.execute_cdp_cmd("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+            driver.get(self.warm_url)
+            return True
+        except Exception as e:
+            logger.warning(f"Driver could not be wiped for reuse: {e}")
+            return False
+
+    @staticmethod
+    def _is_alive(driver):
+        try:
+            driver.current_url
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _quit(driver):
+        try:
+            driver.quit()
+        except Exception as e:
+            logger.error(f"Error quitting pooled driver: {e}")
@@ -0,0 +1,54 @@
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# تا این سن، نتیجه‌ی تاریخچه بدون هیچ کاری از حافظه برگردانده می‌شود؛ بعد از آن هنگام درخواست دوباره خوانده می‌شود
+HISTORY_CACHE_TTL_SECONDS = float(os.environ.get("MOFID_HISTORY_CACHE_TTL", 60))
+# اگر خواندن دوباره شکست بخورد، نتیجه‌ی قدیمی تا این سن هنوز (با ذکر سن) نمایش داده می‌شود
+HISTORY_CACHE_MAX_STALE_SECONDS = float(os.environ.get("MOFID_HISTORY_CACHE_MAX_STALE", 120))
+
+
+class HistoryCache:
+    """
+    Per-session cache of parsed order-history results keyed by (kind, stock, action, status filter).
+    Fresh entries are served as is; older ones are re-fetched on demand, never in the background,
+    since fetching drives the session's single browser thread that order placement also uses.
+    A stale entry is served only when the re-fetch fails and it is younger than max_stale_seconds.
+    """
+
+    def __init__(self, ttl_seconds=HISTORY_CACHE_TTL_SECONDS, max_stale_seconds=HISTORY_CACHE_MAX_STALE_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.max_stale_seconds = max_stale_seconds
+        self._entries = {}      # key -> (value, fetched_at)
+        self._generation = 0    # با هر invalidate زیاد می‌شود تا نتیجه‌ی خواندن‌های قدیمی ذخیره نشود
+
+    async def get(self, key, loader):
+        """
+        (value, age_seconds) for key; loader is an async callable returning a fresh value.
+        age_seconds is 0 when the value was just loaded. A None value is never cached.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl_seconds:
+            return entry[0], time.monotonic() - entry[1]
+        value = await self._load(key, loader)
+        if value is None and entry is not None and key in self._entries:
+            age = time.monotonic() - entry[1]
+            if age < self.max_stale_seconds:
+                logger.info(f"History re-fetch for {key} failed; serving the {age:.0f}s old result.")
+                return entry[0], age
+        return value, 0.0
+
+    async def _load(self, key, loader):
+        generation = self._generation
+        value = await loader()
+        if value is not None and generation == self._generation:
+            self._entries[key] = (value, time.monotonic())
+        return value
+
+    def invalidate(self, stock=None):
+        """Drop every entry for stock (all entries if stock is None), e.g. after a new burst on that symbol."""
+        self._generation += 1
+        for key in [key for key in self._entries if stock is None or key[1] == stock]:
+            del self._entries[key]
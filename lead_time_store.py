@@ -0,0 +1,101 @@
+import json
+import logging
+import math
+import os
+import statistics
+import threading
+
+from filelock import FileLock, Timeout
+
+logger = logging.getLogger(__name__)
+
+LEAD_TIME_FILE = os.environ.get("MOFID_LEAD_TIME_FILE", "lead_times.json")
+MAX_SAMPLES_PER_CLASS = 50
+MIN_SAMPLES_FOR_AUTO = 3
+# تاخیرهای بیرون از این بازه (میلی‌ثانیه) نمونه معتبر حساب نمی‌شوند
+MAX_VALID_LEAD_MS = 60_000
+# سقف انتظار برای قفل فایل (ثانیه)؛ پس از آن نمونه ثبت نمی‌شود یا آمار «ناموجود» برمی‌گردد
+LEAD_TIME_LOCK_TIMEOUT_SECONDS = float(os.environ.get("MOFID_LEAD_TIME_LOCK_TIMEOUT", 5))
+
+
+def symbol_class(stock_name):
+    """'option' (ض/ط + digits), 'right' (…ح) or 'regular' — acceptance latency differs per class."""
+    name = (stock_name or "").strip()
+    if name[:1] in ("ض", "ط") and any(ch.isdigit() for ch in name):
+        return "option"
+    if len(name) > 2 and name.endswith("ح"):
+        return "right"
+    return "regular"
+
+
+def median_confidence_interval(samples, z=1.96):
+    """Distribution-free ~95% CI for the median from order statistics."""
+    ordered = sorted(samples)
+    n = len(ordered)
+    half_width = z * math.sqrt(n) / 2
+    low_rank = max(0, int(math.floor(n / 2 - half_width)))
+    high_rank = min(n - 1, int(math.ceil(n / 2 + half_width)) - 1)
+    return ordered[low_rank], ordered[high_rank]
+
+
+class LeadTimeStore:
+    """
+    Per user and symbol class, the observed delay (ms) between the first submit click
+    and the first order accepted by the trading core, persisted in a JSON file.
+    """
+
+    def __init__(self, path=LEAD_TIME_FILE, lock_timeout=LEAD_TIME_LOCK_TIMEOUT_SECONDS):
+        self.path = path
+        self.lock_timeout = lock_timeout
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read lead-time file {self.path}: {e}")
+            return {}
+
+    def record(self, user_id, stock_name, lead_ms):
+        if not 0 <= lead_ms <= MAX_VALID_LEAD_MS:
+            logger.warning(f"Ignoring implausible lead time {lead_ms:.0f} ms for user {user_id}")
+            return False
+        klass = symbol_class(stock_name)
+        try:
+            with self._lock, FileLock(self.path + ".lock", timeout=self.lock_timeout):
+                data = self._load()
+                samples = data.setdefault(str(user_id), {}).setdefault(klass, [])
+                samples.append(round(lead_ms, 1))
+                del samples[:-MAX_SAMPLES_PER_CLASS]
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.path)
+        except Timeout:
+            logger.error(f"Lead-time file {self.path} stayed locked for {self.lock_timeout:.1f}s; sample for user {user_id} not recorded.")
+            return False
+        logger.info(f"Recorded lead time {lead_ms:.0f} ms for user {user_id} ({klass})")
+        return True
+
+    def stats(self, user_id, stock_name):
+        """{"median_ms", "ci_low_ms", "ci_high_ms", "samples", "symbol_class"} or None if too few samples."""
+        klass = symbol_class(stock_name)
+        try:
+            with self._lock, FileLock(self.path + ".lock", timeout=self.lock_timeout):
+                samples = self._load().get(str(user_id), {}).get(klass, [])
+        except Timeout:
+            logger.error(f"Lead-time file {self.path} stayed locked for {self.lock_timeout:.1f}s; no stats for user {user_id}.")
+            return None
+        if len(samples) < MIN_SAMPLES_FOR_AUTO:
+            return None
+        ci_low, ci_high = median_confidence_interval(samples)
+        return {
+            "median_ms": statistics.median(samples),
+            "ci_low_ms": ci_low,
+            "ci_high_ms": ci_high,
+            "samples": len(samples),
+            "symbol_class": klass,
+        }
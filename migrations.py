@@ -0,0 +1,100 @@
+import logging
+
+from mysql.connector import Error, errorcode
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_LOCK_NAME = "mofid_schema_migrations"
+MIGRATION_LOCK_TIMEOUT_SECONDS = 60
+
+# خطاهایی که یعنی این گام قبلاً (مثلاً در اجرای نیمه‌کاره‌ی قبلی) اعمال شده است؛ DDL در MySQL تراکنشی نیست
+ALREADY_APPLIED_ERRORS = (errorcode.ER_DUP_FIELDNAME, errorcode.ER_DUP_KEYNAME)
+
+
+def ensure_unique_key(table, column):
+    """Step adding a unique index on column unless an existing unique index already starts with it."""
+
+    def step(cursor):
+        cursor.execute("""
+            SELECT COUNT(*) FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+              AND seq_in_index = 1 AND non_unique = 0
+        """, (table, column))
+        if cursor.fetchone()[0] == 0:
+            cursor.execute(f"CREATE UNIQUE INDEX uq_{table}_{column} ON {table} ({column})")
+
+    step.__name__ = f"ensure_unique_key({table}.{column})"
+    return step
+
+
+# (version, description, steps); هر گام یک دستور SQL یا تابعی که cursor می‌گیرد. نسخه‌ها را فقط اضافه کنید، تغییر ندهید.
+MIGRATIONS = [
+    (1, "normalised, indexed brokerage username", [
+        # ستون تولیدشده: در هر INSERT/UPDATE (ربات، پنل ادمین یا دستی) خود MySQL مقدار را به‌روز نگه می‌دارد
+        """
+        ALTER TABLE users
+        ADD COLUMN brokerage_username_normalized VARCHAR(255)
+            GENERATED ALWAYS AS (LOWER(brokerage_username)) STORED
+        """,
+        "CREATE INDEX idx_users_brokerage_username_normalized ON users (brokerage_username_normalized, brokerage_type)",
+    ]),
+    (2, "keys for the hot lookups in users, tokens and activity_log", [
+        ensure_unique_key("users", "telegram_id"),
+        ensure_unique_key("tokens", "token"),
+        ensure_unique_key("activity_log", "telegram_id"),
+    ]),
+]
+
+
+def run_migrations(get_connection, migrations=MIGRATIONS):
+    """
+    Apply pending migrations in version order and record each in schema_migrations.
+    A MySQL named lock keeps two processes from migrating at once. Returns the versions applied.
+    """
+    connection = get_connection()
+    if not connection:
+        raise Error("No database connection")
+    cursor = connection.cursor()
+    applied_now = []
+    try:
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (MIGRATION_LOCK_NAME, MIGRATION_LOCK_TIMEOUT_SECONDS))
+        if cursor.fetchone()[0] != 1:
+            raise Error(f"Could not take migration lock within {MIGRATION_LOCK_TIMEOUT_SECONDS}s")
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT NOT NULL PRIMARY KEY,
+                    description VARCHAR(255) NOT NULL,
+                    applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cursor.execute("SELECT version FROM schema_migrations")
+            applied = {row[0] for row in cursor.fetchall()}
+            for version, description, steps in sorted(migrations, key=lambda migration: migration[0]):
+                if version in applied:
+                    continue
+                logger.info(f"Applying schema migration {version}: {description}")
+                for step in steps:
+                    try:
+                        if callable(step):
+                            step(cursor)
+                        else:
+                            cursor.execute(step)
+                    except Error as e:
+                        if e.errno not in ALREADY_APPLIED_ERRORS:
+                            raise
+                        logger.info(f"Migration {version}: step already applied ({e.msg})")
+                cursor.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                               (version, description))
+                connection.commit()
+                applied_now.append(version)
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK_NAME,))
+            cursor.fetchone()
+    finally:
+        cursor.close()
+        if connection.is_connected():
+            connection.close()
+    if applied_now:
+        logger.info(f"Schema migrations applied: {applied_now}")
+    return applied_now
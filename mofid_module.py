@@ -1,6 +1,7 @@
 # dual repo pushing Removing
 import logging
 import time
+import threading
 from datetime import datetime, timedelta # timedelta اضافه شده است
 import pytz
 from selenium import webdriver
@@ -8,21 +9,528 @@ from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.common.exceptions import TimeoutException, WebDriverException, StaleElementReferenceException
 import os 
 import glob 
+import json
+import re
+import shutil
+import uuid
 from selenium.webdriver.support.ui import Select 
-
-
+from order_scheduler import get_firing_scheduler
+from broker_clock import get_broker_clock
+from network_tracker import OrderNetworkTracker
+from driver_pool import DriverPool
+from shared_browser import get_shared_browser
+from selector_registry import SelectorRegistry
+from download_watcher import DownloadWatcher
+
+
+logger = logging.getLogger(__name__)
+
+MOFID_LOGIN_URL = "https://d.easytrader.ir/"
+# دامنه‌هایی که هنگام بازیافت درایور، کوکی/حافظه آن‌ها پاک می‌شود
+MOFID_ORIGINS = ("https://d.easytrader.ir", "https://easytrader.ir", "https://account.emofid.com", "https://online.mofidbrokerage.ir")
+DRIVER_POOL_SIZE = int(os.environ.get("MOFID_DRIVER_POOL_SIZE", 2))
+# "process": یک کروم برای هر کاربر (پیش‌فرض) | "shared": یک کروم مشترک با browser context جدا برای هر کاربر
+BROWSER_BACKEND = os.environ.get("MOFID_BROWSER_BACKEND", "process").lower()
+# هر نشست زیرپوشه‌ی دانلود خودش را زیر این مسیر دارد تا خروجی‌های اکسل کاربران با هم قاطی نشوند
+DOWNLOAD_ROOT = os.environ.get("MOFID_DOWNLOAD_ROOT", os.path.join(os.getcwd(), "temp_mofid_downloads"))
+
+# عنصری که فقط پس از ورود موفق در صفحه وجود دارد
+LOGGED_IN_MARKER_SELECTOR = "li[data-cy='search-menu-icon']"
+# فیلدهای مجاز CDP Network.setCookies (خروجی getAllCookies فیلدهای اضافه دارد)
+COOKIE_PARAM_KEYS = ("name", "value", "domain", "path", "secure", "httpOnly", "sameSite", "expires", "priority",
+                     "sourceScheme", "sourcePort", "partitionKey")
+
+JS_EXPORT_STORAGE = """
+const dump = (store) => { const out = {}; for (let i = 0; i < store.length; i++) { const k = store.key(i); out[k] = store.getItem(k); } return out; };
+return {origin: location.origin, local: dump(localStorage), session: dump(sessionStorage)};
+"""
+
+# %s با JSON شامل origin/local/session جایگزین می‌شود
+JS_SEED_STORAGE_TEMPLATE = """
+(() => {
+    const saved = %s;
+    if (location.origin !== saved.origin) return;
+    try {
+        for (const [k, v] of Object.entries(saved.local)) localStorage.setItem(k, v);
+        for (const [k, v] of Object.entries(saved.session)) sessionStorage.setItem(k, v);
+    } catch (e) {}
+})();
+"""
+
+# کاندیداهای انتخابگر برای هر عنصر منطقی؛ برنده‌ی آخر در SelectorRegistry اول امتحان می‌شود
+SELECTOR_CANDIDATES = {
+    "search_icon": [
+        ("css", "li[data-cy='search-menu-icon']"),
+        ("xpath", "//li[contains(@class, 'search') or contains(@data-cy, 'search')]"),
+    ],
+    "search_input": [
+        ("css", "#searchInputControl"),
+        ("css", "input[type='search'], input[placeholder*='جستجو'], input[name='search']"),
+    ],
+    "stock_result": [
+        ("xpath", "//div[contains(@data-cy, 'search-item-name') and contains(., '{stock_name}')] | //div[contains(text(), '{stock_name}') and ancestor::div[contains(@class, 'search-result')]]"),
+        ("css", "div[data-cy='search-item-name-{stock_name}']"),
+    ],
+    "action_button": [
+        ("css", "button[data-cy='order-{action}-btn']"),
+        ("css", "button.btn-outline-{color}"),
+    ],
+    "quantity_input": [
+        ("css", "order-form-value[data-cy='order-form-quantity'] input[data-cy='custom-number-box-input-quantity']"),
+        ("css", "input[data-cy='custom-number-box-input-quantity']"),
+        ("css", "input[id='quantity']"),
+        ("css", "input[name='quantity']"),
+    ],
+    "max_price_button": [("css", "div[data-cy='order-form-max-price']")],
+    "min_price_button": [("css", "div[data-cy='order-form-min-price']")],
+    "price_input": [
+        ("css", "custom-number-box input[data-cy='custom-number-box-input-price']"),
+        ("css", "input[id*='price'], input[data-cy*='price']"),
+    ],
+    "submit_button": [
+        ("css", "button.btn-sm.btn-{color}"),
+        ("xpath", "//button[contains(@class, 'btn-sm') and (contains(., 'ارسال {verb}') or contains(., '{action_title}')) and contains(@class, 'btn-{color}')]"),
+    ],
+}
+selector_registry = SelectorRegistry(SELECTOR_CANDIDATES)
+
+# پر کردن کامل فرم سفارش در یک اسکریپت؛ هر مرحله با کاندیداهای انتخابگر خودش تا پیدا شدن عنصر صبر می‌کند
+# arguments: [steps, timeout_ms, done_callback]
+JS_ORDER_FORM_MACRO = """
+const steps = arguments[0];
+const timeoutMs = arguments[1];
+const done = arguments[arguments.length - 1];
+const started = performance.now();
+const report = {ok: false, steps: [], elapsedMs: 0};
+const valueSetter = Object.getOwnPropertyDescriptor(HTMLInputElement.prototype, 'value').set;
+
+function resolve(candidates, needClickable) {
+    for (const c of candidates) {
+        let el = null;
+        try {
+            el = c.kind === 'xpath'
+                ? document.evaluate(c.selector, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue
+                : document.querySelector(c.selector);
+        } catch (e) { continue; }
+        if (!el) continue;
+        if (needClickable && (el.getClientRects().length === 0 || el.disabled)) continue;
+        return [c, el];
+    }
+    return null;
+}
+
+function runStep(i) {
+    if (i >= steps.length) {
+        report.ok = true;
+        report.elapsedMs = performance.now() - started;
+        return done(report);
+    }
+    const step = steps[i];
+    const stepStarted = performance.now();
+    (function attempt() {
+        const match = resolve(step.candidates, step.op === 'click');
+        if (!match) {
+            if (performance.now() - started > timeoutMs) {
+                report.steps.push({name: step.name, op: step.op, ok: false, error: 'element not found'});
+                report.elapsedMs = performance.now() - started;
+                return done(report);
+            }
+            return setTimeout(attempt, 16);
+        }
+        const [candidate, el] = match;
+        const entry = {name: step.name, op: step.op, ok: true, selector: candidate.selector, candidateIndex: candidate.index};
+        try {
+            if (step.op === 'click') {
+                el.click();
+            } else {
+                el.focus();
+                valueSetter.call(el, '');
+                el.dispatchEvent(new Event('input', {bubbles: true}));
+                valueSetter.call(el, step.value);
+                el.dispatchEvent(new Event('input', {bubbles: true}));
+                el.dispatchEvent(new Event('change', {bubbles: true}));
+                el.dispatchEvent(new Event('blur'));
+                entry.finalValue = el.value;
+            }
+        } catch (e) {
+            entry.ok = false;
+            entry.error = String(e);
+        }
+        entry.elapsedMs = performance.now() - stepStarted;
+        report.steps.push(entry);
+        if (!entry.ok) {
+            report.elapsedMs = performance.now() - started;
+            return done(report);
+        }
+        // یک چرخه فرصت برای رندر واکنشی فرم (مثلاً ظاهر شدن فیلدها پس از کلیک خرید/فروش)؛
+        // از requestAnimationFrame استفاده نمی‌شود چون در تب‌های پس‌زمینه متوقف می‌شود
+        setTimeout(() => runStep(i + 1), 0);
+    })();
+}
+
+runStep(0);
+"""
+
+# چرخه stage/arm/fire برای سفارش‌های زمان‌دار و سرخطی
+STAGE_PROBE_INTERVAL_SECONDS = float(os.environ.get("MOFID_STAGE_PROBE_INTERVAL", 5))
+STAGE_FINAL_GUARD_SECONDS = 1.5  # در این بازه‌ی پایانی دیگر بررسی/آماده‌سازی مجدد انجام نمی‌شود
+MAX_RESTAGES = 5
+
+# arguments: [submit_button, quantity_candidates, price_candidates, band_candidates]
+JS_STAGE_PROBE = """
+const submit = arguments[0];
+function first(candidates) {
+    for (const c of candidates) {
+        try {
+            const el = c.kind === 'xpath'
+                ? document.evaluate(c.selector, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue
+                : document.querySelector(c.selector);
+            if (el) return el;
+        } catch (e) {}
+    }
+    return null;
+}
+const quantity = first(arguments[1]);
+const price = first(arguments[2]);
+const band = first(arguments[3]);
+return {
+    submitAttached: !!submit && submit.isConnected,
+    submitEnabled: !!submit && !submit.disabled && submit.getClientRects().length > 0,
+    quantityValue: quantity ? quantity.value : null,
+    priceValue: price ? price.value : null,
+    bandText: band ? band.textContent : null,
+    loginFormVisible: !!document.getElementById('user-name'),
+};
+"""
+
+PERSIAN_DIGITS = str.maketrans("۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩", "01234567890123456789")
+
+
+def normalize_number(text):
+    """'۱۲,۳۴۵' / '12,345.0' -> 12345.0; None if the text has no number."""
+    if text is None:
+        return None
+    cleaned = "".join(ch for ch in str(text).translate(PERSIAN_DIGITS) if ch.isdigit() or ch == ".")
+    try:
+        return float(cleaned) if cleaned else None
+    except ValueError:
+        return None
+
+
+# یک عدد با جداکننده هزارگان اختیاری (, یا ٬) و اعشار اختیاری؛ عدد چسبیده به ٪ یا % قیمت نیست
+PRICE_TOKEN_PATTERN = re.compile(r"\d{1,3}(?:[,٬]\d{3})+(?:[.٫]\d+)?(?!\s*[%٪\d])|\d+(?:[.٫]\d+)?(?!\s*[%٪\d,٬])")
+
+
+def parse_price_token(text):
+    """
+    The price in a max/min button label ('سقف ۱۲,۳۴۵ (+۵٪)' -> 12345.0): the last number with
+    thousands separators, else the last plain number that is not a percentage. None if there is none.
+    """
+    if text is None:
+        return None
+    tokens = PRICE_TOKEN_PATTERN.findall(str(text).translate(PERSIAN_DIGITS))
+    grouped = [token for token in tokens if "," in token or "٬" in token]
+    token = (grouped or tokens or [None])[-1]
+    if token is None:
+        return None
+    return float(re.sub(r"[,٬]", "", token).replace("٫", "."))
+
+
+BURST_DURATION_SECONDS = 20  # مدت زمان ارسال سریع
+SUCCESS_MESSAGE_KEYWORD = "هسته معاملات ثبت گردید"
+NOTIFY_MESSAGE_SELECTOR = "span[data-cy='notify-message']"
+AFTER_SUCCESS_MODES = ("stop", "trickle", "continue")  # رفتار حلقه ارسال پس از دیدن پیام ثبت در هسته
+TRICKLE_RATE_PER_SECOND = 2
+
+# ناظر DOM روی پیام‌های کارگزار؛ هر پیام با زمان دقیق (epoch ms) در window.__sarNotify ثبت می‌شود
+# arguments: [notify_selector, success_keyword]
+JS_NOTIFY_OBSERVER = """
+const selector = arguments[0];
+const keyword = arguments[1];
+if (window.__sarNotify && window.__sarNotify.observer) window.__sarNotify.observer.disconnect();
+const clock = () => performance.timeOrigin + performance.now();
+const store = {messages: [], acceptedAt: null, seen: new WeakMap(), observer: null};
+
+function record(el) {
+    const text = (el.textContent || '').trim();
+    if (!text || store.seen.get(el) === text) return;
+    store.seen.set(el, text);
+    const at = clock();
+    store.messages.push({text: text, at: at});
+    if (store.acceptedAt === null && text.includes(keyword)) store.acceptedAt = at;
+}
+
+function scan(node) {
+    if (node.nodeType === Node.TEXT_NODE) node = node.parentElement;
+    if (!node || node.nodeType !== Node.ELEMENT_NODE) return;
+    const owner = node.closest(selector);
+    if (owner) { record(owner); return; }
+    node.querySelectorAll(selector).forEach(record);
+}
+
+store.observer = new MutationObserver((mutations) => {
+    for (const m of mutations) {
+        if (m.type === 'characterData') scan(m.target);
+        else m.addedNodes.forEach(scan);
+    }
+});
+store.observer.observe(document.body, {childList: true, subtree: true, characterData: true});
+document.querySelectorAll(selector).forEach((el) => store.seen.set(el, (el.textContent || '').trim()));  // پیام‌های قدیمی حساب نمی‌شوند
+window.__sarNotify = store;
+"""
+
+# جمع‌آوری پیام‌های ثبت‌شده توسط ناظر و قطع آن
+JS_NOTIFY_COLLECT = """
+const store = window.__sarNotify;
+if (!store) return null;
+if (store.observer) store.observer.disconnect();
+return {messages: store.messages, acceptedAt: store.acceptedAt};
+"""
+
+# جدول تاریخچه سفارشات؛ انتخابگرها به ترتیب اولویت امتحان می‌شوند و همه به کامپوننت تاریخچه محدودند
+# (یک `table` خالی در لیست انتخابگر، اولین جدول صفحه یعنی جدول دیده‌بان را برمی‌گرداند)
+HISTORY_TABLE_SELECTORS = ("[data-cy*='order-history'] table", "app-order-history table")
+HISTORY_LOADING_SELECTOR = ", ".join(f"{scope} {indicator}"
+                                     for scope in ("[data-cy*='order-history']", "app-order-history")
+                                     for indicator in ("[class*='loading']", "[class*='spinner']"))
+HISTORY_SETTLE_QUIET_MS = 300
+HISTORY_SETTLE_TIMEOUT_SECONDS = 10  # فقط سقف است؛ با رسیدن پاسخ فیلتر زودتر برمی‌گردد
+
+# امضای جدول تاریخچه پیش از کلیک «اعمال فیلتر»؛ جدول فعلی علامت می‌خورد تا جایگزینی آن توسط Angular دیده شود
+# arguments: [selectors] -> "rowCount|text" یا null (جدولی نیست)
+JS_HISTORY_TABLE_SNAPSHOT = """
+const table = arguments[0].map((s) => document.querySelector(s)).find((t) => t) || null;
+if (!table) return null;
+table.__sarHistorySnapshot = true;
+const body = table.tBodies[0] || table;
+return body.querySelectorAll('tr').length + '|' + (body.textContent || '').replace(/\\s+/g, ' ').trim();
+"""
+
+# منتظر پاسخ فیلتر می‌ماند: نشانگر بارگذاری ناپدید شود و جدول عوض شده باشد (نشانگر دیده شده، جدول جایگزین شده
+# یا تعداد/متن ردیف‌ها با امضای قبل از کلیک فرق کند)؛ فقط پس از آن quietMs بدون تغییر در خود جدول لازم است.
+# جدول در هر تغییر دوباره پیدا می‌شود، پس جایگزین شدن آن ناظر را کور نمی‌کند.
+# arguments: [selectors, beforeSignature, loadingSelector, quietMs, timeoutMs, callback] -> true (بارگذاری شد) / false
+JS_WAIT_HISTORY_TABLE_RELOAD = """
+const done = arguments[arguments.length - 1];
+const selectors = arguments[0], before = arguments[1], loadingSelector = arguments[2];
+const quietMs = arguments[3], timeoutMs = arguments[4];
+const findTable = () => selectors.map((s) => document.querySelector(s)).find((t) => t) || null;
+const signature = (t) => {
+    const body = t.tBodies[0] || t;
+    return body.querySelectorAll('tr').length + '|' + (body.textContent || '').replace(/\\s+/g, ' ').trim();
+};
+const isLoading = () => Array.from(document.querySelectorAll(loadingSelector)).some((el) => el.offsetParent !== null);
+let loadingSeen = false, table = null, quietTimer = null;
+const reloaded = () => {
+    const loading = isLoading();
+    if (loading) loadingSeen = true;
+    table = findTable();
+    if (!table || loading) return false;
+    return loadingSeen || !table.__sarHistorySnapshot || signature(table) !== before;
+};
+const finish = (loaded) => { observer.disconnect(); clearTimeout(quietTimer); clearTimeout(deadline); done(loaded); };
+const restartQuiet = () => { clearTimeout(quietTimer); quietTimer = setTimeout(() => finish(true), quietMs); };
+const observer = new MutationObserver((mutations) => {
+    const previous = table;
+    if (!reloaded()) { clearTimeout(quietTimer); quietTimer = null; return; }
+    if (quietTimer === null || table !== previous || mutations.some((m) => table.contains(m.target))) restartQuiet();
+});
+observer.observe(document.body, {childList: true, subtree: true, characterData: true, attributes: true});
+if (reloaded()) restartQuiet();
+const deadline = setTimeout(() => finish(false), timeoutMs);
+"""
+
+# متن سرستون‌ها و سلول‌های جدول تاریخچه در یک فراخوانی (بدون خروجی اکسل و دانلود)
+# arguments: [selectors به ترتیب اولویت] -> {headers: [...], rows: [[...], ...]} یا null
+JS_SCRAPE_TABLE = """
+const table = arguments[0].map((s) => document.querySelector(s)).find((t) => t) || null;
+if (!table) return null;
+const cellText = (cell) => (cell.innerText || cell.textContent || '').replace(/\\s+/g, ' ').trim();
+const headers = Array.from(table.querySelectorAll('thead th')).map(cellText);
+const rows = Array.from(table.querySelectorAll('tbody tr'))
+    .map((tr) => Array.from(tr.querySelectorAll('td')).map(cellText))
+    .filter((cells) => cells.length > 0);
+return {headers: headers, rows: rows};
+"""
+
+# کلیک تکی مسیر webdriver؛ زمان پذیرش را در همان رفت‌وبرگشت برمی‌گرداند
+JS_CLICK_AND_POLL = "arguments[0].click(); return window.__sarNotify ? window.__sarNotify.acceptedAt : null;"
+
+# حلقه‌ی کلیک خودزمان‌بند داخل صفحه؛ پایتون فقط آن را مسلح کرده و نتیجه را تحویل می‌گیرد.
+# arguments: [submit_button, config, done_callback]
+JS_BURST_ENGINE = """
+const button = arguments[0];
+const cfg = arguments[1];
+const done = arguments[arguments.length - 1];
+const clock = () => performance.timeOrigin + performance.now();
+const state = {clicks: 0, errors: 0, timestamps: [], firstSuccessAt: null, startedAt: clock(), endedAt: null, stoppedBy: null};
+window.__sarBurst = state;
+
+let target = button;
+let intervalMs = cfg.ratePerSecond > 0 ? 1000 / cfg.ratePerSecond : 0;
+const deadline = performance.now() + cfg.durationMs;
+let nextClickAt = performance.now();
+const channel = new MessageChannel();
+
+function successSeen() {
+    if (window.__sarNotify) return window.__sarNotify.acceptedAt;
+    if (state.clicks % cfg.successCheckEvery !== 0) return null;
+    for (const el of document.querySelectorAll(cfg.notifySelector)) {
+        if ((el.textContent || '').includes(cfg.successKeyword)) return clock();
+    }
+    return null;
+}
+
+function finish(reason) {
+    state.stoppedBy = reason;
+    state.endedAt = clock();
+    channel.port1.onmessage = null;
+    done(state);
+}
+
+function tick() {
+    const t = performance.now();
+    if (t >= deadline) return finish('duration');
+    if (cfg.maxClicks > 0 && state.clicks >= cfg.maxClicks) return finish('max_clicks');
+    if (state.firstSuccessAt === null) {
+        const acceptedAt = successSeen();
+        if (acceptedAt) {
+            state.firstSuccessAt = acceptedAt;
+            if (cfg.afterSuccess === 'stop') return finish('success');
+            if (cfg.afterSuccess === 'trickle') {
+                intervalMs = 1000 / cfg.trickleRatePerSecond;
+                nextClickAt = t + intervalMs;
+            }
+        }
+    }
+    if (t >= nextClickAt) {
+        if (!target.isConnected && cfg.submitSelector) {
+            target = document.querySelector(cfg.submitSelector) || target;
+        }
+        try {
+            target.click();
+            state.clicks++;
+            if (state.timestamps.length < cfg.maxTimestamps) state.timestamps.push(clock());
+        } catch (e) {
+            state.errors++;
+        }
+        nextClickAt = intervalMs > 0 ? nextClickAt + intervalMs : t;
+    }
+    const wait = nextClickAt - performance.now();
+    // setTimeout زیر ۴ میلی‌ثانیه محدود می‌شود؛ برای نرخ بالا از MessageChannel استفاده می‌کنیم
+    if (wait >= 4) setTimeout(tick, wait);
+    else channel.port2.postMessage(0);
+}
+
+channel.port1.onmessage = tick;
+tick();
+"""
+
+
+# آرگومان‌های کروم؛ هم برای کروم اختصاصی هر کاربر و هم برای کروم مشترک استفاده می‌شود
+CHROME_ARGUMENTS = (
+    # --- Essential Headless Mode Options ---
+    "--headless",
+    "--no-sandbox",
+    "--disable-dev-shm-usage",
+    # --- Performance & Resource Optimization Options ---
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disable-infobars",
+    "--disable-popup-blocking",
+    "--disable-notifications",
+    "--disable-logging",
+    "--log-level=3",
+    "--silent",
+    "--blink-settings=imagesEnabled=false",
+    # --- Stability & Compatibility Options ---
+    "--window-size=1920,1080",
+    "user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "--disable-blink-features=AutomationControlled",
+)
+
+# --- Attempt to mask WebDriver presence ---
+STEALTH_SCRIPT = """
+    Object.defineProperty(navigator, 'webdriver', {
+        get: () => undefined
+    });
+    Object.defineProperty(navigator, 'languages', {
+        get: () => ['en-US', 'en']
+    });
+    Object.defineProperty(navigator, 'plugins', {
+        get: () => [1, 2, 3, 4, 5]
+    });
+"""
+
+
+def enable_network_logging(chrome_options):
+    """Network events (CDP) for order-submit tracking."""
+    chrome_options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    chrome_options.add_experimental_option("perfLoggingPrefs", {"enableNetwork": True, "enablePage": False})
+    return chrome_options
+
+
+def create_chrome_driver(download_dir):
+    """Launch a headless Chrome WebDriver with the bot's options, download dir, network logging and stealth script."""
+    chrome_options = Options()
+    for argument in CHROME_ARGUMENTS:
+        chrome_options.add_argument(argument)
+    chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
+
+    # --- Download Preferences ---
+    prefs = {
+        "download.default_directory": download_dir,
+        "download.prompt_for_download": False,
+        "download.directory_upgrade": True,
+        "safeBrowse.enabled": True  # Keep safeBrowse enabled for security unless it causes issues
+    }
+    chrome_options.add_experimental_option("prefs", prefs)
+    enable_network_logging(chrome_options)
+
+    driver = webdriver.Chrome(options=chrome_options)
+    driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": STEALTH_SCRIPT})
+    return driver
+
+
+def attached_driver_options():
+    """Options for a chromedriver attached to the shared Chrome (launch-time options do not apply there)."""
+    return enable_network_logging(Options())
+
+
+_driver_pool = None
+_driver_pool_lock = threading.Lock()
+
+
+def get_driver_pool():
+    """Process-wide pool of pre-warmed drivers (size from MOFID_DRIVER_POOL_SIZE, 0 disables it)."""
+    global _driver_pool
+    with _driver_pool_lock:
+        if _driver_pool is None:
+            # پوشه دانلود هنگام تحویل درایور به هر نشست با CDP به پوشه‌ی همان نشست تغییر می‌کند
+            os.makedirs(DOWNLOAD_ROOT, exist_ok=True)
+            _driver_pool = DriverPool(
+                factory=lambda: create_chrome_driver(DOWNLOAD_ROOT),
+                size=DRIVER_POOL_SIZE,
+                warm_url=MOFID_LOGIN_URL,
+                wipe_origins=MOFID_ORIGINS,
+            )
+        return _driver_pool
 
 
 class MofidBroker:
-    def __init__(self):
+    def __init__(self, session_id=None):
         self.driver = None # باید توسط setup_driver مقداردهی شود
+        self.network_tracker = None # ردیابی درخواست‌های ثبت سفارش از طریق لاگ شبکه کروم
+        self.driver_prewarmed = False # True یعنی درایور از استخر آمده و روی صفحه ورود منتظر است
+        self.browser_context_id = None # فقط در حالت کروم مشترک مقدار دارد
         self.logs = []
         self.submission_logs = []
-        # دایرکتوری برای دانلود فایل‌های اکسل تعریف و ایجاد می‌شود
-        self.download_dir = os.path.join(os.getcwd(), "temp_mofid_downloads")
+        # دایرکتوری اختصاصی این نشست برای دانلود فایل‌های اکسل (با release_driver حذف می‌شود)
+        self.session_id = session_id or uuid.uuid4().hex
+        self.download_dir = os.path.join(DOWNLOAD_ROOT, self.session_id)
         os.makedirs(self.download_dir, exist_ok=True)
         
         # این بخش برای اجرای مستقل کد اضافه شده، در کد اصلی شما نیاز نیست
@@ -33,57 +541,29 @@ class MofidBroker:
         tehran_tz = pytz.timezone('Asia/Tehran')
 
     def setup_driver(self, headless=True):  # Changed default to True for headless
-        """Initialize and return a Chrome WebDriver with optimized settings for headless operation."""
+        """Take a pre-warmed driver from the pool if one is idle, otherwise cold-start Chrome."""
         try:
-            chrome_options = Options()
-            # --- Essential Headless Mode Options ---
-            chrome_options.add_argument("--headless")
-            chrome_options.add_argument("--no-sandbox")
-            chrome_options.add_argument("--disable-dev-shm-usage")
-
-            # --- Performance & Resource Optimization Options ---
-            chrome_options.add_argument("--disable-gpu")
-            chrome_options.add_argument("--disable-extensions")
-            chrome_options.add_argument("--disable-infobars")
-            chrome_options.add_argument("--disable-popup-blocking")
-            chrome_options.add_argument("--disable-notifications")
-            chrome_options.add_argument("--disable-logging")
-            chrome_options.add_argument("--log-level=3")
-            chrome_options.add_argument("--silent")
-            chrome_options.add_argument("--blink-settings=imagesEnabled=false")
-
-            # --- Stability & Compatibility Options ---
-            chrome_options.add_argument("--window-size=1920,1080")
-            chrome_options.add_argument("user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
-            chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
-            chrome_options.add_argument("--disable-blink-features=AutomationControlled")
-
-            # --- Download Preferences ---
-            prefs = {
-                "download.default_directory": self.download_dir,
-                "download.prompt_for_download": False,
-                "download.directory_upgrade": True,
-                "safeBrowse.enabled": True  # Keep safeBrowse enabled for security unless it causes issues
-            }
-            chrome_options.add_experimental_option("prefs", prefs)
-
-            self.driver = webdriver.Chrome(options=chrome_options)
-            
-            # --- Attempt to mask WebDriver presence ---
-            self.driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {
-                "source": """
-                    Object.defineProperty(navigator, 'webdriver', {
-                        get: () => undefined
-                    });
-                    Object.defineProperty(navigator, 'languages', {
-                        get: () => ['en-US', 'en']
-                    });
-                    Object.defineProperty(navigator, 'plugins', {
-                        get: () => [1, 2, 3, 4, 5]
-                    });
-                """
-            })
-            logger.info(f"WebDriver setup complete. Download directory set to: {self.download_dir}")
+            os.makedirs(self.download_dir, exist_ok=True)
+            if BROWSER_BACKEND == "shared":
+                self.driver, self.browser_context_id = get_shared_browser(CHROME_ARGUMENTS).open_context(
+                    self.download_dir, attached_driver_options)
+                self.driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": STEALTH_SCRIPT})
+                self.driver_prewarmed = False
+                self.network_tracker = OrderNetworkTracker(self.driver)
+                logger.info(f"WebDriver attached to shared Chrome context {self.browser_context_id}.")
+                return True
+            pooled_driver = get_driver_pool().acquire()
+            if pooled_driver is not None:
+                self.driver = pooled_driver
+                self.driver_prewarmed = True
+                self.driver.execute_cdp_cmd("Browser.setDownloadBehavior", {
+                    "behavior": "allow", "downloadPath": self.download_dir, "eventsEnabled": False})
+                logger.info("WebDriver taken from pre-warmed pool.")
+            else:
+                self.driver = create_chrome_driver(self.download_dir)
+                self.driver_prewarmed = False
+                logger.info(f"WebDriver setup complete. Download directory set to: {self.download_dir}")
+            self.network_tracker = OrderNetworkTracker(self.driver)
             return True
         except WebDriverException as e:
             print(f"Error setting up WebDriver: {e}")
@@ -92,89 +572,51 @@ class MofidBroker:
             print(f"An unexpected error occurred during WebDriver setup: {e}")
             return False
 
+    def release_driver(self):
+        """Hand the driver back to the pool (recycled after a wipe when safe, otherwise quit)."""
+        if self.driver:
+            if self.browser_context_id:
+                get_shared_browser().close_context(self.driver, self.browser_context_id)
+                self.browser_context_id = None
+            else:
+                get_driver_pool().release(self.driver)
+            self.driver = None
+            self.network_tracker = None
+            self.driver_prewarmed = False
+        self.cleanup_download_dir()
+
+    def cleanup_download_dir(self):
+        """Delete this session's download directory (recreated by setup_driver on the next login)."""
+        shutil.rmtree(self.download_dir, ignore_errors=True)
+
+    def own_window_handles(self):
+        """Window handles of this session only (in shared-Chrome mode other users' tabs are visible to chromedriver)."""
+        if self.browser_context_id:
+            return get_shared_browser().context_window_handles(self.browser_context_id)
+        return self.driver.window_handles
 
     def get_order_history_excel(self, stock_name, order_action_persian, order_status_filter_value="1: 1", download_timeout=45): # مقدار پیش‌فرض برای "همه"
+        """Open the history view for one symbol/side and export it with one status filter; returns the file path or None."""
+        return self.get_order_history_exports(stock_name, order_action_persian, (order_status_filter_value,), download_timeout)[order_status_filter_value]
+
+    def get_order_history_exports(self, stock_name, order_action_persian, status_filter_values=("1: 1", "0: 0"), download_timeout=45):
+        """
+        Open the history view and apply symbol and side once, then switch only the status filter
+        between exports. Returns {status_filter_value: file path or None}.
+        """
+        exports = {value: None for value in status_filter_values}
         if not self.driver:
             logger.error("Driver not initialized for get_order_history_excel.")
             self.add_log("خطا: درایور برای دریافت تاریخچه سفارشات مقداردهی نشده است.", "error")
-            return None
-        
+            return exports
+
         try:
-            status_description = "همه وضعیت‌ها"
-            if order_status_filter_value == "0: 0":
-                status_description = "بدون خطا"
-            
-            logger.info(f"Starting order history Excel retrieval for stock: {stock_name}, action: {order_action_persian}, status_filter: {status_description}")
-            self.add_log(f"شروع دریافت تاریخچه سفارشات (اکسل) برای نماد: {stock_name}, نوع: {order_action_persian}, وضعیت: {status_description}", "info")
-
-            # Step 1: Click "Order History" icon
-            logger.info("Clicking Order History icon...")
-            history_icon_selector = "li[data-cy='order-history-menu-icon']"
-            history_icon = self.wait_for_element(By.CSS_SELECTOR, history_icon_selector, timeout=15)
-            self.driver.execute_script("arguments[0].click();", history_icon) 
-            self.add_log("آیکون تاریخچه سفارشات کلیک شد", "info")
-            time.sleep(1.5) 
-
-            # Step 2: Fill stock symbol
-            self.wait_for_element(By.XPATH, "//button[normalize-space()='اعمال فیلتر']", timeout=10) 
-            logger.info(f"Entering stock symbol: {stock_name}...")
-            search_input_selector = "input[data-cy='layout-search-input']"
-            stock_input_field = self.wait_for_element(By.CSS_SELECTOR, search_input_selector, timeout=10)
-            stock_input_field.clear()
-            stock_input_field.send_keys(stock_name)
-            self.add_log(f"نماد '{stock_name}' در فیلد جستجو وارد شد", "info")
-            time.sleep(2.5) 
-
-            # Step 3: Click stock symbol from list
-            logger.info(f"Selecting '{stock_name}' from results...")
-            clickable_stock_xpath = f"//div[@data-cy='search-symbol-item'][.//span[@class='fw-bold' and normalize-space(text())='{stock_name}']]//div[contains(@class, 'cup')]"
-            stock_element_in_list = self.wait_for_element(By.XPATH, clickable_stock_xpath, timeout=10)
-            WebDriverWait(self.driver, 10).until(EC.element_to_be_clickable((By.XPATH, clickable_stock_xpath)))
-            stock_element_in_list.click()
-            self.add_log(f"نماد '{stock_name}' از لیست نتایج انتخاب شد", "info")
-            time.sleep(0.5)
-
-            # Step 4: Select order side
-            logger.info(f"Selecting order side: {order_action_persian}...")
-            order_side_select_elem = self.wait_for_element(By.ID, "orderSide", timeout=5)
-            order_side_select = Select(order_side_select_elem)
-            if order_action_persian == "خرید":
-                order_side_select.select_by_value("1: 0") # Buy
-            elif order_action_persian == "فروش":
-                order_side_select.select_by_value("2: 1") # Sell
-            self.add_log(f"سمت سفارش '{order_action_persian}' انتخاب شد", "info")
-            time.sleep(0.5)
-
-            # Step 5: Select status based on order_status_filter_value
-            logger.info(f"Selecting status with filter value: '{order_status_filter_value}' ({status_description})...")
-            status_select_elem = self.wait_for_element(By.ID, "states", timeout=5)
-            status_select = Select(status_select_elem)
-            try:
-                status_select.select_by_value(order_status_filter_value)
-                self.add_log(f"وضعیت سفارشات '{status_description}' (value: {order_status_filter_value}) انتخاب شد", "info")
-            except Exception as e_status_select:
-                logger.error(f"Could not select status with value '{order_status_filter_value}'. Defaulting to 'همه'. Error: {e_status_select}")
-                self.add_log(f"خطا در انتخاب وضعیت '{status_description}'. انتخاب پیش‌فرض 'همه'. خطا: {e_status_select}", "warning")
-                status_select.select_by_value("1: 1") # Fallback to "همه"
-                self.add_log("وضعیت سفارشات 'همه' (پیش‌فرض پس از خطا) انتخاب شد", "info")
-            time.sleep(0.5)
-
-            # Step 6: Date selection is REMOVED as per user request
-            self.add_log("مرحله انتخاب تاریخ (فیلتر تاریخ) طبق درخواست حذف شد.", "info")
-            logger.info("Date selection (Step 6) has been removed.")
-
-            # Step 7: Click "اعمال فیلتر" button
-            logger.info("Clicking 'اعمال فیلتر' button...")
-            apply_filter_button_xpath = "//button[normalize-space()='اعمال فیلتر' and @type='submit']"
-            apply_filter_button = WebDriverWait(self.driver,15).until(
-                EC.element_to_be_clickable((By.XPATH, apply_filter_button_xpath))
-            )
-            self.driver.execute_script("arguments[0].click();", apply_filter_button)
-            self.add_log("دکمه 'اعمال فیلتر' کلیک شد", "info")
-            time.sleep(3.5) # Wait for table to load/update based on other filters
+            logger.info(f"Starting order history Excel retrieval for stock: {stock_name}, action: {order_action_persian}, status_filters: {list(status_filter_values)}")
+            self.add_log(f"شروع دریافت تاریخچه سفارشات (اکسل) برای نماد: {stock_name}, نوع: {order_action_persian}", "info")
+            self._open_order_history(stock_name, order_action_persian)
 
-            # Step 8: Click "Export to Excel" and handle download
-            logger.info("Preparing to download Excel file...")
+            # پوشه مخصوص همین نشست است؛ پاک کردن فایل‌های قبلی روی خروجی کاربران دیگر اثری ندارد
+            os.makedirs(self.download_dir, exist_ok=True)
             for pattern in ["*.xlsx", "*.xls", "*.crdownload"]:
                 for old_file in glob.glob(os.path.join(self.download_dir, pattern)):
                     try: 
@@ -182,74 +624,10 @@ class MofidBroker:
                         logger.info(f"Removed old/partial file: {old_file}")
                     except OSError as e:
                         logger.warning(f"Could not remove old/partial file {old_file}: {e}")
-            
-            files_before = set(os.listdir(self.download_dir))
-            logger.info(f"Files in download dir before Excel export click ('{self.download_dir}'): {files_before}")
 
-            export_icon_xpath = "//svg-icon[@title='خروجی اکسل']" 
-            self.add_log(f"جستجو برای آیکون خروجی اکسل: {export_icon_xpath}", "debug")
-            
-            export_button_element = WebDriverWait(self.driver, 20).until(
-                EC.element_to_be_clickable((By.XPATH, export_icon_xpath))
-            )
-            self.add_log("آیکون خروجی اکسل پیدا و قابل کلیک است.", "info")
-            
-            self.driver.execute_script("arguments[0].scrollIntoView({block: 'center', inline: 'center'});", export_button_element)
-            time.sleep(0.3)
-            self.driver.execute_script("arguments[0].click();", export_button_element) 
-            self.add_log("آیکون 'خروجی اکسل' کلیک شد.", "info")
-            
-            time.sleep(2.0) 
-
-            start_time = time.time()
-            downloaded_file_path = None
-            self.add_log(f"Monitoring download directory: {self.download_dir} for {download_timeout}s", "debug")
-
-            while time.time() - start_time < download_timeout:
-                current_files_in_dir = os.listdir(self.download_dir)
-                logger.debug(f"Files currently in download dir: {current_files_in_dir}")
-                files_after = set(current_files_in_dir)
-                new_files = files_after - files_before
-                
-                if new_files:
-                    logger.info(f"New items detected in download dir: {new_files}")
-                    for new_file_name in new_files:
-                        if new_file_name.lower().endswith(('.xlsx', '.xls')) and not new_file_name.lower().endswith('.crdownload'):
-                            full_path = os.path.join(self.download_dir, new_file_name)
-                            try:
-                                if os.path.exists(full_path):
-                                    initial_size = os.path.getsize(full_path)
-                                    if initial_size > 0: 
-                                        time.sleep(1.0) 
-                                        if os.path.exists(full_path) and os.path.getsize(full_path) == initial_size:
-                                            downloaded_file_path = full_path
-                                            self.add_log(f"فایل اکسل '{new_file_name}' (size: {initial_size} bytes) دانلود و تایید شد.", "success")
-                                            logger.info(f"Excel file downloaded and confirmed: {downloaded_file_path}")
-                                            break
-                                        else:
-                                            logger.debug(f"File '{new_file_name}' size changed or file disappeared, still writing/transient...")
-                                    else: 
-                                        logger.debug(f"Detected Excel file '{new_file_name}' but size is 0, waiting...")
-                                else: 
-                                     logger.debug(f"File '{new_file_name}' detected in dir listing but os.path.exists is false.")        
-                            except FileNotFoundError:
-                                logger.debug(f"File '{new_file_name}' was detected but then disappeared (possibly temp file before rename).")
-                                continue 
-                        elif new_file_name.lower().endswith('.crdownload'):
-                            logger.debug(f"Download in progress: {new_file_name}")
-                    if downloaded_file_path:
-                        break 
-                time.sleep(1.5) 
-            
-            if not downloaded_file_path:
-                self.add_log(f"فایل اکسل در زمان {download_timeout} ثانیه دانلود نشد.", "error")
-                logger.error(f"Excel download timed out. Monitored directory: {self.download_dir}")
-                final_files_in_dir = os.listdir(self.download_dir)
-                logger.error(f"Files present at timeout: {final_files_in_dir}")
-                self.driver.save_screenshot(f"excel_download_timeout_{stock_name}_{int(time.time())}.png")
-                return None
-            self.add_log("فرآیند دانلود اکسل تکمیل شد.", "info")
-            return downloaded_file_path
+            for order_status_filter_value in status_filter_values:
+                exports[order_status_filter_value] = self._export_order_history(stock_name, order_status_filter_value, download_timeout)
+            return exports
 
         except TimeoutException as e:
             logger.error(f"TimeoutException during order history retrieval for {stock_name}: {e}", exc_info=True)
@@ -258,7 +636,7 @@ class MofidBroker:
                 self.driver.save_screenshot(f"history_timeout_{stock_name}_{int(time.time())}.png")
             except Exception as ex_ss:
                  logger.error(f"Could not save screenshot on TimeoutException: {ex_ss}")
-            return None
+            return exports
         except Exception as e:
             logger.error(f"An error occurred during order history retrieval for {stock_name}: {e}", exc_info=True) 
             self.add_log(f"خطا در دریافت تاریخچه سفارشات برای {stock_name}: {type(e).__name__} - {str(e)[:100]}", "error")
@@ -266,8 +644,154 @@ class MofidBroker:
                 self.driver.save_screenshot(f"history_error_{stock_name}_{int(time.time())}.png")
             except Exception as ex_ss:
                 logger.error(f"Could not save screenshot on Exception: {ex_ss}")
+            return exports
+
+    def _open_order_history(self, stock_name, order_action_persian):
+        """Steps 1-4: open the order history view and filter it by symbol and side."""
+        # Step 1: Click "Order History" icon
+        logger.info("Clicking Order History icon...")
+        history_icon_selector = "li[data-cy='order-history-menu-icon']"
+        history_icon = self.wait_for_element(By.CSS_SELECTOR, history_icon_selector, timeout=15)
+        self.driver.execute_script("arguments[0].click();", history_icon) 
+        self.add_log("آیکون تاریخچه سفارشات کلیک شد", "info")
+
+        # Step 2: Fill stock symbol (the filter form being rendered is the signal that the view opened)
+        self.wait_for_element(By.XPATH, "//button[normalize-space()='اعمال فیلتر']", timeout=10) 
+        logger.info(f"Entering stock symbol: {stock_name}...")
+        search_input_selector = "input[data-cy='layout-search-input']"
+        stock_input_field = self.wait_for_element(By.CSS_SELECTOR, search_input_selector, timeout=10)
+        stock_input_field.clear()
+        stock_input_field.send_keys(stock_name)
+        self.add_log(f"نماد '{stock_name}' در فیلد جستجو وارد شد", "info")
+
+        # Step 3: Click stock symbol from list (waits for the search result itself instead of a fixed pause)
+        logger.info(f"Selecting '{stock_name}' from results...")
+        clickable_stock_xpath = f"//div[@data-cy='search-symbol-item'][.//span[@class='fw-bold' and normalize-space(text())='{stock_name}']]//div[contains(@class, 'cup')]"
+        stock_element_in_list = WebDriverWait(self.driver, 10, poll_frequency=0.1).until(
+            EC.element_to_be_clickable((By.XPATH, clickable_stock_xpath))
+        )
+        stock_element_in_list.click()
+        self.add_log(f"نماد '{stock_name}' از لیست نتایج انتخاب شد", "info")
+
+        # Step 4: Select order side
+        logger.info(f"Selecting order side: {order_action_persian}...")
+        order_side_select_elem = self.wait_for_element(By.ID, "orderSide", timeout=5)
+        order_side_select = Select(order_side_select_elem)
+        if order_action_persian == "خرید":
+            order_side_select.select_by_value("1: 0") # Buy
+        elif order_action_persian == "فروش":
+            order_side_select.select_by_value("2: 1") # Sell
+        self.add_log(f"سمت سفارش '{order_action_persian}' انتخاب شد", "info")
+
+        # Step 6: Date selection is REMOVED as per user request
+        logger.info("Date selection (Step 6) has been removed.")
+
+    def get_order_history_table(self, stock_name, order_action_persian, order_status_filter_value="1: 1"):
+        """
+        Read the filtered history table straight from the DOM in one script call (no export/download).
+        Returns {"headers": [...], "rows": [[...], ...]} or None.
+        """
+        if not self.driver:
+            logger.error("Driver not initialized for get_order_history_table.")
+            self.add_log("خطا: درایور برای دریافت تاریخچه سفارشات مقداردهی نشده است.", "error")
+            return None
+        try:
+            self.add_log(f"شروع خواندن جدول تاریخچه سفارشات برای نماد: {stock_name}, نوع: {order_action_persian}", "info")
+            self._open_order_history(stock_name, order_action_persian)
+            _, loaded = self._apply_history_status_filter(order_status_filter_value)
+            if not loaded:
+                # جدول قبلی یا نیمه‌کاره خوانده نمی‌شود؛ خلاصه و زمان پیش‌دستی از آن غلط درمی‌آیند
+                self.add_log("جدول تاریخچه پس از اعمال فیلتر بارگذاری نشد؛ خوانده نشد.", "warning")
+                return None
+            table = self.driver.execute_script(JS_SCRAPE_TABLE, list(HISTORY_TABLE_SELECTORS))
+            if not table:
+                self.add_log("جدول تاریخچه سفارشات در صفحه یافت نشد.", "warning")
+                return None
+            self.add_log(f"جدول تاریخچه خوانده شد: {len(table['rows'])} ردیف", "success")
+            return table
+        except Exception as e:
+            logger.error(f"An error occurred while reading the order history table for {stock_name}: {e}", exc_info=True)
+            self.add_log(f"خطا در خواندن جدول تاریخچه سفارشات برای {stock_name}: {type(e).__name__} - {str(e)[:100]}", "error")
+            try:
+                self.driver.save_screenshot(f"history_table_error_{stock_name}_{int(time.time())}.png")
+            except Exception as ex_ss:
+                logger.error(f"Could not save screenshot on Exception: {ex_ss}")
             return None
 
+    def _apply_history_status_filter(self, order_status_filter_value):
+        """
+        Steps 5 and 7: set the status filter, apply it and wait for the table to reload.
+        Returns (status description, whether the filtered table was seen to load).
+        """
+        status_description = "همه وضعیت‌ها"
+        if order_status_filter_value == "0: 0":
+            status_description = "بدون خطا"
+
+        # Step 5: Select status based on order_status_filter_value
+        logger.info(f"Selecting status with filter value: '{order_status_filter_value}' ({status_description})...")
+        status_select_elem = self.wait_for_element(By.ID, "states", timeout=5)
+        status_select = Select(status_select_elem)
+        try:
+            status_select.select_by_value(order_status_filter_value)
+            self.add_log(f"وضعیت سفارشات '{status_description}' (value: {order_status_filter_value}) انتخاب شد", "info")
+        except Exception as e_status_select:
+            logger.error(f"Could not select status with value '{order_status_filter_value}'. Defaulting to 'همه'. Error: {e_status_select}")
+            self.add_log(f"خطا در انتخاب وضعیت '{status_description}'. انتخاب پیش‌فرض 'همه'. خطا: {e_status_select}", "warning")
+            status_select.select_by_value("1: 1") # Fallback to "همه"
+            self.add_log("وضعیت سفارشات 'همه' (پیش‌فرض پس از خطا) انتخاب شد", "info")
+
+        # Step 7: Click "اعمال فیلتر" button
+        logger.info("Clicking 'اعمال فیلتر' button...")
+        apply_filter_button_xpath = "//button[normalize-space()='اعمال فیلتر' and @type='submit']"
+        apply_filter_button = WebDriverWait(self.driver,15).until(
+            EC.element_to_be_clickable((By.XPATH, apply_filter_button_xpath))
+        )
+        before_signature = self.driver.execute_script(JS_HISTORY_TABLE_SNAPSHOT, list(HISTORY_TABLE_SELECTORS))
+        self.driver.execute_script("arguments[0].click();", apply_filter_button)
+        self.add_log("دکمه 'اعمال فیلتر' کلیک شد", "info")
+        loaded = self._wait_history_table_reload(before_signature)
+        return status_description, loaded
+
+    def _export_order_history(self, stock_name, order_status_filter_value, download_timeout):
+        """Steps 5, 7, 8 on an already opened history view: set the status filter, apply it and download the Excel file."""
+        # خروجی اکسل را خود سرور با فیلتر اعمال‌شده می‌سازد، پس نبود نشانه‌ی بارگذاری جدول مانع آن نیست
+        status_description, _ = self._apply_history_status_filter(order_status_filter_value)
+
+        # Step 8: Click "Export to Excel" and handle download
+        logger.info("Preparing to download Excel file...")
+        export_icon_xpath = "//svg-icon[@title='خروجی اکسل']" 
+        self.add_log(f"جستجو برای آیکون خروجی اکسل: {export_icon_xpath}", "debug")
+        
+        export_button_element = WebDriverWait(self.driver, 20, poll_frequency=0.1).until(
+            EC.element_to_be_clickable((By.XPATH, export_icon_xpath))
+        )
+        self.add_log("آیکون خروجی اکسل پیدا و قابل کلیک است.", "info")
+
+        # پوشه قبل از کلیک زیر نظر گرفته می‌شود تا اتمام دانلود (تغییر نام crdownload به نام نهایی) فوراً دیده شود
+        with DownloadWatcher(self.download_dir) as download_watcher:
+            self.driver.execute_script("arguments[0].scrollIntoView({block: 'center', inline: 'center'}); arguments[0].click();", export_button_element)
+            self.add_log("آیکون 'خروجی اکسل' کلیک شد.", "info")
+            self.add_log(f"Monitoring download directory: {self.download_dir} for {download_timeout}s", "debug")
+            download_started = time.perf_counter()
+            downloaded_file_path = download_watcher.wait(download_timeout)
+
+        if not downloaded_file_path:
+            self.add_log(f"فایل اکسل ({status_description}) در زمان {download_timeout} ثانیه دانلود نشد.", "error")
+            logger.error(f"Excel download timed out. Monitored directory: {self.download_dir}")
+            final_files_in_dir = os.listdir(self.download_dir)
+            logger.error(f"Files present at timeout: {final_files_in_dir}")
+            self.driver.save_screenshot(f"excel_download_timeout_{stock_name}_{int(time.time())}.png")
+            return None
+
+        # نام یکتا بر اساس فیلتر وضعیت، تا خروجی بعدی (که ممکن است همان نام را داشته باشد) آن را بازنویسی نکند
+        root, extension = os.path.splitext(downloaded_file_path)
+        tagged_path = f"{root}_{order_status_filter_value.replace(': ', '_')}{extension}"
+        os.replace(downloaded_file_path, tagged_path)
+        self.add_log(f"فایل اکسل '{os.path.basename(tagged_path)}' (size: {os.path.getsize(tagged_path)} bytes) "
+                     f"پس از {time.perf_counter() - download_started:.2f} ثانیه دانلود و تایید شد.", "success")
+        logger.info(f"Excel file downloaded and confirmed: {tagged_path}")
+        return tagged_path
+
     def click_watchlist_tab(self): #Fix shode
         """
         Clicks on the 'Watchlist' (دیده‌بان) tab to ensure the UI is in the correct state
@@ -326,6 +850,29 @@ class MofidBroker:
             return False
 
 
+    def _wait_armed_order(self, armed_order):
+        """
+        Wait for the firing scheduler to release the order, bounded by its target time plus a margin.
+        If the scheduler never releases it, fire anyway: a late order beats a driver thread blocked forever.
+        """
+        outcome = armed_order.wait_until_due()
+        if outcome == "timed_out":
+            self.add_log(f"زمان‌بند مرکزی سفارش را آزاد نکرد؛ ارسال با {armed_order.wake_jitter * 1000:.0f} میلی‌ثانیه تاخیر انجام می‌شود.", "error")
+        return outcome
+
+    def _wait_history_table_reload(self, before_signature, timeout_seconds=HISTORY_SETTLE_TIMEOUT_SECONDS):
+        """Block until the history table answered the filter and then stayed quiet; False if that never happened."""
+        self.driver.set_script_timeout(timeout_seconds + 5)
+        try:
+            loaded = self.driver.execute_async_script(JS_WAIT_HISTORY_TABLE_RELOAD, list(HISTORY_TABLE_SELECTORS),
+                                                      before_signature, HISTORY_LOADING_SELECTOR,
+                                                      HISTORY_SETTLE_QUIET_MS, int(timeout_seconds * 1000))
+        finally:
+            self.driver.set_script_timeout(30)
+        if not loaded:
+            logger.warning(f"Order history table did not reload within {timeout_seconds}s of applying the filter.")
+        return bool(loaded)
+
     def wait_for_element(self, by, value, timeout=10, retries=5):
         """Wait for an element to be present with retry logic."""
         for attempt in range(retries):
@@ -346,19 +893,94 @@ class MofidBroker:
                     raise
                 time.sleep(0.5) # Pause before retrying
 
-    def login_to_website(self, username, password):
-        """Automate login process for the website."""
+    def export_session_state(self):
+        """Cookies (all domains) plus local/session storage of the current page, for BrokerSessionStore."""
+        if not self.driver:
+            return None
+        try:
+            cookies = self.driver.execute_cdp_cmd("Network.getAllCookies", {}).get("cookies", [])
+            storage = self.driver.execute_script(JS_EXPORT_STORAGE)
+            return {"cookies": cookies, "origin": storage["origin"],
+                    "local_storage": storage["local"], "session_storage": storage["session"]}
+        except Exception as e:
+            logger.warning(f"Could not export broker session state: {e}")
+            return None
+
+    def restore_session(self, state, validation_timeout=10):
+        """
+        Load a saved session into the current driver and open the platform once.
+        Returns True if the broker accepted the session (logged-in UI appeared), False if it showed the login form.
+        """
+        seed_script_id = None
+        try:
+            cookies = [{key: value for key, value in cookie.items() if key in COOKIE_PARAM_KEYS}
+                       for cookie in state.get("cookies", [])]
+            if cookies:
+                self.driver.execute_cdp_cmd("Network.setCookies", {"cookies": cookies})
+            # storage باید قبل از اجرای اسکریپت‌های سایت پر شود
+            seed_script_id = self.driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {
+                "source": JS_SEED_STORAGE_TEMPLATE % json.dumps({
+                    "origin": state.get("origin"),
+                    "local": state.get("local_storage") or {},
+                    "session": state.get("session_storage") or {},
+                })
+            }).get("identifier")
+            self.driver.get(MOFID_LOGIN_URL)
+            logged_in_marker = WebDriverWait(self.driver, validation_timeout).until(
+                EC.any_of(
+                    EC.presence_of_element_located((By.CSS_SELECTOR, LOGGED_IN_MARKER_SELECTOR)),
+                    EC.presence_of_element_located((By.ID, "user-name")),
+                )
+            )
+            if logged_in_marker.get_attribute("id") == "user-name":
+                self.add_log("نشست ذخیره‌شده توسط کارگزاری پذیرفته نشد؛ ورود کامل انجام می‌شود", "warning")
+                return False
+            self.add_log("نشست ذخیره‌شده بازیابی شد؛ ورود بدون فرم انجام شد", "success")
+            return True
+        except TimeoutException:
+            self.add_log("اعتبار نشست ذخیره‌شده در زمان مقرر تأیید نشد؛ ورود کامل انجام می‌شود", "warning")
+            return False
+        except Exception as e:
+            logger.warning(f"Restoring broker session failed: {e}")
+            self.add_log(f"بازیابی نشست ذخیره‌شده ناموفق بود: {str(e)[:100]}", "warning")
+            return False
+        finally:
+            if seed_script_id:
+                try:
+                    self.driver.execute_cdp_cmd("Page.removeScriptToEvaluateOnNewDocument", {"identifier": seed_script_id})
+                except Exception:
+                    pass
+
+    def find_element(self, key, timeout=10, clickable=False, **params):
+        """Resolve a logical element through the shared SelectorRegistry. Returns (element, (kind, selector))."""
+        return selector_registry.find(self.driver, key, timeout=timeout, clickable=clickable, **params)
+
+    def login_to_website(self, username, password, session_state=None):
+        """Automate login process for the website. A saved session_state is tried first and the form is only used if it is rejected."""
         try:
             # Step 1: Set up driver
             if not self.setup_driver(headless=True): # یا False برای مشاهده عملکرد
                 self.add_log("خطا در مقداردهی اولیه WebDriver", "error")
                 raise Exception("Failed to initialize WebDriver")
 
-            # Step 2: Navigate to the website
-            url = "https://d.easytrader.ir/"
-            logger.info(f"Navigating to {url}")
-            self.driver.get(url)
-            self.add_log(f"در حال ناوبری به {url}", "info")
+            # Step 1.1: Try the saved session before filling the form
+            if session_state:
+                if self.restore_session(session_state):
+                    logger.info("Login completed from saved session")
+                    return True
+                try:
+                    self.driver.execute_cdp_cmd("Network.clearBrowserCookies", {})
+                except Exception:
+                    pass
+
+            # Step 2: Navigate to the website (skipped when the pooled driver is already parked there)
+            url = MOFID_LOGIN_URL
+            if self.driver_prewarmed and self.driver.current_url.startswith(url):
+                self.add_log("درایور آماده از قبل روی صفحه ورود است", "info")
+            else:
+                logger.info(f"Navigating to {url}")
+                self.driver.get(url)
+                self.add_log(f"در حال ناوبری به {url}", "info")
 
             # Step 3: Use provided username and password
             logger.info("Locating username field")
@@ -435,30 +1057,14 @@ class MofidBroker:
 
             # Step 2: Click the search icon
             logger.info("Locating search icon")
-            try:
-                search_icon = self.wait_for_element(By.CSS_SELECTOR, "li[data-cy='search-menu-icon']")
-                WebDriverWait(self.driver, 10).until(EC.element_to_be_clickable((By.CSS_SELECTOR, "li[data-cy='search-menu-icon']")))
-            except TimeoutException:
-                logger.warning("Primary search icon selector failed, trying fallback")
-                self.add_log("انتخابگر اصلی آیکون جستجو ناموفق بود، تلاش با انتخابگر جایگزین", "warning")
-                search_icon = self.wait_for_element(By.XPATH, "//li[contains(@class, 'search') or contains(@data-cy, 'search')]")
-                WebDriverWait(self.driver, 10).until(EC.element_to_be_clickable((By.XPATH, "//li[contains(@class, 'search') or contains(@data-cy, 'search')]")))
+            search_icon, _ = self.find_element("search_icon", clickable=True)
             search_icon.click()
             logger.info("Search icon clicked")
             self.add_log("آیکون جستجو کلیک شد", "info")
 
             # Step 3: Enter stock name in search input
             logger.info("Locating search input field")
-            try:
-                self.wait_for_element(By.TAG_NAME, "body") # اطمینان از بارگذاری صفحه
-                time.sleep(1) # انتظار کوتاه برای اطمینان از آمادگی فیلد جستجو
-                search_input = self.wait_for_element(By.ID, "searchInputControl")
-                WebDriverWait(self.driver, 10).until(EC.element_to_be_clickable((By.ID, "searchInputControl")))
-            except TimeoutException:
-                logger.warning("Primary search input selector failed, trying fallback")
-                self.add_log("انتخابگر اصلی فیلد جستجو ناموفق بود، تلاش با انتخابگر جایگزین", "warning")
-                search_input = self.wait_for_element(By.CSS_SELECTOR, "input[type='search'], input[placeholder*='جستجو'], input[name='search']")
-                WebDriverWait(self.driver, 10).until(EC.element_to_be_clickable((By.CSS_SELECTOR, "input[type='search'], input[placeholder*='جستجو'], input[name='search']")))
+            search_input, _ = self.find_element("search_input", clickable=True)
             search_input.clear()
             search_input.send_keys(stock_name)
             logger.info(f"Stock name '{stock_name}' entered")
@@ -466,17 +1072,7 @@ class MofidBroker:
             
             # Step 4: Click the stock from search results
             logger.info(f"Locating search result for stock: {stock_name}")
-            try:
-                # استفاده از یک XPath انعطاف‌پذیرتر برای پیدا کردن نماد در نتایج
-                stock_result_xpath = f"//div[contains(@data-cy, 'search-item-name') and contains(., '{stock_name}')] | //div[contains(text(), '{stock_name}') and ancestor::div[contains(@class, 'search-result')]]"
-                stock_result = self.wait_for_element(By.XPATH, stock_result_xpath)
-                WebDriverWait(self.driver, 10).until(EC.element_to_be_clickable((By.XPATH, stock_result_xpath)))
-            except TimeoutException:
-                logger.warning(f"Primary stock result selector failed, trying specific data-cy")
-                self.add_log(f"انتخابگر اصلی نتیجه جستجوی نماد '{stock_name}' ناموفق بود.", "warning")
-                # تلاش با سلکتور قبلی به عنوان جایگزین نهایی
-                stock_result = self.wait_for_element(By.CSS_SELECTOR, f"div[data-cy='search-item-name-{stock_name}']")
-                WebDriverWait(self.driver, 10).until(EC.element_to_be_clickable((By.CSS_SELECTOR, f"div[data-cy='search-item-name-{stock_name}']")))
+            stock_result, _ = self.find_element("stock_result", clickable=True, stock_name=stock_name)
 
             stock_result.click()
             logger.info(f"Stock '{stock_name}' selected from results")
@@ -498,40 +1094,226 @@ class MofidBroker:
             self.add_log(f"خطا در جستجوی نماد: {str(e)}", "error")
             raise
 
-    def place_order(self, action, quantity, price_option, custom_price=None, send_option="now", scheduled_time_str=None):
+    def _install_notify_observer(self):
+        """Start recording broker notify messages (with epoch-ms timestamps) before the burst."""
+        try:
+            self.driver.execute_script(JS_NOTIFY_OBSERVER, NOTIFY_MESSAGE_SELECTOR, SUCCESS_MESSAGE_KEYWORD)
+            return True
+        except Exception as e:
+            self.add_log(f"نصب ناظر پیام‌های کارگزار ناموفق بود: {str(e)[:100]}", "warning")
+            return False
+
+    def _collect_notify_messages(self):
+        """Disconnect the observer and return {"messages": [{"text", "at"}], "acceptedAt"} or None."""
+        try:
+            return self.driver.execute_script(JS_NOTIFY_COLLECT)
+        except Exception as e:
+            self.add_log(f"خواندن پیام‌های ثبت‌شده توسط ناظر ناموفق بود: {str(e)[:100]}", "warning")
+            return None
+
+    def _run_js_burst(self, submit_button, submit_selector, duration_seconds, rate_per_second=None, after_success="stop", max_clicks=0):
+        """
+        Inject the self-timed click loop (JS_BURST_ENGINE) into the page and block on its result.
+        The Python thread only waits on the chromedriver socket while the browser does the clicking.
+        """
+        config = {
+            "durationMs": int(duration_seconds * 1000),
+            "ratePerSecond": rate_per_second or 0,
+            "afterSuccess": after_success,
+            "trickleRatePerSecond": TRICKLE_RATE_PER_SECOND,
+            "successKeyword": SUCCESS_MESSAGE_KEYWORD,
+            "notifySelector": NOTIFY_MESSAGE_SELECTOR,
+            "successCheckEvery": 10,
+            "submitSelector": submit_selector,
+            "maxClicks": max_clicks,
+            "maxTimestamps": 5000,
+        }
+        self.driver.set_script_timeout(duration_seconds + 10)
+        try:
+            report = self.driver.execute_async_script(JS_BURST_ENGINE, submit_button, config)
+        finally:
+            self.driver.set_script_timeout(30)
+        return report or {}
+
+    def _fill_order_form_webdriver(self, action, action_color, quantity, price_option, custom_price):
+        """Fill the order form step by step through WebDriver (one round-trip per interaction)."""
+        logger.info(f"Locating {action} button")
+        # دکمه خرید یا فروش
+        action_button, _ = self.find_element("action_button", clickable=True, action=action, color=action_color)
+        action_button.click()
+        logger.info(f"{action.capitalize()} button clicked")
+        self.add_log(f"دکمه {action.capitalize()} کلیک شد", "info")
+
+        logger.info("Locating quantity input field")
+        try:
+            quantity_input, (_, quantity_selector) = self.find_element("quantity_input", timeout=8)
+            self.add_log(f"فیلد تعداد با سلکتور '{quantity_selector}' پیدا شد", "info")
+        except TimeoutException:
+            self.add_log("خطا: فیلد تعداد پیدا نشد پس از تمام تلاش‌ها", "error")
+            raise TimeoutException("Quantity input field not found after all attempts")
+
+        try:
+            quantity_input.clear()
+            quantity_input.send_keys(str(quantity))
+            self.add_log(f"تعداد {quantity} با موفقیت وارد شد", "info")
+        except Exception as e:
+            self.add_log(f"خطا در وارد کردن تعداد: {str(e)}", "error")
+            raise
+
+        # انتخاب گزینه قیمت
+        if price_option == 'max':
+            logger.info("Locating maximum price button")
+            max_price_button, _ = self.find_element("max_price_button", clickable=True)
+            max_price_button.click()
+            self.add_log("قیمت حداکثر انتخاب شد", "info")
+        elif price_option == 'min':
+            logger.info("Locating minimum price button")
+            min_price_button, _ = self.find_element("min_price_button", clickable=True)
+            min_price_button.click()
+            self.add_log("قیمت حداقل انتخاب شد", "info")
+        else: # custom price
+            logger.info("Locating custom price input field")
+            price_input, _ = self.find_element("price_input")
+            price_input.clear()
+            price_input.send_keys(str(custom_price))
+            self.add_log(f"قیمت سفارشی '{custom_price}' وارد شد", "info")
+
+    def _fill_order_form_macro(self, action, action_color, quantity, price_option, custom_price, timeout=8):
+        """
+        Fill the whole order form in one injected script (JS_ORDER_FORM_MACRO): click action,
+        set quantity/price through the native value setter with input/change events, click price buttons.
+        Returns True if every step succeeded; the step report goes to the logs either way.
+        """
+        steps = [
+            {"name": "action_button", "op": "click", "candidates": self._macro_candidates("action_button", action=action, color=action_color)},
+            {"name": "quantity_input", "op": "set", "value": str(quantity), "candidates": self._macro_candidates("quantity_input")},
+        ]
+        if price_option == 'max':
+            steps.append({"name": "max_price_button", "op": "click", "candidates": self._macro_candidates("max_price_button")})
+        elif price_option == 'min':
+            steps.append({"name": "min_price_button", "op": "click", "candidates": self._macro_candidates("min_price_button")})
+        else:
+            price_text = str(int(custom_price)) if float(custom_price).is_integer() else str(custom_price)
+            steps.append({"name": "price_input", "op": "set", "value": price_text, "candidates": self._macro_candidates("price_input")})
+
+        self.driver.set_script_timeout(timeout + 5)
+        try:
+            report = self.driver.execute_async_script(JS_ORDER_FORM_MACRO, steps, int(timeout * 1000))
+        except Exception as e:
+            self.add_log(f"خطا در اجرای ماکرو فرم سفارش: {str(e)[:100]}", "error")
+            return False
+        finally:
+            self.driver.set_script_timeout(30)
+
+        for step in report.get("steps", []):
+            if step.get("ok"):
+                selector_registry.record(step["name"], step["candidateIndex"])
+                self.add_log(f"ماکرو: {step['name']} ({step['op']}) با '{step['selector']}' در {step['elapsedMs']:.1f}ms"
+                             + (f" مقدار نهایی: {step.get('finalValue')}" if step["op"] == "set" else ""), "info")
+            else:
+                self.add_log(f"ماکرو: مرحله {step['name']} ناموفق بود: {step.get('error')}", "warning")
+        self.add_log(f"ماکرو فرم سفارش در {report.get('elapsedMs', 0):.1f}ms اجرا شد (موفق: {report.get('ok')})", "info")
+        return bool(report.get("ok"))
+
+    def _stage_order(self, action, action_color, quantity, price_option, custom_price, form_mode):
+        """Fill the order form and locate the submit button. Returns (submit_button, submit_css_selector or None)."""
+        form_filled = False
+        if form_mode == "macro":
+            form_filled = self._fill_order_form_macro(action, action_color, quantity, price_option, custom_price)
+            if not form_filled:
+                self.add_log("پر کردن فرم با ماکرو ناموفق بود؛ استفاده از مسیر WebDriver", "warning")
+        if not form_filled:
+            self._fill_order_form_webdriver(action, action_color, quantity, price_option, custom_price)
+
+        logger.info(f"Locating {action} submit button for burst")
+        # دکمه ارسال نهایی (خرید/فروش)
+        submit_button, (submit_kind, submit_selector) = self.find_element(
+            "submit_button", clickable=True, color=action_color,
+            verb='خرید' if action == 'buy' else 'فروش', action_title=action.capitalize())
+        if submit_kind != "css":
+            submit_selector = None  # موتور JS فقط با انتخابگر CSS دکمه را دوباره پیدا می‌کند
+        self.add_log("دکمه ارسال برای حلقه سریع آماده است.", "info")
+        return submit_button, submit_selector
+
+    def _probe_staged_order(self, submit_button, quantity, price_option, custom_price):
+        """
+        One cheap script checking that the staged form is still fireable.
+        Returns a list of problems (empty = ready): stale_submit, submit_disabled,
+        quantity_changed, price_changed, price_band_changed, session_lost.
+        """
+        band_key = {"max": "max_price_button", "min": "min_price_button"}.get(price_option)
+        try:
+            state = self.driver.execute_script(
+                JS_STAGE_PROBE, submit_button,
+                self._macro_candidates("quantity_input"),
+                self._macro_candidates("price_input"),
+                self._macro_candidates(band_key) if band_key else [],
+            )
+        except StaleElementReferenceException:
+            return ["stale_submit"]
+        except Exception as e:
+            logger.warning(f"Stage probe failed: {e}")
+            return ["probe_failed"]
+
+        problems = []
+        if state.get("loginFormVisible"):
+            problems.append("session_lost")
+        if not state.get("submitAttached"):
+            problems.append("stale_submit")
+        elif not state.get("submitEnabled"):
+            problems.append("submit_disabled")
+        if normalize_number(state.get("quantityValue")) != float(quantity):
+            problems.append("quantity_changed")
+        price_value = normalize_number(state.get("priceValue"))
+        if price_option == "custom":
+            if price_value != float(custom_price):
+                problems.append("price_changed")
+        else:
+            # فقط عدد قیمت در متن دکمه؛ برچسب‌ها یا درصد تغییر کنار آن نباید در عدد ادغام شوند
+            band_value = parse_price_token(state.get("bandText"))
+            # سقف/کف مجاز روز عوض شده و قیمت فرم دیگر روی آن نیست
+            if band_value is not None and price_value is not None and band_value != price_value:
+                problems.append("price_band_changed")
+        return problems
+
+    @staticmethod
+    def _macro_candidates(key, **params):
+        """Registry candidates (learned winner first) in the shape JS_ORDER_FORM_MACRO expects."""
+        return [{"index": index, "kind": kind, "selector": selector} for index, kind, selector in selector_registry.ordered(key, **params)]
+
+    def place_order(self, action, quantity, price_option, custom_price=None, send_option="now", scheduled_time_str=None,
+                    burst_mode="webdriver", burst_rate_per_second=None, burst_duration_seconds=BURST_DURATION_SECONDS, after_success="stop",
+                    form_mode="webdriver"):
         """
         Handle buy/sell action, quantity, price selection, scheduling,
         and ultra-fast burst submit with no artificial rate limiting.
         Logging and message checking are minimized during the burst loop for maximum speed.
+
+        burst_mode="webdriver" clicks via one WebDriver round-trip per click;
+        burst_mode="js" injects JS_BURST_ENGINE so the browser clicks at burst_rate_per_second
+        (None = as fast as possible).
+        A MutationObserver records every broker message during the burst; once the success keyword
+        appears the burst stops (after_success="stop"), drops to TRICKLE_RATE_PER_SECOND ("trickle")
+        or keeps going ("continue").
+
+        form_mode="macro" fills the form in one injected script and falls back to the
+        step-by-step WebDriver path ("webdriver") if any macro step fails.
         """
         try:
             # پاک کردن لاگ‌های قبلی برای این فراخوانی خاص (اختیاری)
             # self.logs = []
             # self.submission_logs = []
             self.add_log(f"شروع فرآیند سفارش: {action.capitalize()} برای تعداد {quantity}", "info")
+            fire_timing = {}
 
             action = action.strip().lower()
             if action not in ['buy', 'sell']:
                 self.add_log(f"عملیات نامعتبر: {action}. باید 'buy' یا 'sell' باشد.", "error")
                 raise ValueError("Action must be 'buy' or 'sell'")
 
-            logger.info(f"Locating {action} button")
-            # انتخابگر دکمه خرید یا فروش
-            button_selector = f"button[data-cy='order-{action}-btn']"
-            try:
-                action_button = self.wait_for_element(By.CSS_SELECTOR, button_selector)
-            except TimeoutException:
-                self.add_log(f"انتخابگر اصلی دکمه {action} ناموفق بود، تلاش با انتخابگر جایگزین.", "warning")
-                button_selector_fallback = f"button.btn-outline-{'success' if action == 'buy' else 'danger'}"
-                action_button = self.wait_for_element(By.CSS_SELECTOR, button_selector_fallback)
-                button_selector = button_selector_fallback
-
-            WebDriverWait(self.driver, 10).until(EC.element_to_be_clickable((By.CSS_SELECTOR, button_selector)))
-            action_button.click()
-            logger.info(f"{action.capitalize()} button clicked")
-            self.add_log(f"دکمه {action.capitalize()} کلیک شد", "info")
+            action_color = 'success' if action == 'buy' else 'danger'
 
-            # اعتبارسنجی و وارد کردن تعداد
+            # اعتبارسنجی تعداد و قیمت قبل از هر تعامل با فرم
             try:
                 quantity = int(quantity)
                 if quantity <= 0:
@@ -540,54 +1322,11 @@ class MofidBroker:
                 self.add_log(f"تعداد نامعتبر: {quantity}. {e}", "error")
                 raise ValueError("Quantity must be a positive integer")
 
-            logger.info("Locating quantity input field")
-            quantity_input = None
-            selectors = [
-                "order-form-value[data-cy='order-form-quantity'] input[data-cy='custom-number-box-input-quantity']",
-                "input[data-cy='custom-number-box-input-quantity']",
-                "input[id='quantity']", "input[name='quantity']"
-            ]
-            for idx, selector in enumerate(selectors):
-                try:
-                    quantity_input = self.wait_for_element(By.CSS_SELECTOR, selector, timeout=2) # کاهش timeout برای سرعت
-                    self.add_log(f"فیلد تعداد با سلکتور '{selector}' پیدا شد", "info")
-                    break
-                except TimeoutException:
-                    self.add_log(f"فیلد تعداد با سلکتور '{selector}' پیدا نشد (تلاش {idx+1}/{len(selectors)})", "warning")
-            
-            if not quantity_input:
-                self.add_log("خطا: فیلد تعداد پیدا نشد پس از تمام تلاش‌ها", "error")
-                raise TimeoutException("Quantity input field not found after all attempts")
-
-            try:
-                quantity_input.clear()
-                # time.sleep(0.1) # حذف یا کاهش شدید تاخیر
-                quantity_input.send_keys(str(quantity))
-                # time.sleep(0.2) # حذف یا کاهش شدید تاخیر
-                self.add_log(f"تعداد {quantity} با موفقیت وارد شد", "info")
-            except Exception as e:
-                self.add_log(f"خطا در وارد کردن تعداد: {str(e)}", "error")
-                raise
-
-            # انتخاب گزینه قیمت
             price_option = price_option.strip().lower()
             if price_option not in ['max', 'min', 'custom']:
                 self.add_log(f"گزینه قیمت نامعتبر: {price_option}", "error")
                 raise ValueError("Price option must be 'max', 'min', or 'custom'")
-
-            if price_option == 'max':
-                logger.info("Locating maximum price button")
-                max_price_button = self.wait_for_element(By.CSS_SELECTOR, "div[data-cy='order-form-max-price']")
-                WebDriverWait(self.driver, 10).until(EC.element_to_be_clickable((By.CSS_SELECTOR, "div[data-cy='order-form-max-price']")))
-                max_price_button.click()
-                self.add_log("قیمت حداکثر انتخاب شد", "info")
-            elif price_option == 'min':
-                logger.info("Locating minimum price button")
-                min_price_button = self.wait_for_element(By.CSS_SELECTOR, "div[data-cy='order-form-min-price']")
-                WebDriverWait(self.driver, 10).until(EC.element_to_be_clickable((By.CSS_SELECTOR, "div[data-cy='order-form-min-price']")))
-                min_price_button.click()
-                self.add_log("قیمت حداقل انتخاب شد", "info")
-            else: # custom price
+            if price_option == 'custom':
                 try:
                     custom_price = float(custom_price)
                     if custom_price <= 0:
@@ -595,20 +1334,10 @@ class MofidBroker:
                 except (ValueError, TypeError) as e:
                     self.add_log(f"قیمت سفارشی نامعتبر: {custom_price}. {e}", "error")
                     raise ValueError("Custom price must be a positive number")
-                
-                logger.info("Locating custom price input field")
-                price_input_selector = "custom-number-box input[data-cy='custom-number-box-input-price']"
-                try:
-                    price_input = self.wait_for_element(By.CSS_SELECTOR, price_input_selector)
-                except TimeoutException:
-                    self.add_log(f"انتخابگر اصلی قیمت '{price_input_selector}' ناموفق بود، تلاش با جایگزین.", "warning")
-                    price_input_selector = "input[id*='price'], input[data-cy*='price']" # انتخابگر جایگزین
-                    price_input = self.wait_for_element(By.CSS_SELECTOR, price_input_selector)
 
-                price_input.clear()
-                # time.sleep(0.1) # حذف یا کاهش
-                price_input.send_keys(str(custom_price))
-                self.add_log(f"قیمت سفارشی '{custom_price}' وارد شد", "info")
+            # مرحله آماده‌سازی (stage): پر کردن فرم و پیدا کردن دکمه ارسال، قبل از هر انتظار
+            stage_args = (action, action_color, quantity, price_option, custom_price, form_mode)
+            submit_button, submit_selector = self._stage_order(*stage_args)
 
             # مدیریت زمان ارسال
             send_option = send_option.strip().lower()
@@ -621,7 +1350,12 @@ class MofidBroker:
                     self.add_log("خطا: زمانبندی انتخاب شده اما زمان ارائه نشده است.", "error")
                     raise ValueError("Scheduled time string is required for schedule option.")
                 
-                now_system = datetime.now(tehran_tz)
+                # زمان بورس = ساعت محلی + اختلاف تخمینی با ساعت کارگزاری
+                # یک تخمین برداشته می‌شود و «اکنون» و زمان هدف هر دو از همان محاسبه می‌شوند
+                broker_clock = get_broker_clock()
+                clock_estimate = broker_clock.current_estimate()
+                clock_offset = clock_estimate.offset if clock_estimate else 0.0
+                now_system = datetime.fromtimestamp(time.time() + clock_offset, tehran_tz)
                 try:
                     # پشتیبانی از فرمت با میلی‌ثانیه و بدون میلی‌ثانیه
                     if '.' in scheduled_time_str:
@@ -655,76 +1389,114 @@ class MofidBroker:
                     self.add_log(f"بات در حال انتظار برای زمان برنامه‌ریزی شده (ساعت تهران): {target_datetime.strftime('%H:%M:%S.%f')}", "info")
                     logger.info(f"Waiting for scheduled time (Tehran clock): {target_datetime.strftime('%H:%M:%S.%f')}")
 
-                    # حلقه انتظار دقیق‌تر
+                    # انتظار روی زمان‌بند مرکزی؛ بین بررسی‌های آمادگی، این نخ بدون مصرف CPU مسدود می‌ماند
+                    local_target_epoch = target_datetime.timestamp() - clock_offset
+                    if clock_estimate:
+                        self.add_log(f"اختلاف ساعت سرور با کارگزاری: {clock_estimate.offset * 1000:+.1f} میلی‌ثانیه (±{clock_estimate.uncertainty * 1000:.1f})", "info")
+                    else:
+                        self.add_log("ساعت کارگزاری هنوز کالیبره نشده؛ از ساعت سرور استفاده می‌شود", "warning")
+                    armed_order = get_firing_scheduler().arm(local_target_epoch, label=f"{action}:{scheduled_time_str}")
+                    restage_count = 0
                     while True:
-                        current_system_time = datetime.now(tehran_tz)
-                        remaining_seconds = (target_datetime - current_system_time).total_seconds()
-                        
-                        if remaining_seconds <= 0: 
+                        remaining = armed_order.target_epoch - time.time()
+                        if remaining <= STAGE_FINAL_GUARD_SECONDS:
+                            self._wait_armed_order(armed_order)
                             break
-                        
-                        # استفاده از sleep‌های بسیار کوتاه برای دقت بالا
-                        # این مقادیر ممکن است نیاز به تنظیم دقیق بر اساس سیستم داشته باشند
-                        if remaining_seconds > 0.01: # اگر بیش از 10 میلی‌ثانیه باقی مانده
-                            time.sleep(0.001) # خواب 1 میلی‌ثانیه
-                        elif remaining_seconds > 0.0001: # اگر بیش از 0.1 میلی‌ثانیه باقی مانده
-                            time.sleep(0.00001) # خواب 10 میکروثانیه
-                        # برای زمان‌های بسیار کوتاه، حلقه بدون sleep اجرا می‌شود (busy-waiting)
-                        # این کار CPU را مصرف می‌کند اما دقت زمانی را افزایش می‌دهد
+                        if armed_order.wait(timeout=min(STAGE_PROBE_INTERVAL_SECONDS, remaining - STAGE_FINAL_GUARD_SECONDS)):
+                            break
+                        # کالیبراسیون تازه‌ای رسیده (مثلاً سفارش پیش از اولین کالیبراسیون با اختلاف صفر مسلح شده بود)؛ زمان هدف اصلاح می‌شود
+                        fresh_estimate = broker_clock.current_estimate()
+                        if fresh_estimate is not None and fresh_estimate is not clock_estimate:
+                            clock_estimate, clock_offset = fresh_estimate, fresh_estimate.offset
+                            local_target_epoch = target_datetime.timestamp() - clock_offset
+                            if abs(local_target_epoch - armed_order.target_epoch) >= 0.0005:
+                                get_firing_scheduler().cancel(armed_order)
+                                armed_order = get_firing_scheduler().arm(local_target_epoch, label=f"{action}:{scheduled_time_str}")
+                                self.add_log(f"اختلاف ساعت با کارگزاری به‌روز شد: {clock_offset * 1000:+.1f} میلی‌ثانیه (±{fresh_estimate.uncertainty * 1000:.1f})؛ زمان ارسال اصلاح شد", "info")
+                            continue
+                        # بررسی ارزان آمادگی فرم (probe)؛ مشکلات قبل از زمان هدف کشف و رفع می‌شوند
+                        problems = self._probe_staged_order(submit_button, quantity, price_option, custom_price)
+                        if not problems:
+                            continue
+                        self.add_log(f"بررسی آمادگی سفارش: {', '.join(problems)}", "warning")
+                        if "session_lost" in problems:
+                            get_firing_scheduler().cancel(armed_order)
+                            raise Exception("نشست کارگزاری قبل از زمان ارسال قطع شد؛ لطفاً دوباره وارد شوید.")
+                        if restage_count >= MAX_RESTAGES:
+                            # لغو سفارش بدتر از شلیک با فرم فعلی است؛ فقط تا زمان هدف صبر می‌کنیم
+                            self.add_log(f"پس از {MAX_RESTAGES} بار آماده‌سازی مجدد، بررسی متوقف شد و با فرم فعلی ادامه می‌دهیم.", "warning")
+                            self._wait_armed_order(armed_order)
+                            break
+                        restage_count += 1
+                        self.add_log(f"آماده‌سازی مجدد فرم سفارش (مرتبه {restage_count})", "info")
+                        submit_button, submit_selector = self._stage_order(*stage_args)
+                    fire_timing = armed_order.jitter_report()
+                    fire_timing["restage_count"] = restage_count
+                    if fire_timing["release_jitter_ms"] is not None:
+                        self.add_log(f"انحراف زمان شلیک: {fire_timing['fire_jitter_ms']:+.3f} میلی‌ثانیه (آزادسازی زمان‌بند: {fire_timing['release_jitter_ms']:+.3f} میلی‌ثانیه)", "info")
+
+                # اختلاف ساعتی که برای تصمیم (انتظار یا شلیک فوری) به کار رفت، همراه نتیجه‌ی سفارش برمی‌گردد
+                if clock_estimate:
+                    fire_timing.update(clock_estimate.as_dict())
                 
                 logger.info(f"زمان برنامه‌ریزی شده {target_datetime.strftime('%H:%M:%S.%f')} فرا رسید. شروع ارسال سریع.")
                 self.add_log(f"زمان برنامه‌ریزی شده فرا رسید. شروع ارسال سریع در {datetime.now(tehran_tz).strftime('%H:%M:%S.%f')}", "info")
 
             # --- شروع حلقه ارسال سریع سفارش (بخش بهینه‌سازی شده) ---
-            logger.info(f"Locating {action} submit button for burst")
-            # انتخابگر دکمه ارسال نهایی (خرید/فروش)
-            submit_selector = f"button.btn-sm.btn-{'success' if action == 'buy' else 'danger'}"
-            try:
-                submit_button = WebDriverWait(self.driver, 5).until(
-                    EC.presence_of_element_located((By.CSS_SELECTOR, submit_selector))
-                )
-            except TimeoutException:
-                self.add_log(f"انتخابگر اصلی دکمه ارسال {action} ناموفق بود، تلاش با XPath.", "warning")
-                # انتخابگر XPath جایگزین و عمومی‌تر
-                submit_selector_xpath = f"//button[contains(@class, 'btn-sm') and (contains(., 'ارسال {('خرید' if action == 'buy' else 'فروش')}') or contains(., '{action.capitalize()}')) and contains(@class, 'btn-{'success' if action == 'buy' else 'danger'}')]"
-                submit_button = self.wait_for_element(By.XPATH, submit_selector_xpath)
-            
-            WebDriverWait(self.driver, 5).until(EC.element_to_be_clickable(submit_button))
-            self.add_log("دکمه ارسال برای حلقه سریع آماده است.", "info")
-
-            start_burst_time = time.perf_counter() # زمان شروع دقیق با perf_counter
-            burst_duration_seconds = 20  # مدت زمان ارسال سریع (مثلا 20 ثانیه)
-            
             click_count = 0
             order_successful = False
+            burst_report = {}
+            accepted_at = None  # زمان دقیق دیدن پیام ثبت در هسته (epoch ms)
+            if after_success not in AFTER_SUCCESS_MODES:
+                after_success = "stop"
+            self._install_notify_observer()
+            if self.network_tracker:
+                self.network_tracker.reset()
             # کلمه کلیدی برای تشخیص پیام موفقیت (باید با پیام واقعی کارگزاری تطابق داشته باشد)
-            success_message_keyword = "هسته معاملات ثبت گردید" 
-            
+            success_message_keyword = SUCCESS_MESSAGE_KEYWORD
+
             # لاگ شروع حلقه ارسال سریع با زمان دقیق
-            self.add_log(f"شروع حلقه ارسال سریع در {datetime.now(tehran_tz).strftime('%H:%M:%S.%f')} بدون محدودیت نرخ مصنوعی.", "info")
+            self.add_log(f"شروع حلقه ارسال سریع ({burst_mode}) در {datetime.now(tehran_tz).strftime('%H:%M:%S.%f')} بدون محدودیت نرخ مصنوعی.", "info")
             self.submission_logs.append(f"{datetime.now(tehran_tz).strftime('%H:%M:%S.%f')[:-3]}: شروع  ارسال سریع سفارشات.")
+            start_burst_time = time.perf_counter() # زمان شروع دقیق با perf_counter
+            burst_started_at = get_broker_clock().now()  # اولین کلیک به وقت بورس (برای یادگیری تاخیر پذیرش)
 
-            # حلقه اصلی ارسال سفارش با حداکثر سرعت
-            while (time.perf_counter() - start_burst_time) < burst_duration_seconds:
+            if burst_mode == "js":
                 try:
-                    # کلیک با جاوااسکریپت برای سرعت بیشتر و جلوگیری از مشکلات احتمالی کلیک استاندارد
-                    self.driver.execute_script("arguments[0].click();", submit_button)
-                    click_count += 1
-                    # لاگ‌برداری در این بخش به حداقل ممکن کاهش یافته است
-                    # می‌توان زمان هر کلیک را در یک لیست ذخیره کرد و بعدا پردازش نمود
-                    # self.submission_logs.append(f"{datetime.now(tehran_tz).strftime('%H:%M:%S.%f')[:-3]}: کلیک {click_count}")
-
+                    burst_report = self._run_js_burst(
+                        submit_button,
+                        submit_selector,
+                        burst_duration_seconds,
+                        rate_per_second=burst_rate_per_second,
+                        after_success=after_success,
+                    )
                 except Exception as e:
-                    # در صورت بروز خطا در کلیک، آن را لاگ کرده و ادامه می‌دهیم
-                    # این خطاها ممکن است به دلیل سرعت بالای ارسال باشند
                     current_error_time = datetime.now(tehran_tz).strftime("%H:%M:%S.%f")[:-3]
-                    self.submission_logs.append(f"{current_error_time}: خطا در ارسال سفارشات (تلاش {click_count}): {str(e)[:100]}") # کوتاه کردن پیام خطا
-                    # در صورت بروز خطای زیاد، شاید بهتر باشد حلقه متوقف شود یا تاخیر کوچکی ایجاد شود
-                    # اما طبق درخواست، هدف حداکثر سرعت است
-                    continue 
-                
-                # بررسی پیام موفقیت در اینجا حذف شده تا سرعت حلقه کم نشود
-                # این بررسی پس از اتمام حلقه انجام خواهد شد
+                    self.submission_logs.append(f"{current_error_time}: خطا در موتور ارسال جاوااسکریپت: {str(e)[:100]}")
+                    self.add_log(f"خطا در موتور ارسال جاوااسکریپت: {str(e)[:100]}", "error")
+                click_count = burst_report.get("clicks", 0)
+                accepted_at = burst_report.get("firstSuccessAt")
+                self.add_log(f"موتور جاوااسکریپت: {click_count} کلیک، {burst_report.get('errors', 0)} خطا، توقف به دلیل: {burst_report.get('stoppedBy')}", "info")
+            else:
+                # حلقه اصلی ارسال سفارش با حداکثر سرعت
+                while (time.perf_counter() - start_burst_time) < burst_duration_seconds:
+                    try:
+                        # کلیک با جاوااسکریپت برای سرعت بیشتر و جلوگیری از مشکلات احتمالی کلیک استاندارد
+                        # همان فراخوانی، زمان پذیرش ثبت‌شده توسط ناظر را هم برمی‌گرداند (بدون رفت‌وبرگشت اضافه)
+                        click_accepted_at = self.driver.execute_script(JS_CLICK_AND_POLL, submit_button)
+                        click_count += 1
+                        if click_accepted_at and accepted_at is None:
+                            accepted_at = click_accepted_at
+                            if after_success == "stop":
+                                break
+                        if accepted_at is not None and after_success == "trickle":
+                            time.sleep(1 / TRICKLE_RATE_PER_SECOND)
+                    except Exception as e:
+                        # در صورت بروز خطا در کلیک، آن را لاگ کرده و ادامه می‌دهیم
+                        # این خطاها ممکن است به دلیل سرعت بالای ارسال باشند
+                        current_error_time = datetime.now(tehran_tz).strftime("%H:%M:%S.%f")[:-3]
+                        self.submission_logs.append(f"{current_error_time}: خطا در ارسال سفارشات (تلاش {click_count}): {str(e)[:100]}") # کوتاه کردن پیام خطا
+                        continue 
 
             # پایان حلقه ارسال سریع
             end_burst_time = time.perf_counter()
@@ -732,45 +1504,72 @@ class MofidBroker:
             self.add_log(f"پایان حلقه ارسال سریع. کل کلیک‌ها: {click_count}. زمان سپری شده: {total_burst_duration:.4f} ثانیه.", "info")
             self.submission_logs.append(f"{datetime.now(tehran_tz).strftime('%H:%M:%S.%f')[:-3]}: پایان ارسال سفارشات . تعداد کل سفارشات ارسالی : {click_count}, مدت: {total_burst_duration:.4f}s")
 
-            # بررسی نهایی برای پیام موفقیت پس از اتمام زمان انفجار
-            # این بخش مهم است چون در طول حلقه، پیام‌ها چک نمی‌شوند
-            logger.info("بررسی نهایی برای پیام پس از اتمام زمان انفجار")
-            self.add_log("شروع بررسی نهایی پیام کارگزاری پس از اتمام حلقه ارسال.", "info")
-            try:
-                # کمی صبر برای اینکه پیام‌های احتمالی در DOM ظاهر شوند
-                time.sleep(0.5) # این زمان ممکن است نیاز به تنظیم داشته باشد
-                
-                # تلاش برای یافتن همه پیام‌های اعلان
-                message_elements = self.driver.find_elements(By.CSS_SELECTOR, "span[data-cy='notify-message']")
-                
-                if message_elements:
-                    # بررسی آخرین پیام یا همه پیام‌ها برای کلمه کلیدی موفقیت
-                    for msg_element in reversed(message_elements): # بررسی از آخرین پیام
-                        final_message = msg_element.text.strip()
-                        if final_message: # اگر پیام خالی نباشد
-                            msg_time = datetime.now(tehran_tz).strftime("%H:%M:%S.%f")[:-3]
-                            log_msg = f"{msg_time}: پیام نهایی کارگزار (پس از انفجار): {final_message}"
-                            self.submission_logs.append(log_msg)
-                            self.add_log(f"پیام نهایی پس از انفجار: {final_message}", "info")
-                            
-                            if success_message_keyword in final_message:
-                                order_successful = True
-                                self.add_log(f"موفقیت بر اساس پیام '{success_message_keyword}' تأیید شد.", "success")
-                                break # اگر پیام موفقیت پیدا شد، از حلقه خارج شو
-                    if not order_successful:
-                         self.add_log("پیام موفقیت در بررسی نهایی یافت نشد.", "warning")
-                else:
-                    self.add_log("هیچ پیام نهایی پس از ارسال سفارشاتیافت نشد.", "warning")
-                    self.submission_logs.append(f"{datetime.now(tehran_tz).strftime('%H:%M:%S.%f')[:-3]}: هیچ پیام نهایی کارگزار (پس از انفجار) یافت نشد")
-
-            except Exception as e:
-                # خطاهایی که ممکن است در حین تلاش برای خواندن پیام‌ها رخ دهد
-                self.add_log(f"خطا در بررسی پیام نهایی: {str(e)}", "warning")
-                self.submission_logs.append(f"{datetime.now(tehran_tz).strftime('%H:%M:%S.%f')[:-3]}: خطا در بررسی پیام نهایی: {str(e)}")
+            # شمارش واقعی درخواست‌های ارسال/پذیرفته/رد شده از روی رویدادهای شبکه
+            network_summary = {}
+            if self.network_tracker:
+                network_summary = self.network_tracker.summary()
+                self.add_log(f"رویدادهای شبکه: ارسال {network_summary['requests_sent']}، پذیرفته {network_summary['requests_accepted']}، رد {network_summary['requests_rejected']}، بی‌پاسخ {network_summary['requests_pending']}", "info")
+                self.submission_logs.append(f"{datetime.now(tehran_tz).strftime('%H:%M:%S.%f')[:-3]}: هیستوگرام تأخیر پاسخ سرور: {network_summary['latency_histogram']}")
+
+            # پیام‌هایی که ناظر DOM در حین ارسال ثبت کرده است (با زمان دقیق هر پیام)
+            notify_report = self._collect_notify_messages()
+            if notify_report:
+                for notify_message in notify_report.get("messages", []):
+                    msg_time = datetime.fromtimestamp(notify_message["at"] / 1000, tehran_tz).strftime("%H:%M:%S.%f")[:-3]
+                    self.submission_logs.append(f"{msg_time}: پیام کارگزار: {notify_message['text']}")
+                if accepted_at is None:
+                    accepted_at = notify_report.get("acceptedAt")
+
+            if accepted_at:
+                order_successful = True
+                accepted_at_str = datetime.fromtimestamp(accepted_at / 1000, tehran_tz).strftime('%H:%M:%S.%f')[:-3]
+                self.add_log(f"موفقیت بر اساس پیام '{success_message_keyword}' در {accepted_at_str} تأیید شد.", "success")
+            else:
+                # بررسی نهایی برای پیام موفقیت پس از اتمام زمان انفجار (در صورتی که ناظر پیامی ندیده باشد)
+                logger.info("بررسی نهایی برای پیام پس از اتمام زمان انفجار")
+                self.add_log("شروع بررسی نهایی پیام کارگزاری پس از اتمام حلقه ارسال.", "info")
+                try:
+                    # کمی صبر برای اینکه پیام‌های احتمالی در DOM ظاهر شوند
+                    time.sleep(0.5) # این زمان ممکن است نیاز به تنظیم داشته باشد
+                    
+                    # تلاش برای یافتن همه پیام‌های اعلان
+                    message_elements = self.driver.find_elements(By.CSS_SELECTOR, NOTIFY_MESSAGE_SELECTOR)
+                    
+                    if message_elements:
+                        # بررسی آخرین پیام یا همه پیام‌ها برای کلمه کلیدی موفقیت
+                        for msg_element in reversed(message_elements): # بررسی از آخرین پیام
+                            final_message = msg_element.text.strip()
+                            if final_message: # اگر پیام خالی نباشد
+                                msg_time = datetime.now(tehran_tz).strftime("%H:%M:%S.%f")[:-3]
+                                log_msg = f"{msg_time}: پیام نهایی کارگزار (پس از انفجار): {final_message}"
+                                self.submission_logs.append(log_msg)
+                                self.add_log(f"پیام نهایی پس از انفجار: {final_message}", "info")
+                                
+                                if success_message_keyword in final_message:
+                                    order_successful = True
+                                    self.add_log(f"موفقیت بر اساس پیام '{success_message_keyword}' تأیید شد.", "success")
+                                    break # اگر پیام موفقیت پیدا شد، از حلقه خارج شو
+                        if not order_successful:
+                             self.add_log("پیام موفقیت در بررسی نهایی یافت نشد.", "warning")
+                    else:
+                        self.add_log("هیچ پیام نهایی پس از ارسال سفارشاتیافت نشد.", "warning")
+                        self.submission_logs.append(f"{datetime.now(tehran_tz).strftime('%H:%M:%S.%f')[:-3]}: هیچ پیام نهایی کارگزار (پس از انفجار) یافت نشد")
+
+                except Exception as e:
+                    # خطاهایی که ممکن است در حین تلاش برای خواندن پیام‌ها رخ دهد
+                    self.add_log(f"خطا در بررسی پیام نهایی: {str(e)}", "warning")
+                    self.submission_logs.append(f"{datetime.now(tehran_tz).strftime('%H:%M:%S.%f')[:-3]}: خطا در بررسی پیام نهایی: {str(e)}")
+
+            if not order_successful and network_summary.get("requests_accepted"):
+                # پیام موفقیت ممکن است در ارسال‌های سریع از UI جا بیفتد؛ پاسخ موفق سرور ملاک است
+                order_successful = True
+                self.add_log(f"موفقیت بر اساس پاسخ شبکه تأیید شد ({network_summary['requests_accepted']} درخواست پذیرفته شده).", "success")
 
             logger.info("Order placement process completed within place_order.")
             self.add_log("فرآیند ارسال سفارش در place_order تکمیل شد", "info")
-            return {"success": order_successful, "logs": self.logs, "submission_logs": self.submission_logs, "click_count": click_count, "burst_duration": total_burst_duration}
+            return {"success": order_successful, "logs": self.logs, "submission_logs": self.submission_logs, "click_count": click_count, "burst_duration": total_burst_duration,
+                    "burst_mode": burst_mode, "click_timestamps": burst_report.get("timestamps", []), "accepted_at": accepted_at,
+                    "burst_started_at": burst_started_at, **network_summary, **fire_timing}
 
         except TimeoutException as e:
             logger.error(f"Timeout waiting for element during order placement: {e}")
@@ -826,7 +1625,7 @@ class MofidBroker:
             return {"success": False, "logs": self.logs, "submission_logs": self.submission_logs, "error": str(e)}
         finally:
             if self.driver:
-                self.driver.quit()
+                self.release_driver()
                 logger.info("Browser closed")
                 self.add_log("مرورگر بسته شد", "info")
 
@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# آدرس سرویس ثبت سفارش کارگزاری (قابل تغییر از طریق متغیر محیطی)
+ORDER_ENDPOINT_PATTERN = os.environ.get("MOFID_ORDER_ENDPOINT_PATTERN", r"/api/v\d+/order")
+# مرزهای هیستوگرام تأخیر پاسخ سرور (میلی‌ثانیه)
+LATENCY_BUCKETS_MS = (50, 100, 200, 500, 1000, 2000)
+
+
+def latency_bucket_labels():
+    lower = 0
+    labels = []
+    for upper in LATENCY_BUCKETS_MS:
+        labels.append(f"{lower}-{upper}ms")
+        lower = upper
+    labels.append(f">={LATENCY_BUCKETS_MS[-1]}ms")
+    return labels
+
+
+def latency_bucket_label(latency_ms):
+    lower = 0
+    for upper in LATENCY_BUCKETS_MS:
+        if latency_ms < upper:
+            return f"{lower}-{upper}ms"
+        lower = upper
+    return f">={LATENCY_BUCKETS_MS[-1]}ms"
+
+
+class OrderNetworkTracker:
+    """
+    Follows the order-submit requests of one burst through Chrome's performance log
+    (Network.requestWillBeSent / responseReceived / loadingFailed), so accepted/rejected
+    counts come from the broker's HTTP responses rather than from UI toasts.
+    """
+
+    def __init__(self, driver, endpoint_pattern=ORDER_ENDPOINT_PATTERN):
+        self.driver = driver
+        self.endpoint_re = re.compile(endpoint_pattern)
+        self.requests = {}  # requestId -> {"sent_at", "status", "finished_at", "failed"}
+
+    def reset(self):
+        """Drop everything Chrome has logged so far so the next summary only covers the burst."""
+        self.requests = {}
+        try:
+            self.driver.get_log("performance")
+        except Exception as e:
+            logger.warning(f"Could not drain performance log: {e}")
+
+    def collect(self):
+        """Read pending performance log entries and fold the order-endpoint events into self.requests."""
+        try:
+            entries = self.driver.get_log("performance")
+        except Exception as e:
+            logger.warning(f"Could not read performance log: {e}")
+            return
+        for entry in entries:
+            try:
+                message = json.loads(entry["message"])["message"]
+            except (KeyError, ValueError, TypeError):
+                continue
+            method = message.get("method")
+            params = message.get("params", {})
+            request_id = params.get("requestId")
+            if method == "Network.requestWillBeSent":
+                request = params.get("request", {})
+                if request.get("method") == "POST" and self.endpoint_re.search(request.get("url", "")):
+                    self.requests[request_id] = {"sent_at": params.get("timestamp"), "status": None, "finished_at": None, "failed": False}
+            elif request_id in self.requests:
+                tracked = self.requests[request_id]
+                if method == "Network.responseReceived":
+                    tracked["status"] = params.get("response", {}).get("status")
+                    tracked["finished_at"] = params.get("timestamp")
+                elif method == "Network.loadingFailed":
+                    tracked["failed"] = True
+                    tracked["finished_at"] = params.get("timestamp")
+
+    def summary(self):
+        """Sent/accepted/rejected/pending counts plus a server-latency histogram for the tracked requests."""
+        self.collect()
+        accepted = rejected = pending = 0
+        latencies_ms = []
+        histogram = dict.fromkeys(latency_bucket_labels(), 0)
+        for tracked in self.requests.values():
+            if tracked["finished_at"] is None:
+                pending += 1
+                continue
+            if not tracked["failed"] and tracked["status"] is not None and 200 <= tracked["status"] < 300:
+                accepted += 1
+            else:
+                rejected += 1
+            if tracked["sent_at"] is not None:
+                latency_ms = (tracked["finished_at"] - tracked["sent_at"]) * 1000  # timestamp های CDP بر حسب ثانیه هستند
+                latencies_ms.append(latency_ms)
+                label = latency_bucket_label(latency_ms)
+                histogram[label] += 1
+
+        latencies_ms.sort()
+        def percentile(p):
+            if not latencies_ms:
+                return None
+            return latencies_ms[min(len(latencies_ms) - 1, int(len(latencies_ms) * p))]
+
+        return {
+            "requests_sent": len(self.requests),
+            "requests_accepted": accepted,
+            "requests_rejected": rejected,
+            "requests_pending": pending,
+            "latency_histogram": {label: count for label, count in histogram.items() if count},
+            "latency_p50_ms": percentile(0.5),
+            "latency_p95_ms": percentile(0.95),
+        }
@@ -0,0 +1,138 @@
+import logging
+import re
+from datetime import datetime
+
+import pandas as pd
+import pytz
+
+logger = logging.getLogger(__name__)
+
+tehran_tz = pytz.timezone('Asia/Tehran')
+
+# کلمات کلیدی برای پیدا کردن ستون‌ها در فایل تاریخچه کارگزاری (نام دقیق ستون‌ها ممکن است تغییر کند)
+SUBMIT_TIME_COLUMN_KEYWORDS = ("زمان ثبت", "زمان ارسال", "زمان ایجاد", "تاریخ ثبت", "تاریخ ایجاد", "زمان", "ساعت")
+STATUS_COLUMN_KEYWORDS = ("وضعیت",)
+# ستونی که علت خطا/رد سفارش را نشان می‌دهد (در نبود آن، متن وضعیت ملاک است)
+REASON_COLUMN_KEYWORDS = ("توضیحات", "علت", "پیام", "شرح")
+# وضعیت‌هایی که یعنی سفارش در هسته معاملات پذیرفته نشده است
+REJECTED_STATUS_KEYWORDS = ("خطا", "رد شد", "نامعتبر", "ناموفق", "error")
+
+PERSIAN_DIGITS = str.maketrans("۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩", "01234567890123456789")
+TIME_PATTERN = re.compile(r"(\d{1,2}):(\d{2}):(\d{2})(?:[.:](\d{1,6}))?")
+
+
+def find_column(columns, keywords):
+    """First column whose header contains one of the keywords (keywords are tried in priority order)."""
+    for keyword in keywords:
+        for column in columns:
+            if keyword in str(column):
+                return column
+    return None
+
+
+def parse_time_of_day(value):
+    """'08:45:00.123' / '۱۴۰۳/۰۵/۰۱ ۰۸:۴۵:۰۰' -> (h, m, s, microseconds) or None; whole-second times map to mid-second."""
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return None
+    match = TIME_PATTERN.search(str(value).translate(PERSIAN_DIGITS))
+    if not match:
+        return None
+    fraction = match.group(4)
+    if fraction is None:
+        # زمان با دقت ثانیه ثبت شده؛ وسط همان ثانیه بهترین تخمین است
+        return int(match.group(1)), int(match.group(2)), int(match.group(3)), 500_000
+    return int(match.group(1)), int(match.group(2)), int(match.group(3)), int(fraction.ljust(6, "0")[:6])
+
+
+def is_rejected_status(status):
+    return any(keyword in str(status) for keyword in REJECTED_STATUS_KEYWORDS)
+
+
+def rows_from_dataframe(df, on_date):
+    """[{"submitted_at": epoch, "status": str, "accepted": bool}] for every row with a readable time."""
+    time_column = find_column(df.columns, SUBMIT_TIME_COLUMN_KEYWORDS)
+    status_column = find_column(df.columns, STATUS_COLUMN_KEYWORDS)
+    if time_column is None:
+        logger.warning(f"Order history has no recognisable time column: {list(df.columns)}")
+        return []
+    rows = []
+    for _, record in df.iterrows():
+        parsed = parse_time_of_day(record[time_column])
+        if not parsed:
+            continue
+        hour, minute, second, microsecond = parsed
+        submitted = tehran_tz.localize(datetime(on_date.year, on_date.month, on_date.day, hour, minute, second, microsecond))
+        status = "" if status_column is None else str(record[status_column])
+        rows.append({"submitted_at": submitted.timestamp(), "status": status, "accepted": not is_rejected_status(status)})
+    return rows
+
+
+def parse_order_history_file(path, on_date):
+    """Read a broker order-history Excel file into rows (see rows_from_dataframe)."""
+    try:
+        df = pd.read_excel(path)
+    except Exception as e:
+        logger.error(f"Could not read order history file {path}: {e}")
+        return []
+    return rows_from_dataframe(df, on_date)
+
+
+def dataframe_from_table(table):
+    """{"headers": [...], "rows": [[...]]} scraped from the page -> DataFrame (short rows padded, long rows cut)."""
+    headers = table.get("headers") or []
+    width = max([len(headers)] + [len(row) for row in table.get("rows", [])])
+    columns = [headers[i] if i < len(headers) and headers[i] else f"ستون {i + 1}" for i in range(width)]
+    rows = [(row + [""] * width)[:width] for row in table.get("rows", [])]
+    return pd.DataFrame(rows, columns=columns)
+
+
+def summarize_history(df, on_date):
+    """
+    Accepted/rejected counts, first and last accept time (HH:MM:SS.mmm, Tehran) and the
+    most common rejection reasons, from a history table or export.
+    """
+    rows = rows_from_dataframe(df, on_date)
+    accepted_times = sorted(row["submitted_at"] for row in rows if row["accepted"])
+    reason_column = find_column(df.columns, REASON_COLUMN_KEYWORDS)
+    status_column = find_column(df.columns, STATUS_COLUMN_KEYWORDS)
+    reasons = {}
+    if status_column is not None:
+        for _, record in df.iterrows():
+            if is_rejected_status(record[status_column]):
+                reason = str(record[reason_column] if reason_column is not None else record[status_column]).strip() or "نامشخص"
+                reasons[reason] = reasons.get(reason, 0) + 1
+    as_time = lambda epoch: datetime.fromtimestamp(epoch, tehran_tz).strftime("%H:%M:%S.%f")[:-3]
+    return {
+        "total": len(df),
+        "accepted": len(accepted_times),
+        "rejected": sum(reasons.values()),
+        "first_accepted_at": as_time(accepted_times[0]) if accepted_times else None,
+        "last_accepted_at": as_time(accepted_times[-1]) if accepted_times else None,
+        "rejection_reasons": sorted(reasons.items(), key=lambda item: item[1], reverse=True),
+        "rows": rows,
+    }
+
+
+def first_accepted_epoch(rows, not_before_epoch, window_seconds=120):
+    """Earliest accepted order time within window_seconds after not_before_epoch (tolerating 1 s of rounding)."""
+    candidates = [row["submitted_at"] for row in rows
+                  if row["accepted"] and not_before_epoch - 1 <= row["submitted_at"] <= not_before_epoch + window_seconds]
+    return min(candidates) if candidates else None
+
+
+def merge_history_workbooks(sheets, output_path):
+    """Write {sheet_name: excel_path} into one workbook with one sheet per export; missing files are skipped."""
+    frames = {}
+    for sheet_name, path in sheets.items():
+        if not path:
+            continue
+        try:
+            frames[sheet_name[:31]] = pd.read_excel(path)
+        except Exception as e:
+            logger.error(f"Could not read order history file {path} for merging: {e}")
+    if not frames:
+        return None
+    with pd.ExcelWriter(output_path, engine="openpyxl") as writer:
+        for sheet_name, df in frames.items():
+            df.to_excel(writer, sheet_name=sheet_name, index=False)
+    return output_path
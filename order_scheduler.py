@@ -0,0 +1,148 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# پنجره‌ی انتظار فعال (busy-wait) قبل از زمان هدف؛ قبل از آن زمان‌بند فقط می‌خوابد
+SPIN_WINDOW_SECONDS = 0.005
+# اگر زمان‌بند تا این مدت پس از زمان هدف سفارش را آزاد نکند (مثلاً نخ آن از کار افتاده)، انتظار رها می‌شود
+RELEASE_WAIT_MARGIN_SECONDS = 0.5
+
+
+class ArmedOrder:
+    """A single order waiting on the shared firing scheduler."""
+
+    def __init__(self, target_epoch, label=""):
+        self.target_epoch = target_epoch
+        self.label = label
+        self.cancelled = False
+        self.released_at = None      # زمانی که زمان‌بند سفارش را آزاد کرد (epoch)
+        self.release_jitter = None   # released_at - target_epoch (ثانیه)
+        self.wake_jitter = None      # زمان بیدار شدن نخ سفارش - target_epoch (ثانیه)
+        self._event = threading.Event()
+
+    def wait(self, timeout=None):
+        """Block the calling thread until the scheduler fires this order. Returns False if cancelled/timed out."""
+        fired = self._event.wait(timeout)
+        if not fired or self.cancelled:
+            return False
+        self.wake_jitter = time.time() - self.target_epoch
+        return True
+
+    def wait_until_due(self, margin=RELEASE_WAIT_MARGIN_SECONDS):
+        """
+        Like wait(), but never past target_epoch + margin, so a dead scheduler thread cannot hang
+        the caller. Returns "fired", "cancelled" or "timed_out"; on "timed_out" the order is
+        taken off the scheduler and wake_jitter records when the caller gave up waiting.
+        """
+        if self.wait(timeout=max(0.0, self.target_epoch - time.time()) + margin):
+            return "fired"
+        if self.cancelled:
+            return "cancelled"
+        self.cancelled = True  # زمان‌بند اگر دوباره زنده شد آن را رد می‌کند
+        self.wake_jitter = time.time() - self.target_epoch
+        logger.error(f"Firing scheduler did not release {self.label} within {margin:.3f}s of its target; "
+                     f"caller stops waiting {self.wake_jitter * 1000:.1f} ms late.")
+        return "timed_out"
+
+    def jitter_report(self):
+        """Firing jitter in milliseconds (positive = late)."""
+        return {
+            "release_jitter_ms": None if self.release_jitter is None else self.release_jitter * 1000,
+            "fire_jitter_ms": None if self.wake_jitter is None else self.wake_jitter * 1000,
+        }
+
+
+class FiringScheduler:
+    """
+    One timer heap for every scheduled/serkhati order in the process.
+    The scheduler thread sleeps coarsely until SPIN_WINDOW_SECONDS before the earliest
+    target, then spins once and releases every due order together, so N users targeting
+    the same instant cost one spinning thread instead of N.
+    """
+
+    def __init__(self, spin_window=SPIN_WINDOW_SECONDS):
+        self.spin_window = spin_window
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="firing-scheduler", daemon=True)
+            self._thread.start()
+            logger.info("Firing scheduler thread started.")
+
+    def arm(self, target_epoch, label=""):
+        """Register an order to be released at target_epoch (seconds since epoch, local clock)."""
+        self.start()
+        armed = ArmedOrder(target_epoch, label)
+        with self._cond:
+            heapq.heappush(self._heap, (target_epoch, next(self._seq), armed))
+            self._cond.notify()  # ممکن است این سفارش زودتر از سفارش فعلی سر صف باشد
+        logger.info(f"Order armed on firing scheduler: {label} @ {target_epoch:.6f}")
+        return armed
+
+    def cancel(self, armed):
+        armed.cancelled = True
+        armed._event.set()
+        with self._cond:
+            self._cond.notify()
+
+    def pending_count(self):
+        with self._cond:
+            return sum(1 for _, _, armed in self._heap if not armed.cancelled)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                target_epoch = self._heap[0][0]
+                remaining = target_epoch - time.time()
+                if remaining > self.spin_window:
+                    # خواب درشت؛ arm/cancel جدید این انتظار را زودتر قطع می‌کند
+                    self._cond.wait(timeout=remaining - self.spin_window)
+                    continue
+
+            # نقطه‌ی واحد انتظار فعال برای همه‌ی سفارش‌های این لحظه
+            while time.time() < target_epoch:
+                pass
+            released_at = time.time()
+
+            due = []
+            with self._cond:
+                while self._heap and self._heap[0][0] <= released_at:
+                    _, _, armed = heapq.heappop(self._heap)
+                    if not armed.cancelled:
+                        due.append(armed)
+            for armed in due:
+                armed.released_at = released_at
+                armed.release_jitter = released_at - armed.target_epoch
+                armed._event.set()
+            if due:
+                logger.info(f"Firing scheduler released {len(due)} order(s); "
+                            f"release jitter (ms): {[round(a.release_jitter * 1000, 3) for a in due]}")
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_firing_scheduler():
+    """Process-wide firing scheduler shared by every MofidBroker."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = FiringScheduler()
+            _scheduler.start()
+        return _scheduler
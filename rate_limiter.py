@@ -0,0 +1,275 @@
+import logging
+import os
+from abc import ABC, abstractmethod
+import threading
+import time
+from datetime import datetime, timedelta
+
+from mysql.connector import Error
+
+logger = logging.getLogger(__name__)
+
+# مدت اعتبار وضعیت محدودیت هر کاربر در حافظه‌ی همین پروسه (ثانیه)
+RATE_LIMIT_CACHE_TTL_SECONDS = float(os.environ.get("MOFID_RATE_LIMIT_CACHE_TTL", 5))
+# "mysql": جدول activity_log (قابل اشتراک بین چند پروسه) | "memory": فقط همین پروسه
+RATE_LIMIT_BACKEND = os.environ.get("MOFID_RATE_LIMIT_BACKEND", "mysql").lower()
+
+
+class RateLimitState:
+    """Rate-limit columns of one activity_log row."""
+
+    def __init__(self, cooldown_until=None, last_order_at=None):
+        self.cooldown_until = cooldown_until
+        self.last_order_at = last_order_at
+
+
+class RateLimitBackend(ABC):
+    """
+    Shared rate-limit store. Every method touches a single row and check-and-record happens
+    in one atomic statement, so several bot processes can share one backend.
+    """
+
+    @abstractmethod
+    def get_state(self, user_id):
+        """Current RateLimitState of user_id."""
+
+    @abstractmethod
+    def record_failed_login(self, user_id, now, window_start, max_attempts, cooldown_until):
+        """Count a failed login (restarting the window if it expired); start the cooldown at max_attempts. Returns the new state."""
+
+    @abstractmethod
+    def reset_login(self, user_id):
+        """Clear the failed-login count and any cooldown."""
+
+    @abstractmethod
+    def try_record_order(self, user_id, now, previous_not_after):
+        """Record an order at now only if the previous one was at or before previous_not_after. Returns (recorded, state)."""
+
+    @abstractmethod
+    def record_order(self, user_id, now):
+        """Move the last order time to now unconditionally."""
+
+
+class InMemoryRateLimitBackend(RateLimitBackend):
+    """Single-process store (MOFID_RATE_LIMIT_BACKEND=memory); state is lost on restart."""
+
+    def __init__(self):
+        self._rows = {}  # user_id -> {"count", "first_attempt", "cooldown_until", "last_order_at"}
+        self._lock = threading.Lock()
+
+    def _row(self, user_id):
+        return self._rows.setdefault(str(user_id), {"count": 0, "first_attempt": None, "cooldown_until": None, "last_order_at": None})
+
+    @staticmethod
+    def _state_of(row):
+        return RateLimitState(cooldown_until=row["cooldown_until"], last_order_at=row["last_order_at"])
+
+    def get_state(self, user_id):
+        with self._lock:
+            return self._state_of(self._row(user_id))
+
+    def record_failed_login(self, user_id, now, window_start, max_attempts, cooldown_until):
+        with self._lock:
+            row = self._row(user_id)
+            row["count"] = row["count"] + 1 if row["first_attempt"] and row["first_attempt"] > window_start else 1
+            row["cooldown_until"] = cooldown_until if row["count"] >= max_attempts else None
+            row["first_attempt"] = None if row["count"] >= max_attempts else (now if row["count"] == 1 else row["first_attempt"])
+            return self._state_of(row)
+
+    def reset_login(self, user_id):
+        with self._lock:
+            self._row(user_id).update(count=0, first_attempt=None, cooldown_until=None)
+
+    def try_record_order(self, user_id, now, previous_not_after):
+        with self._lock:
+            row = self._row(user_id)
+            recorded = row["last_order_at"] is None or row["last_order_at"] <= previous_not_after
+            if recorded:
+                row["last_order_at"] = now
+            return recorded, self._state_of(row)
+
+    def record_order(self, user_id, now):
+        with self._lock:
+            self._row(user_id)["last_order_at"] = now
+
+
+class MySQLRateLimitBackend(RateLimitBackend):
+    """activity_log-backed store; each call is one primary-key upsert (plus a primary-key read where a result is needed)."""
+
+    def __init__(self, get_connection):
+        self.get_connection = get_connection
+
+    def _run(self, user_id, statement, params, read_back=True):
+        """Execute one write statement and optionally read the row back; returns (affected_rows, state)."""
+        connection = self.get_connection()
+        if not connection:
+            raise Error("No database connection")
+        cursor = None
+        try:
+            cursor = connection.cursor()
+            affected_rows = 0
+            if statement:
+                cursor.execute(statement, params)
+                affected_rows = cursor.rowcount
+                connection.commit()
+            state = RateLimitState()
+            if read_back:
+                cursor.execute("""
+                    SELECT cooldown_until, last_order_submission_timestamp
+                    FROM activity_log WHERE telegram_id = %s
+                """, (str(user_id),))
+                row = cursor.fetchone()
+                if row:
+                    state = RateLimitState(cooldown_until=row[0], last_order_at=row[1])
+            return affected_rows, state
+        finally:
+            if cursor is not None:
+                cursor.close()
+            if connection.is_connected():
+                connection.close()
+
+    def get_state(self, user_id):
+        return self._run(user_id, None, None)[1]
+
+    def record_failed_login(self, user_id, now, window_start, max_attempts, cooldown_until):
+        # ترتیب انتساب‌ها مهم است: MySQL هر انتساب را با مقادیر به‌روزشده‌ی انتساب‌های قبلی ارزیابی می‌کند.
+        # پس از شروع cooldown، first_attempt_timestamp تهی است و تلاش ناموفق بعدی شمارش را از ۱ شروع می‌کند.
+        return self._run(user_id, """
+            INSERT INTO activity_log (telegram_id, login_attempts_count, first_attempt_timestamp, cooldown_until)
+            VALUES (%(id)s, 1, %(now)s, NULL)
+            ON DUPLICATE KEY UPDATE
+                login_attempts_count = IF(first_attempt_timestamp IS NOT NULL AND first_attempt_timestamp > %(window_start)s,
+                                          login_attempts_count + 1, 1),
+                cooldown_until = IF(login_attempts_count >= %(max_attempts)s, %(cooldown_until)s, NULL),
+                first_attempt_timestamp = IF(login_attempts_count >= %(max_attempts)s, NULL,
+                                             IF(login_attempts_count = 1, %(now)s, first_attempt_timestamp))
+        """, {"id": str(user_id), "now": now, "window_start": window_start,
+              "max_attempts": max_attempts, "cooldown_until": cooldown_until})[1]
+
+    def reset_login(self, user_id):
+        self._run(user_id, """
+            UPDATE activity_log
+            SET login_attempts_count = 0, first_attempt_timestamp = NULL, cooldown_until = NULL
+            WHERE telegram_id = %s
+        """, (str(user_id),), read_back=False)
+
+    def try_record_order(self, user_id, now, previous_not_after):
+        # بدون CLIENT_FOUND_ROWS، ردیفی که تغییر نکرده affected_rows=0 برمی‌گرداند: یعنی سفارش قبلی خیلی نزدیک بوده است
+        affected_rows, state = self._run(user_id, """
+            INSERT INTO activity_log (telegram_id, last_order_submission_timestamp)
+            VALUES (%(id)s, %(now)s)
+            ON DUPLICATE KEY UPDATE last_order_submission_timestamp =
+                IF(last_order_submission_timestamp IS NULL OR last_order_submission_timestamp <= %(not_after)s,
+                   %(now)s, last_order_submission_timestamp)
+        """, {"id": str(user_id), "now": now, "not_after": previous_not_after})
+        return affected_rows > 0, state
+
+    def record_order(self, user_id, now):
+        self._run(user_id, """
+            INSERT INTO activity_log (telegram_id, last_order_submission_timestamp)
+            VALUES (%s, %s)
+            ON DUPLICATE KEY UPDATE last_order_submission_timestamp = VALUES(last_order_submission_timestamp)
+        """, (str(user_id), now), read_back=False)
+
+
+class RateLimiter:
+    """
+    Login and order rate limits per Telegram user over a RateLimitBackend, with an in-process
+    cache of each user's state so repeated checks cost no database round-trip.
+    A cached "limited" answer is always safe to serve (limits only move forward); writes go
+    straight to the backend and refresh the cache from its result.
+    """
+
+    def __init__(self, backend, max_login_attempts, login_window_minutes, login_cooldown_minutes,
+                 min_seconds_between_orders, cache_ttl_seconds=RATE_LIMIT_CACHE_TTL_SECONDS):
+        self.backend = backend
+        self.max_login_attempts = max_login_attempts
+        self.login_window = timedelta(minutes=login_window_minutes)
+        self.login_cooldown = timedelta(minutes=login_cooldown_minutes)
+        self.min_order_interval = timedelta(seconds=min_seconds_between_orders)
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self._cache = {}  # user_id -> (RateLimitState, cached_at)
+        self._lock = threading.Lock()
+
+    def _cached(self, user_id):
+        with self._lock:
+            entry = self._cache.get(str(user_id))
+        if entry and time.monotonic() - entry[1] < self.cache_ttl_seconds:
+            return entry[0]
+        return None
+
+    def _store(self, user_id, state):
+        with self._lock:
+            self._cache[str(user_id)] = (state, time.monotonic())
+
+    def _state(self, user_id):
+        state = self._cached(user_id)
+        if state is None:
+            state = self.backend.get_state(user_id)
+            self._store(user_id, state)
+        return state
+
+    def login_cooldown_remaining(self, user_id):
+        """Seconds left in the login cooldown (0 if none)."""
+        now = datetime.now()
+        try:
+            state = self._state(user_id)
+        except Error as e:
+            logger.error(f"Login rate-limit check failed for user {user_id}: {e}")
+            return 0
+        if state.cooldown_until and now < state.cooldown_until:
+            return (state.cooldown_until - now).total_seconds()
+        return 0
+
+    def record_failed_login(self, user_id):
+        now = datetime.now()
+        try:
+            state = self.backend.record_failed_login(user_id, now, now - self.login_window,
+                                                     self.max_login_attempts, now + self.login_cooldown)
+        except Error as e:
+            logger.error(f"Error recording failed login attempt for user {user_id}: {e}")
+            return
+        self._store(user_id, state)
+        if state.cooldown_until and state.cooldown_until > now:
+            logger.warning(f"User {user_id} rate-limited for login. Cooldown until: {state.cooldown_until}")
+
+    def reset_login(self, user_id):
+        try:
+            self.backend.reset_login(user_id)
+        except Error as e:
+            logger.error(f"Error resetting login attempts for user {user_id}: {e}")
+            return
+        with self._lock:
+            entry = self._cache.get(str(user_id))
+            if entry:
+                entry[0].cooldown_until = None
+        logger.info(f"Login attempts reset for user {user_id}")
+
+    def acquire_order_slot(self, user_id):
+        """Atomically check and record an order submission. Returns seconds to wait (0 means the slot was taken)."""
+        now = datetime.now()
+        cached = self._cached(user_id)
+        if cached and cached.last_order_at and now - cached.last_order_at < self.min_order_interval:
+            return (self.min_order_interval - (now - cached.last_order_at)).total_seconds()
+        try:
+            recorded, state = self.backend.try_record_order(user_id, now, now - self.min_order_interval)
+        except Error as e:
+            logger.error(f"Order rate-limit check failed for user {user_id}: {e}")
+            return 0
+        self._store(user_id, state)
+        if recorded or not state.last_order_at:
+            return 0
+        return max(0.0, (self.min_order_interval - (now - state.last_order_at)).total_seconds())
+
+    def record_order(self, user_id):
+        """Move the order window to now (called again after a long scheduled placement finishes)."""
+        now = datetime.now()
+        try:
+            self.backend.record_order(user_id, now)
+        except Error as e:
+            logger.error(f"Error recording order submission for user {user_id}: {e}")
+            return
+        with self._lock:
+            entry = self._cache.get(str(user_id))
+            if entry:
+                entry[0].last_order_at = now
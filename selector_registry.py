@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from filelock import FileLock
+from selenium.common.exceptions import TimeoutException
+
+logger = logging.getLogger(__name__)
+
+# فایل ذخیره انتخابگر برنده برای هر عنصر منطقی (بین اجراهای ربات حفظ می‌شود)
+SELECTOR_CACHE_FILE = os.environ.get("MOFID_SELECTOR_CACHE", "selector_cache.json")
+
+# همه‌ی کاندیداها در یک فراخوانی بررسی می‌شوند؛ اولین مورد منطبق [index, element] برمی‌گردد
+# arguments: [[[kind, selector], ...], require_clickable]
+JS_RESOLVE_CANDIDATES = """
+const candidates = arguments[0];
+const requireClickable = arguments[1];
+for (let i = 0; i < candidates.length; i++) {
+    const kind = candidates[i][0], selector = candidates[i][1];
+    let el = null;
+    try {
+        if (kind === 'xpath') {
+            el = document.evaluate(selector, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+        } else {
+            el = document.querySelector(selector);
+        }
+    } catch (e) {
+        continue;
+    }
+    if (!el) continue;
+    if (requireClickable && (el.getClientRects().length === 0 || el.disabled)) continue;
+    return [i, el];
+}
+return null;
+"""
+
+
+class SelectorRegistry:
+    """
+    Candidate selectors per logical element ("quantity_input", "action_button", ...).
+    The candidate that matched most recently is tried first, and every poll resolves
+    all candidates in one script, so a broker UI change costs one slow lookup instead
+    of a full timeout per stale selector on every order.
+    """
+
+    def __init__(self, candidates, cache_path=SELECTOR_CACHE_FILE):
+        self.candidates = candidates  # key -> [(kind, selector_template), ...]; kind: "css" | "xpath"
+        self.cache_path = cache_path
+        self._winners = {}            # key -> index in candidates[key]
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        try:
+            with FileLock(self.cache_path + ".lock"):
+                with open(self.cache_path, "r", encoding="utf-8") as f:
+                    stored = json.load(f)
+            self._winners = {key: index for key, index in stored.items()
+                             if key in self.candidates and 0 <= index < len(self.candidates[key])}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read selector cache {self.cache_path}: {e}")
+
+    def _save(self):
+        if not self.cache_path:
+            return
+        try:
+            with FileLock(self.cache_path + ".lock"):
+                with open(self.cache_path, "w", encoding="utf-8") as f:
+                    json.dump(self._winners, f)
+        except OSError as e:
+            logger.warning(f"Could not write selector cache {self.cache_path}: {e}")
+
+    def ordered(self, key, **params):
+        """[(candidate_index, kind, selector)] with the learned winner first and templates filled from params."""
+        with self._lock:
+            winner = self._winners.get(key, 0)
+        indexes = [winner] + [i for i in range(len(self.candidates[key])) if i != winner]
+        return [(i, self.candidates[key][i][0], self.candidates[key][i][1].format(**params)) for i in indexes]
+
+    def record(self, key, candidate_index):
+        with self._lock:
+            if self._winners.get(key, 0) == candidate_index:
+                return
+            self._winners[key] = candidate_index
+            self._save()
+        logger.info(f"Selector winner for '{key}' is now candidate #{candidate_index}")
+
+    def find(self, driver, key, timeout=10, clickable=False, poll_interval=0.05, **params):
+        """
+        Poll until any candidate for `key` matches (and is visible/enabled if clickable).
+        Returns (element, (kind, selector)); raises TimeoutException if nothing matched in time.
+        """
+        ordered = self.ordered(key, **params)
+        script_candidates = [[kind, selector] for _, kind, selector in ordered]
+        deadline = time.monotonic() + timeout
+        while True:
+            match = driver.execute_script(JS_RESOLVE_CANDIDATES, script_candidates, clickable)
+            if match:
+                position, element = match
+                candidate_index, kind, selector = ordered[position]
+                if position != 0:
+                    logger.warning(f"Selector for '{key}' fell back to candidate #{candidate_index}: {selector}")
+                self.record(key, candidate_index)
+                return element, (kind, selector)
+            if time.monotonic() >= deadline:
+                raise TimeoutException(f"No selector candidate matched for '{key}' within {timeout}s")
+            time.sleep(poll_interval)
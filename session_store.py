@@ -0,0 +1,99 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+from filelock import FileLock
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:  # بدون cryptography ذخیره نشست غیرفعال می‌ماند
+    Fernet = None
+    InvalidToken = Exception
+
+logger = logging.getLogger(__name__)
+
+# کلید Fernet (خروجی Fernet.generate_key()); در صورت نبود، ذخیره نشست غیرفعال است
+SESSION_STORE_KEY = os.environ.get("MOFID_SESSION_KEY", "")
+SESSION_STORE_DIR = os.environ.get("MOFID_SESSION_DIR", os.path.join(os.getcwd(), "broker_sessions"))
+# نشست‌های قدیمی‌تر از این مقدار بازیابی نمی‌شوند
+SESSION_MAX_AGE_SECONDS = int(os.environ.get("MOFID_SESSION_MAX_AGE", 12 * 3600))
+
+
+class BrokerSessionStore:
+    """
+    Encrypted per-user store of broker web-session state (cookies + local/session storage),
+    one file per (telegram user, brokerage username).
+    """
+
+    def __init__(self, key=SESSION_STORE_KEY, directory=SESSION_STORE_DIR, max_age_seconds=SESSION_MAX_AGE_SECONDS):
+        self.directory = directory
+        self.max_age_seconds = max_age_seconds
+        self.fernet = None
+        if key and Fernet is not None:
+            try:
+                self.fernet = Fernet(key.encode() if isinstance(key, str) else key)
+                os.makedirs(self.directory, exist_ok=True)
+            except (ValueError, TypeError) as e:
+                logger.error(f"Invalid MOFID_SESSION_KEY, broker session store disabled: {e}")
+                self.fernet = None
+        elif key:
+            logger.warning("cryptography is not installed; broker session store disabled.")
+
+    @property
+    def enabled(self):
+        return self.fernet is not None
+
+    def _path(self, user_id, brokerage_username):
+        digest = hashlib.sha256(f"{user_id}:{(brokerage_username or '').strip().lower()}".encode()).hexdigest()
+        return os.path.join(self.directory, f"{digest}.session")
+
+    def save(self, user_id, brokerage_username, state):
+        if not self.enabled or not state:
+            return False
+        path = self._path(user_id, brokerage_username)
+        payload = self.fernet.encrypt(json.dumps({"saved_at": time.time(), "state": state}).encode())
+        try:
+            with FileLock(path + ".lock"):
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(payload)
+                os.replace(tmp_path, path)
+            logger.info(f"Broker session saved for user {user_id}.")
+            return True
+        except OSError as e:
+            logger.error(f"Could not save broker session for user {user_id}: {e}")
+            return False
+
+    def load(self, user_id, brokerage_username):
+        """Return the stored state dict, or None if missing, expired or undecryptable."""
+        if not self.enabled:
+            return None
+        path = self._path(user_id, brokerage_username)
+        if not os.path.exists(path):
+            return None
+        try:
+            with FileLock(path + ".lock"):
+                with open(path, "rb") as f:
+                    payload = f.read()
+            record = json.loads(self.fernet.decrypt(payload))
+        except (OSError, ValueError, InvalidToken) as e:
+            logger.warning(f"Discarding unreadable broker session for user {user_id}: {e}")
+            self.delete(user_id, brokerage_username)
+            return None
+        if time.time() - record.get("saved_at", 0) > self.max_age_seconds:
+            self.delete(user_id, brokerage_username)
+            return None
+        return record.get("state")
+
+    def delete(self, user_id, brokerage_username):
+        if not self.enabled:
+            return
+        path = self._path(user_id, brokerage_username)
+        try:
+            with FileLock(path + ".lock"):
+                if os.path.exists(path):
+                    os.remove(path)
+        except OSError as e:
+            logger.error(f"Could not delete broker session for user {user_id}: {e}")
@@ -0,0 +1,226 @@
+import itertools
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.request
+
+import websocket
+from selenium import webdriver
+
+logger = logging.getLogger(__name__)
+
+# مسیر باینری کروم (در صورت خالی بودن، از PATH پیدا می‌شود)
+CHROME_BINARY = os.environ.get("CHROME_BINARY", "")
+CHROME_BINARY_CANDIDATES = ("google-chrome", "google-chrome-stable", "chromium", "chromium-browser", "chrome")
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def find_chrome_binary():
+    if CHROME_BINARY:
+        return CHROME_BINARY
+    for candidate in CHROME_BINARY_CANDIDATES:
+        path = shutil.which(candidate)
+        if path:
+            return path
+    raise RuntimeError("Chrome binary not found; set CHROME_BINARY.")
+
+
+class SharedChromeBrowser:
+    """
+    One headless Chrome process hosting an isolated browser context per user
+    (CDP Target.createBrowserContext), so cookies/storage stay separate while the
+    browser's base memory is paid once. Each user still gets its own chromedriver,
+    attached through debuggerAddress and pinned to the tab of its own context.
+    """
+
+    def __init__(self, chrome_args=()):
+        # حالت headless را خود این کلاس با --headless=new تنظیم می‌کند
+        self.chrome_args = [arg for arg in chrome_args if not arg.startswith("--headless")]
+        self.port = None
+        self.process = None
+        self.user_data_dir = None
+        self._ws = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()  # یک فرمان CDP در هر لحظه روی اتصال مرورگر
+
+    def start(self):
+        with self._lock:
+            if self.process and self.process.poll() is None:
+                return
+            self.port = _free_port()
+            self.user_data_dir = tempfile.mkdtemp(prefix="mofid-shared-chrome-")
+            command = [
+                find_chrome_binary(),
+                "--headless=new",
+                f"--remote-debugging-port={self.port}",
+                f"--user-data-dir={self.user_data_dir}",
+                *self.chrome_args,
+                "about:blank",
+            ]
+            self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            browser_ws_url = self._wait_for_devtools()
+            self._ws = websocket.create_connection(browser_ws_url, timeout=30)
+        logger.info(f"Shared Chrome started (pid {self.process.pid}, devtools port {self.port}).")
+
+    def stop(self):
+        with self._lock:
+            if self._ws:
+                try:
+                    self._ws.close()
+                except Exception:
+                    pass
+                self._ws = None
+            if self.process and self.process.poll() is None:
+                self.process.terminate()
+                try:
+                    self.process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+            self.process = None
+            if self.user_data_dir:
+                shutil.rmtree(self.user_data_dir, ignore_errors=True)
+                self.user_data_dir = None
+
+    def _wait_for_devtools(self, timeout=20):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{self.port}/json/version", timeout=2) as response:
+                    return json.loads(response.read())["webSocketDebuggerUrl"]
+            except Exception:
+                time.sleep(0.2)
+        raise RuntimeError("Shared Chrome did not expose its DevTools endpoint in time.")
+
+    def cdp(self, method, params=None):
+        """Send a browser-level CDP command and return its result."""
+        with self._lock:
+            if not self._ws:
+                raise RuntimeError("Shared Chrome is not running.")
+            message_id = next(self._ids)
+            self._ws.send(json.dumps({"id": message_id, "method": method, "params": params or {}}))
+            while True:
+                reply = json.loads(self._ws.recv())
+                if reply.get("id") != message_id:
+                    continue  # رویدادها و پاسخ‌های دیگر نادیده گرفته می‌شوند
+                if "error" in reply:
+                    raise RuntimeError(f"CDP {method} failed: {reply['error'].get('message')}")
+                return reply.get("result", {})
+
+    def open_context(self, download_dir, options_factory, url="about:blank"):
+        """
+        Create an isolated context with one tab and a chromedriver attached to it.
+        options_factory() must return selenium ChromeOptions (debuggerAddress is set here).
+        Returns (driver, browser_context_id).
+        """
+        self.start()
+        context_id = self.cdp("Target.createBrowserContext", {"disposeOnDetach": False})["browserContextId"]
+        try:
+            target_id = self.cdp("Target.createTarget", {"url": url, "browserContextId": context_id})["targetId"]
+            self.cdp("Browser.setDownloadBehavior", {
+                "behavior": "allow",
+                "browserContextId": context_id,
+                "downloadPath": download_dir,
+                "eventsEnabled": False,
+            })
+            options = options_factory()
+            options.debugger_address = f"127.0.0.1:{self.port}"
+            driver = webdriver.Chrome(options=options)
+            driver.switch_to.window(target_id)  # handle های chromedriver همان targetId هستند
+        except Exception:
+            self.dispose_context(context_id)
+            raise
+        logger.info(f"Opened browser context {context_id} on shared Chrome.")
+        return driver, context_id
+
+    def context_window_handles(self, context_id):
+        """Tabs (window handles) that belong to one context; other users' tabs are excluded."""
+        targets = self.cdp("Target.getTargets").get("targetInfos", [])
+        return [t["targetId"] for t in targets if t.get("type") == "page" and t.get("browserContextId") == context_id]
+
+    def dispose_context(self, context_id):
+        try:
+            self.cdp("Target.disposeBrowserContext", {"browserContextId": context_id})
+        except Exception as e:
+            logger.warning(f"Could not dispose browser context {context_id}: {e}")
+
+    def close_context(self, driver, context_id):
+        """Close a user's context and stop its chromedriver without touching the shared browser."""
+        self.dispose_context(context_id)
+        try:
+            # quit() روی درایور متصل‌شده ممکن است تب‌های دیگران را هم ببندد؛ فقط سرویس chromedriver را متوقف می‌کنیم
+            driver.service.stop()
+        except Exception as e:
+            logger.warning(f"Error stopping chromedriver for context {context_id}: {e}")
+
+    def process_pids(self):
+        """PIDs of the shared Chrome process tree (for memory accounting)."""
+        if not self.process:
+            return []
+        return [self.process.pid] + descendant_pids(self.process.pid)
+
+
+def descendant_pids(root_pid):
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat_file:
+                # فیلد چهارم ppid است؛ نام فرآیند ممکن است فاصله داشته باشد
+                ppid = int(stat_file.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    result, stack = [], [root_pid]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            result.append(child)
+            stack.append(child)
+    return result
+
+
+def rss_kb(pids):
+    """Total resident memory (VmRSS, kB) of the given processes."""
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as status_file:
+                for line in status_file:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+                        break
+        except OSError:
+            continue
+    return total
+
+
+_shared_browser = None
+_shared_browser_lock = threading.Lock()
+
+
+def get_shared_browser(chrome_args=()):
+    """Process-wide shared Chrome used when MOFID_BROWSER_BACKEND=shared."""
+    global _shared_browser
+    with _shared_browser_lock:
+        if _shared_browser is None:
+            _shared_browser = SharedChromeBrowser(chrome_args)
+        return _shared_browser
+
+
+def stop_shared_browser():
+    """Stop the process-wide shared Chrome (and remove its temp profile) if one was created."""
+    with _shared_browser_lock:
+        browser = _shared_browser
+    if browser is not None:
+        browser.stop()
@@ -0,0 +1,41 @@
+import asyncio
+import os
+
+from telegram.ext import BaseUpdateProcessor
+
+# سقف آپدیت‌های هم‌زمان در کل ربات (کاربران مختلف)؛ آپدیت‌های یک کاربر همیشه به ترتیب و یکی‌یکی اجرا می‌شوند
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MOFID_MAX_CONCURRENT_UPDATES", 256))
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates from different users concurrently but updates from the same user in
+    arrival order, one at a time. ConversationHandler relies on that order: a /start or a second
+    confirm button must not run while the same user's order or login is still in progress.
+    Updates without a user (e.g. channel posts) are not serialised.
+    """
+
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}  # user_id -> [asyncio.Lock, updates holding or waiting for it]
+
+    async def do_process_update(self, update, coroutine):
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            await coroutine
+            return
+        entry = self._locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[user.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,149 @@
+import logging
+import os
+import threading
+import time
+
+from mysql.connector import Error
+
+logger = logging.getLogger(__name__)
+
+# مدت اعتبار رکورد کاربر در حافظه (ثانیه)؛ سقف تاخیر دیده شدن تغییری که اعلان ابطال آن نرسیده باشد
+USER_CACHE_TTL_SECONDS = float(os.environ.get("MOFID_USER_CACHE_TTL", 300))
+# هر چند ثانیه جدول user_cache_invalidations (ویرایش‌های پنل ادمین) بررسی شود
+USER_CACHE_INVALIDATION_POLL_SECONDS = float(os.environ.get("MOFID_USER_CACHE_POLL", 5))
+STATS_LOG_EVERY_LOOKUPS = 500
+
+INVALIDATION_TABLE_DDL = """
+    CREATE TABLE IF NOT EXISTS user_cache_invalidations (
+        telegram_id VARCHAR(64) NOT NULL PRIMARY KEY,
+        invalidated_at DATETIME(6) NOT NULL,
+        KEY idx_user_cache_invalidations_at (invalidated_at)
+    )
+"""
+
+
+def ensure_invalidation_table(cursor):
+    # DDL باعث commit ضمنی می‌شود؛ پیش از شروع تغییرات تراکنش صدا زده شود
+    cursor.execute(INVALIDATION_TABLE_DDL)
+
+
+def publish_user_invalidation(cursor, telegram_ids):
+    """
+    Tell every bot process to drop its cached copy of these users. Runs on the caller's cursor
+    so it commits together with the edit itself (used by the admin panel).
+    """
+    cursor.executemany("""
+        INSERT INTO user_cache_invalidations (telegram_id, invalidated_at) VALUES (%s, NOW(6))
+        ON DUPLICATE KEY UPDATE invalidated_at = NOW(6)
+    """, [(str(telegram_id),) for telegram_id in telegram_ids])
+
+
+class UserCache:
+    """
+    Read-through cache of users rows keyed by telegram_id. Writes made by this process
+    invalidate the entry directly; writes from other processes (admin panel) are picked up by
+    polling user_cache_invalidations at most once per poll interval, piggybacked on lookups.
+    Missing users are cached too, so unregistered users do not cost a query per step.
+    """
+
+    def __init__(self, loader, get_connection=None, ttl_seconds=USER_CACHE_TTL_SECONDS,
+                 poll_seconds=USER_CACHE_INVALIDATION_POLL_SECONDS):
+        self.loader = loader  # telegram_id -> row dict or None; raises mysql Error on failure
+        self.get_connection = get_connection
+        self.ttl_seconds = ttl_seconds
+        self.poll_seconds = poll_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}  # telegram_id -> (row or None, cached_at)
+        self._generation = {}  # telegram_id -> invalidation count, so an in-flight load cannot store stale data
+        self._lock = threading.Lock()
+        self._last_poll = 0.0
+        self._last_invalidation_seen = None
+        self._poll_disabled = get_connection is None
+        self._poll_failed = False
+
+    def get(self, telegram_id):
+        """Row dict (a copy, safe to mutate) or None if the user does not exist."""
+        key = str(telegram_id)
+        self._poll_invalidations()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] < self.ttl_seconds:
+                self.hits += 1
+                self._maybe_log_stats()
+                return dict(entry[0]) if entry[0] is not None else None
+            self.misses += 1
+            self._maybe_log_stats()
+            generation = self._generation.get(key, 0)
+
+        row = self.loader(telegram_id)
+        with self._lock:
+            if self._generation.get(key, 0) == generation:
+                self._entries[key] = (row, time.monotonic())
+        return dict(row) if row is not None else None
+
+    def invalidate(self, telegram_id):
+        key = str(telegram_id)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generation[key] = self._generation.get(key, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries),
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
+
+    def _maybe_log_stats(self):
+        # با قفل صدا زده می‌شود
+        lookups = self.hits + self.misses
+        if lookups % STATS_LOG_EVERY_LOOKUPS == 0:
+            logger.info(f"User cache: {self.hits} hits, {self.misses} misses "
+                        f"({self.hits / lookups:.0%} hit rate), {len(self._entries)} entries")
+
+    def _poll_invalidations(self):
+        if self._poll_disabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_poll < self.poll_seconds:
+                return
+            self._last_poll = now
+            since = self._last_invalidation_seen
+
+        connection = self.get_connection()
+        if not connection:
+            return
+        cursor = None
+        try:
+            cursor = connection.cursor()
+            if since is None:
+                # اولین بررسی: فقط نقطه شروع را برمی‌داریم؛ حافظه هنوز خالی است
+                cursor.execute(INVALIDATION_TABLE_DDL)
+                cursor.execute("SELECT COALESCE(MAX(invalidated_at), NOW(6)) FROM user_cache_invalidations")
+                rows = [(None, cursor.fetchone()[0])]
+            else:
+                cursor.execute("""
+                    SELECT telegram_id, invalidated_at FROM user_cache_invalidations
+                    WHERE invalidated_at > %s
+                """, (since,))
+                rows = cursor.fetchall()
+        except Error as e:
+            if not self._poll_failed:
+                logger.warning(f"User cache invalidation poll failed, relying on TTL until it recovers: {e}")
+            self._poll_failed = True
+            return
+        finally:
+            if cursor is not None:
+                cursor.close()
+            if connection.is_connected():
+                connection.close()
+
+        self._poll_failed = False
+        for telegram_id, invalidated_at in rows:
+            if telegram_id is not None:
+                self.invalidate(telegram_id)
+            with self._lock:
+                if self._last_invalidation_seen is None or invalidated_at > self._last_invalidation_seen:
+                    self._last_invalidation_seen = invalidated_at
@@ -0,0 +1,193 @@
+import logging
+from datetime import datetime
+
+from mysql.connector import Error
+
+logger = logging.getLogger(__name__)
+
+USER_COLUMNS = ("telegram_id", "telegram_name", "registration_date", "brokerage_type", "full_name",
+                "brokerage_username", "subscription_type", "token", "expiry_date", "brokerage_password",
+                "real_name", "national_id", "phone_number", "email")
+TOKEN_COLUMNS = ("token", "is_used", "used_by_telegram_id", "used_at", "telegram_id",
+                 "brokerage_username", "subscription_type", "expiry_date")
+
+TOKEN_REJECTION_MESSAGES = {
+    "not_found": "توکن نامعتبر یا پیدا نشد.",
+    "used": "این توکن قبلا استفاده شده است.",
+    "wrong_user": "این توکن برای شناسه تلگرام شما صادر نشده است.",
+    "wrong_brokerage": "این توکن برای نام کاربری کارگزاری '{brokerage_username}' معتبر نیست.",
+    "expired": "توکن منقضی شده است.",
+    "user_missing": "حساب کاربری برای فعال‌سازی توکن پیدا نشد.",
+    "db_error": "خطا در بررسی توکن",
+}
+
+
+class TokenRedemption:
+    """Outcome of UserRepository.redeem_premium_token; reason is "redeemed" or a TOKEN_REJECTION_MESSAGES key."""
+
+    def __init__(self, reason, message="", token_data=None, expiry_date=None):
+        self.reason = reason
+        self.message = message
+        self.token_data = token_data
+        self.expiry_date = expiry_date  # "%Y-%m-%d %H:%M:%S" of the new premium subscription
+
+    @property
+    def ok(self):
+        return self.reason == "redeemed"
+
+    @classmethod
+    def rejected(cls, reason, token_data=None, **message_args):
+        return cls(reason, TOKEN_REJECTION_MESSAGES[reason].format(**message_args), token_data)
+
+
+def token_rejection_reason(token_data, telegram_id, brokerage_username, now):
+    """None if token_data (a locked tokens row) may be redeemed by this user, else the rejection reason."""
+    if not token_data:
+        return "not_found"
+    if token_data.get("is_used"):
+        return "used"
+    bound_telegram_id = token_data.get("telegram_id")
+    if bound_telegram_id and str(bound_telegram_id) != str(telegram_id):
+        return "wrong_user"
+    bound_brokerage_username = token_data.get("brokerage_username")
+    if bound_brokerage_username and (brokerage_username or "").lower() != bound_brokerage_username.lower():
+        return "wrong_brokerage"
+    if token_data.get("expiry_date") and now >= token_data["expiry_date"]:
+        return "expired"
+    return None
+
+
+def upsert_user_statement(user):
+    """INSERT ... ON DUPLICATE KEY UPDATE for the columns present in `user` (other columns keep their values)."""
+    columns = [column for column in USER_COLUMNS if column in user]
+    updates = ", ".join(f"{column} = VALUES({column})" for column in columns if column != "telegram_id")
+    return (f"INSERT INTO users ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) "
+            f"ON DUPLICATE KEY UPDATE {updates}", tuple(user[column] for column in columns))
+
+
+class UserRepository:
+    """
+    Targeted single-row reads and writes for users and tokens, so registration and token
+    redemption cost a constant number of statements instead of a full-table load and re-save.
+    """
+
+    def __init__(self, get_connection, on_user_write=None):
+        self.get_connection = get_connection
+        self.on_user_write = on_user_write  # telegram_id -> None, e.g. drop the user's cached record
+
+    def _user_written(self, telegram_id):
+        if self.on_user_write is not None:
+            self.on_user_write(telegram_id)
+
+    def _execute(self, statement, params, fetch=None):
+        """Run one statement in its own pooled connection; fetch is None, "one" or "all". Returns rows or rowcount."""
+        connection = self.get_connection()
+        if not connection:
+            raise Error("No database connection")
+        cursor = None
+        try:
+            cursor = connection.cursor(dictionary=True)
+            cursor.execute(statement, params)
+            if fetch == "one":
+                return cursor.fetchone()
+            if fetch == "all":
+                return cursor.fetchall()
+            connection.commit()
+            return cursor.rowcount
+        finally:
+            if cursor is not None:
+                cursor.close()
+            if connection.is_connected():
+                connection.close()
+
+    def upsert_user(self, user):
+        """Insert or update one user row with the columns present in `user` (other columns keep their values)."""
+        try:
+            self._execute(*upsert_user_statement(user))
+        finally:
+            self._user_written(user["telegram_id"])
+
+    def update_user_fields(self, telegram_id, **fields):
+        """UPDATE only the given columns of one user. Returns the affected row count."""
+        unknown = set(fields) - set(USER_COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown user columns: {sorted(unknown)}")
+        if not fields:
+            return 0
+        assignments = ", ".join(f"{column} = %s" for column in fields)
+        try:
+            return self._execute(f"UPDATE users SET {assignments} WHERE telegram_id = %s",
+                                 (*fields.values(), telegram_id))
+        finally:
+            self._user_written(telegram_id)
+
+    def redeem_premium_token(self, token, telegram_id, brokerage_username, expiry_for, new_user=None):
+        """
+        Check and spend a premium token in one transaction: the token row is locked with
+        SELECT ... FOR UPDATE, so two users racing for the same token cannot both succeed.
+        The user's subscription is written in the same transaction — new_user (a full users row)
+        is upserted for a registration, otherwise the existing row is updated.
+        expiry_for(token_subscription_type) -> datetime of the new subscription's expiry.
+        """
+        connection = self.get_connection()
+        if not connection:
+            logger.error("Cannot redeem token: No database connection")
+            return TokenRedemption.rejected("db_error")
+        cursor = None
+        try:
+            connection.start_transaction()
+            cursor = connection.cursor(dictionary=True)
+            cursor.execute("SELECT * FROM tokens WHERE token = %s FOR UPDATE", (token,))
+            token_data = cursor.fetchone()
+            now = datetime.now()
+            reason = token_rejection_reason(token_data, telegram_id, brokerage_username, now)
+            if reason is None and new_user is None:
+                cursor.execute("SELECT telegram_id FROM users WHERE telegram_id = %s FOR UPDATE", (telegram_id,))
+                if cursor.fetchone() is None:
+                    reason = "user_missing"
+            if reason is not None:
+                connection.rollback()
+                logger.warning(f"Token {token} refused for Telegram ID {telegram_id}: {reason}")
+                return TokenRedemption.rejected(reason, token_data, brokerage_username=brokerage_username)
+
+            expiry_date = expiry_for(token_data.get("subscription_type") or "ماهانه").strftime("%Y-%m-%d %H:%M:%S")
+            cursor.execute("""
+                UPDATE tokens SET is_used = TRUE, used_by_telegram_id = %s, used_at = %s
+                WHERE token = %s AND NOT is_used
+            """, (telegram_id, now.strftime("%Y-%m-%d %H:%M:%S"), token))
+            subscription = {"subscription_type": "premium", "token": token, "expiry_date": expiry_date}
+            if new_user is not None:
+                cursor.execute(*upsert_user_statement({**new_user, **subscription}))
+            else:
+                cursor.execute("""
+                    UPDATE users SET subscription_type = %s, token = %s, expiry_date = %s
+                    WHERE telegram_id = %s
+                """, (*subscription.values(), telegram_id))
+            connection.commit()
+            return TokenRedemption("redeemed", token_data=token_data, expiry_date=expiry_date)
+        except Error as e:
+            logger.error(f"Error redeeming token {token} for Telegram ID {telegram_id}: {e}")
+            try:
+                connection.rollback()
+            except Error:
+                pass
+            return TokenRedemption.rejected("db_error")
+        finally:
+            self._user_written(telegram_id)
+            if cursor is not None:
+                cursor.close()
+            if connection.is_connected():
+                connection.close()
+
+    def brokerage_username_owners(self, brokerage_username, brokerage_type="mofid"):
+        """telegram_ids (as strings) registered with this brokerage username (case-insensitive)."""
+        rows = self._execute("""
+            SELECT telegram_id FROM users
+            WHERE brokerage_username_normalized = LOWER(%s) AND brokerage_type = %s
+        """, (brokerage_username, brokerage_type), fetch="all")
+        return {str(row["telegram_id"]) for row in rows}
+
+
+def record_fingerprint(record, columns):
+    """Comparable snapshot of a record's persisted columns (used to find dirty rows in bulk saves)."""
+    return tuple(str(record.get(column)) for column in columns)